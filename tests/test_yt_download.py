@@ -8,6 +8,7 @@
 import os
 import sys
 import tempfile
+import time
 from pathlib import Path
 from unittest.mock import MagicMock
 from collections import namedtuple
@@ -35,6 +36,7 @@ def load_module(module_name, file_name):
 
 ru = load_module("yt_download_ru", "yt_download_ru.py")
 en = load_module("yt_download_en", "yt_download_en.py")
+cleaner = load_module("yt_media_cleaner_ru", "yt_media_cleaner_ru.py")
 
 
 # ── Fixture: reset config cache after each load_config test ───
@@ -602,3 +604,1615 @@ def test_idempotent(self, tmp_path):
         path = self._make_info_json(tmp_path, info)
         assert en.generate_nfo_file(path) is True
         assert en.generate_nfo_file(path) is True
+
+
+# ═══════════════════════════════════════════════════════════════
+# Media cleaner: find_duplicates() + hash cache
+# ═══════════════════════════════════════════════════════════════
+
+class TestCleanerHashCache:
+    def _tree(self, tmp_path):
+        root = tmp_path / "lib"
+        (root / "a").mkdir(parents=True)
+        (root / "b").mkdir()
+        big = os.urandom(cleaner.PARTIAL_HASH_SIZE * 3)
+        (root / "a" / "v [id1].jpg").write_bytes(big)
+        (root / "b" / "v [id1].jpg").write_bytes(big)
+        # Same size and same head/tail, different middle -> not a duplicate
+        other = big[:cleaner.PARTIAL_HASH_SIZE] + b"x" * cleaner.PARTIAL_HASH_SIZE + big[-cleaner.PARTIAL_HASH_SIZE:]
+        (root / "b" / "other.jpg").write_bytes(other)
+        (root / "a" / "small.json").write_text("{}", encoding="utf-8")
+        (root / "b" / "small.json").write_text("{}", encoding="utf-8")
+        (root / "b" / "unique.json").write_text("{\"x\": 1}", encoding="utf-8")
+        return root
+
+    def test_groups(self, tmp_path):
+        root = self._tree(tmp_path)
+        dupes = cleaner.find_duplicates(root)
+        groups = sorted(sorted(f.path.name for f in files) for files in dupes.values())
+        assert groups == [["small.json", "small.json"], ["v [id1].jpg", "v [id1].jpg"]]
+
+    @pytest.mark.parametrize("algorithm", ["sha256", "blake2b"])
+    def test_parallel_algorithms(self, tmp_path, algorithm):
+        root = self._tree(tmp_path)
+        dupes = cleaner.find_duplicates(root, None, algorithm, workers=4)
+        assert len(dupes) == 2
+
+    @pytest.mark.parametrize("algorithm,ref", [("sha256", "sha256"), ("blake2b", "blake2b")])
+    def test_calc_hash_readinto(self, tmp_path, algorithm, ref):
+        import hashlib
+        data = os.urandom(cleaner.HASH_BUFFER_SIZE * 2 + 3)
+        fp = tmp_path / "f.bin"
+        fp.write_bytes(data)
+        assert cleaner.calc_hash(fp, algorithm) == hashlib.new(ref, data).hexdigest()
+
+    def test_second_scan_reads_nothing(self, tmp_path, monkeypatch):
+        root = self._tree(tmp_path)
+        conn = cleaner.open_hash_cache(tmp_path / "cache.sqlite")
+        first = cleaner.find_duplicates(root, conn)
+
+        def fail(*a, **kw):
+            raise AssertionError("file was re-read")
+
+        monkeypatch.setattr(cleaner, "calc_hash", fail)
+        monkeypatch.setattr(cleaner, "calc_partial_hash", fail)
+        assert cleaner.find_duplicates(root, conn) == first
+        conn.close()
+
+    def test_prune_removed_files(self, tmp_path):
+        root = self._tree(tmp_path)
+        conn = cleaner.open_hash_cache(tmp_path / "cache.sqlite")
+        cleaner.find_duplicates(root, conn)
+        (root / "b" / "small.json").unlink()
+        cleaner.find_duplicates(root, conn)
+        paths = {r[0] for r in conn.execute("SELECT path FROM file_hashes")}
+        assert str(root / "b" / "small.json") not in paths
+        assert str(root / "a" / "small.json") in paths  # still on disk -> row kept
+        conn.close()
+
+
+class TestCleanerScan:
+    def test_single_pass_orphans(self, tmp_path):
+        root = tmp_path / "lib"
+        (root / "ch").mkdir(parents=True)
+        (root / ".hidden").mkdir()
+        for name in ("v [a].mp4", "v [a].info.json", "v [a].jpg", "gone [b].info.json", "gone [b].jpg"):
+            (root / "ch" / name).write_bytes(b"x")
+        (root / ".hidden" / "x.json").write_bytes(b"x")
+        tree = cleaner.scan_tree(root)
+        assert root / ".hidden" not in tree
+        assert sum(len(d.files) for d in tree.values()) == 5
+        orphans = cleaner.find_orphans(root, tree)
+        assert sorted(f.path.name for f in orphans) == ["gone [b].info.json", "gone [b].jpg"]
+        assert all(f.size == 1 for f in orphans)
+
+    def test_non_mp4_items_are_not_orphans(self, tmp_path):
+        root = tmp_path / "lib"
+        (root / "ch").mkdir(parents=True)
+        for name in ("w [a].webm", "w [a].info.json", "w [a].jpg", "m [b].m4a", "m [b].info.json",
+                     "gone [c].info.json"):
+            (root / "ch" / name).write_bytes(b"x")
+        conn = cleaner.open_hash_cache(tmp_path / "cache.sqlite")
+        past = 1_000_000_000
+        os.utime(root / "ch", (past, past))
+        tree = cleaner.scan_tree(root, conn)
+        assert [f.path.name for f in cleaner.find_orphans(root, tree)] == ["gone [c].info.json"]
+        # A snapshot saved by the old .mp4-only rule is recounted on reuse
+        conn.execute("UPDATE dir_snapshot SET orphans = ?", (json.dumps(["w [a].jpg"]),))
+        tree = cleaner.scan_tree(root, conn)
+        assert [f.path.name for f in cleaner.find_orphans(root, tree)] == ["gone [c].info.json"]
+        conn.close()
+
+    def test_incremental_snapshot(self, tmp_path, monkeypatch):
+        root = tmp_path / "lib"
+        (root / "old").mkdir(parents=True)
+        (root / "new").mkdir()
+        (root / "old" / "o [x].jpg").write_bytes(b"x")
+        (root / "new" / "n [y].jpg").write_bytes(b"y")
+        past = 1_000_000_000
+        for d in (root, root / "old", root / "new"):
+            os.utime(d, (past, past))
+        conn = cleaner.open_hash_cache(tmp_path / "cache.sqlite")
+        cleaner.scan_tree(root, conn)
+
+        (root / "new" / "n [y].mp4").write_bytes(b"v")
+        os.utime(root / "new", (past + 10, past + 10))
+        scanned = []
+        real_scan_dir = cleaner.scan_dir
+        monkeypatch.setattr(cleaner, "scan_dir", lambda d: scanned.append(d) or real_scan_dir(d))
+        tree = cleaner.scan_tree(root, conn)
+        assert scanned == [root / "new"]
+        orphans = cleaner.find_orphans(root, tree)
+        assert [f.path.name for f in orphans] == ["o [x].jpg"]
+        conn.close()
+
+    def test_orphans_from_downloader_catalog(self, tmp_path, monkeypatch):
+        root = tmp_path / "lib"
+        (root / "ch").mkdir(parents=True)
+        for name, data in (("v [a].mkv", "x"), ("v [a].info.json", '{"id": "a"}'),
+                           ("gone [b].info.json", '{"id": "b"}'), ("gone [b].jpg", "x"),
+                           ("late [c].info.json", '{"id": "c"}')):
+            (root / "ch" / name).write_text(data, encoding="utf-8")
+        index = tmp_path / "library_index.sqlite"
+        conn = en.open_catalog(str(index))
+        en.backfill_catalog(conn, str(root))
+        conn.commit()
+        conn.close()
+        (root / "ch" / "late [c].mp4").write_bytes(b"v")  # landed after the catalog was built
+
+        assert cleaner.DEFAULT_CONFIG["catalog_orphans"] is False  # opt-in
+        cfg = dict(cleaner.DEFAULT_CONFIG, hash_cache_file=str(index), catalog_orphans=True)
+        cache = cleaner.open_hash_cache(index)
+        monkeypatch.setattr(cleaner, "scan_tree", MagicMock(side_effect=AssertionError("walked")))
+        orphans = cleaner.collect_orphans(root, cfg, cache)
+        assert sorted(f.path.name for f in orphans) == ["gone [b].info.json", "gone [b].jpg"]
+        # Nothing of this root in the catalog: back to the tree walk
+        assert cleaner.catalog_orphans(cache, tmp_path / "other") is None
+        cache.close()
+
+    def test_pick_file_to_keep(self, tmp_path):
+        F = cleaner.FileInfo
+        a = F(Path("/x/a/long/name.jpg"), 1, 200, 1, 1)
+        b = F(Path("/x/b.jpg"), 1, 100, 1, 2)
+        assert cleaner.pick_file_to_keep([a, b], "shortest_path") == b
+        assert cleaner.pick_file_to_keep([a, b], "oldest") == b
+        assert cleaner.pick_file_to_keep([a, b], "newest") == a
+
+
+class TestCleanerBatch:
+    def _tree(self, tmp_path):
+        root = tmp_path / "lib"
+        (root / "a").mkdir(parents=True)
+        (root / "b").mkdir()
+        (root / "a" / "v [x].mp4").write_bytes(b"video")
+        (root / "a" / "v [x].jpg").write_bytes(b"thumb")
+        (root / "b" / "a much longer copy name.jpg").write_bytes(b"thumb")
+        (root / "b" / "gone [y].info.json").write_text("{}", encoding="utf-8")
+        return root
+
+    def test_scan_then_apply(self, tmp_path):
+        root = self._tree(tmp_path)
+        cfg = dict(cleaner.DEFAULT_CONFIG, hash_cache_file="")
+        plan_path = tmp_path / "plan.json"
+        plan = cleaner.batch_scan(root, cfg, "both", plan_path)
+        assert json.loads(plan_path.read_text(encoding="utf-8")) == plan
+
+        dry = cleaner.batch_apply(plan_path, dry_run=True)
+        assert dry["deleted"] == 2 and dry["errors"] == 0
+        assert (root / "b" / "a much longer copy name.jpg").exists()
+
+        result = cleaner.batch_apply(plan_path)
+        assert result["deleted"] == 2
+        assert (root / "a" / "v [x].jpg").exists()
+        assert (root / "a" / "v [x].mp4").exists()
+        assert not (root / "b" / "a much longer copy name.jpg").exists()
+        assert not (root / "b" / "gone [y].info.json").exists()
+
+    def test_apply_skips_changed_files(self, tmp_path):
+        root = self._tree(tmp_path)
+        cfg = dict(cleaner.DEFAULT_CONFIG, hash_cache_file="")
+        plan_path = tmp_path / "plan.json"
+        cleaner.batch_scan(root, cfg, "orphans", plan_path)
+        (root / "b" / "gone [y].info.json").write_text('{"changed": true}', encoding="utf-8")
+        result = cleaner.batch_apply(plan_path)
+        assert result == {"deleted": 1, "bytes": 5, "changed": 1, "blocked": 0, "errors": 0}
+        assert (root / "b" / "gone [y].info.json").exists()
+
+
+class TestCleanerLinkDedup:
+    def test_video_id_from_name(self):
+        assert cleaner.video_id_from_name("Title [dQw4w9WgXcQ].mp4") == "dQw4w9WgXcQ"
+        assert cleaner.video_id_from_name("Title [dQw4w9WgXcQ].info.json") is None
+        assert cleaner.video_id_from_name("no id.mp4") is None
+
+    def test_hardlink_replaces_identical_copies(self, tmp_path):
+        root = tmp_path / "lib"
+        for folder in ("Channel", "Watch later"):
+            (root / folder).mkdir(parents=True)
+            (root / folder / "Clip [abcdefghijk].mp4").write_bytes(b"same video")
+        # Same ID, different bytes (re-encode) -> must stay independent
+        (root / "Channel" / "Other [zzzzzzzzzzz].mp4").write_bytes(b"version one")
+        (root / "Watch later" / "Other [zzzzzzzzzzz].mp4").write_bytes(b"version two")
+        cfg = dict(cleaner.DEFAULT_CONFIG, link_mode="hardlink")
+        tree = cleaner.scan_tree(root)
+
+        result = cleaner.dedup_links(root, cfg, tree, None)
+        assert result == {"groups": 1, "linked": 1, "bytes": len(b"same video"), "failed": 0}
+        a = os.stat(root / "Channel" / "Clip [abcdefghijk].mp4")
+        b = os.stat(root / "Watch later" / "Clip [abcdefghijk].mp4")
+        assert (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+        assert (root / "Watch later" / "Other [zzzzzzzzzzz].mp4").read_bytes() == b"version two"
+
+        # Second pass: copies already share an inode -> nothing to do
+        again = cleaner.dedup_links(root, cfg, cleaner.scan_tree(root), None)
+        assert again["linked"] == 0
+
+
+# ═══════════════════════════════════════════════════════════════
+# Hash-on-write: library index shared with the cleaner
+# ═══════════════════════════════════════════════════════════════
+
+class TestLibraryFingerprint:
+    @pytest.mark.parametrize("mod", [en, ru])
+    @pytest.mark.parametrize("mode", ["partial", "full"])
+    def test_matches_cleaner(self, tmp_path, mod, mode):
+        data = os.urandom(mod.FINGERPRINT_BUFFER_SIZE + 12345)
+        fp = tmp_path / "v [abc].mp4"
+        fp.write_bytes(data)
+        key, partial, full = mod.fingerprint_file(str(fp), mode)
+        assert partial == cleaner.calc_partial_hash(fp, len(data))
+        assert full == (cleaner.calc_hash(fp) if mode == "full" else None)
+        assert key[2:] == (len(data), fp.stat().st_mtime_ns)
+
+    def test_small_file_full_equals_partial(self, tmp_path):
+        fp = tmp_path / "v.info.json"
+        fp.write_bytes(b"{}")
+        _, partial, full = en.fingerprint_file(str(fp), "partial")
+        assert partial == full == cleaner.calc_hash(fp)
+
+    def test_read_landed_complete_lines_only(self, tmp_path):
+        state = en.new_landed_manifest(str(tmp_path))
+        with open(state["path"], "a", encoding="utf-8") as f:
+            f.write("abc\t/lib/one [abc].mp4\nxyz\t/lib/tw")
+        assert en.read_landed(state, force=True) == [("abc", "/lib/one [abc].mp4")]
+        with open(state["path"], "a", encoding="utf-8") as f:
+            f.write("o [xyz].mp4\n")
+        assert en.read_landed(state, force=True) == [("xyz", "/lib/two [xyz].mp4")]
+        en.remove_landed_manifest(state)
+        assert not os.path.exists(state["path"])
+
+    def test_cleaner_reuses_rows(self, tmp_path, monkeypatch):
+        root = tmp_path / "lib"
+        (root / "a").mkdir(parents=True)
+        (root / "b").mkdir()
+        data = os.urandom(cleaner.PARTIAL_HASH_SIZE * 3)
+        for sub in ("a", "b"):
+            (root / sub / "v [id1].mp4").write_bytes(data)
+
+        index = tmp_path / "library_index.sqlite"
+        conn = en.open_library_index(str(index))
+        for sub in ("a", "b"):
+            path = str(root / sub / "v [id1].mp4")
+            key, partial, full = en.fingerprint_file(path, "full")
+            en.store_fingerprint(conn, key, path, "sha256", partial, full)
+        conn.commit()
+        conn.close()
+
+        def fail(*a, **kw):
+            raise AssertionError("file was re-read")
+
+        monkeypatch.setattr(cleaner, "calc_hash", fail)
+        monkeypatch.setattr(cleaner, "calc_partial_hash", fail)
+        cache = cleaner.open_hash_cache(index)
+        dupes = cleaner.find_duplicates(root, cache)
+        cache.close()
+        assert [len(files) for files in dupes.values()] == [2]
+
+
+class TestLibraryCatalog:
+    def _item(self, folder, video_id, media=True, nfo=False, title="T"):
+        folder.mkdir(parents=True, exist_ok=True)
+        stem = folder / f"{title} [{video_id}]"
+        info = {"id": video_id, "title": title, "uploader": "Ch", "duration": 61.5, "upload_date": "20240102"}
+        Path(f"{stem}.info.json").write_text(json.dumps(info), encoding="utf-8")
+        if media:
+            Path(f"{stem}.mp4").write_bytes(b"v" * 100)
+            Path(f"{stem}.jpg").write_bytes(b"j")
+        if nfo:
+            Path(f"{stem}.nfo").write_text("<movie/>", encoding="utf-8")
+        return f"{stem}.info.json"
+
+    def test_backfill_and_queries(self, tmp_path):
+        dl = tmp_path / "downloads"
+        self._item(dl / "PL one", "aaa", nfo=True)
+        self._item(dl / "PL two", "aaa")
+        orphan = self._item(dl / "PL two", "bbb", media=False)
+        (dl / "PL two" / "PL two [PLx].info.json").write_text('{"_type": "playlist", "id": "PLx"}', encoding="utf-8")
+
+        conn = en.open_catalog(str(tmp_path / "index.sqlite"))
+        counters = en.backfill_catalog(conn, str(dl), workers=4)
+        assert (counters["items"], counters["parsed"], counters["errors"]) == (3, 3, 0)
+        assert en.catalog_orphans(conn) == [orphan]
+        assert en.catalog_pending_nfo(conn) == [str(dl / "PL two" / "T [aaa].info.json")]
+
+        stats = en.catalog_stats(conn)
+        assert (stats["items"], stats["size"], stats["duration"]) == (2, 200, 122)
+        assert stats["folders"] == [("PL one", 1, 100), ("PL two", 1, 100)]
+        assert (stats["orphans"], stats["no_nfo"], stats["no_thumb"], stats["multi_folder"]) == (1, 1, 0, 1)
+
+        # Second run parses nothing, but notices new and removed sibling files
+        Path(orphan.replace(".info.json", ".mp4")).write_bytes(b"v")
+        (dl / "PL one" / "T [aaa].mp4").unlink()
+        (dl / "PL one" / "T [aaa].nfo").unlink()
+        (dl / "PL one" / "T [aaa].jpg").unlink()
+        os.remove(dl / "PL one" / "T [aaa].info.json")
+        counters = en.backfill_catalog(conn, str(dl))
+        assert (counters["items"], counters["parsed"], counters["removed"]) == (2, 0, 1)
+        assert en.catalog_orphans(conn) == []
+        conn.close()
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_landed_item_gets_nfo(self, tmp_path, mod):
+        dl = tmp_path / "downloads"
+        info_json = self._item(dl, "ccc")
+        conn = mod.open_catalog(str(tmp_path / "index.sqlite"))
+        mod.catalog_landed(conn, info_json.replace(".info.json", ".mp4"), str(dl), generate_nfo=True)
+        row = conn.execute("SELECT video_id, folder, has_nfo, has_thumb FROM catalog").fetchone()
+        assert row == ("ccc", "", 1, 1)
+        assert os.path.exists(info_json.replace(".info.json", ".nfo"))
+        conn.close()
+
+    def test_playlist_completeness_from_catalog(self, tmp_path, monkeypatch):
+        url = "https://www.youtube.com/playlist?list=PL1"
+        dl = tmp_path / "downloads"
+        self._item(dl / "PL", "aaa")
+        self._item(dl / "PL", "bbb", media=False)
+        archive = tmp_path / "archive.txt"
+        archive.write_text("youtube ccc\n", encoding="utf-8")
+        cfg = json.loads(json.dumps(en.load_config()))
+        cfg["downloads"]["library_index"] = str(tmp_path / "index.sqlite")
+        conn = en.open_catalog(cfg["downloads"]["library_index"])
+        en.backfill_catalog(conn, str(dl))
+        conn.commit()
+        conn.close()
+
+        en.record_playlist_listing(cfg, str(tmp_path), url, ["aaa", "bbb", "ccc", "ddd"])
+        # No new listing: aaa has media, ccc is in the archive, bbb and ddd are missing
+        monkeypatch.setattr(en, "get_playlist_info", MagicMock(side_effect=AssertionError("listed")))
+        assert en.playlist_completeness(url, str(archive), cfg, str(tmp_path)) == (4, 2, 2)
+
+        conn = en.open_catalog(cfg["downloads"]["library_index"])
+        assert en.catalog_playlist_missing(conn, url) == (4, ["bbb", "ccc", "ddd"])
+        assert en.catalog_stats(conn)["incomplete_playlists"] == 1
+        en.store_playlist_listing(conn, url, ["aaa"])
+        assert en.catalog_playlist_missing(conn, url) == (1, [])
+        conn.close()
+
+        # A playlist never listed falls back to a listing
+        monkeypatch.setattr(en, "get_playlist_info", lambda *a: (3, 0, 3))
+        assert en.playlist_completeness(url + "2", str(archive), cfg, str(tmp_path)) == (3, 0, 3)
+
+
+@pytest.mark.skipif(not en.FTS5_AVAILABLE, reason="SQLite without FTS5")
+class TestLibrarySearch:
+    def _write(self, folder, video_id, **info):
+        folder.mkdir(parents=True, exist_ok=True)
+        stem = folder / f"{info['title']} [{video_id}]"
+        Path(f"{stem}.info.json").write_text(json.dumps({"id": video_id, **info}), encoding="utf-8")
+        Path(f"{stem}.mp4").write_bytes(b"v")
+        return f"{stem}.mp4"
+
+    def test_ranked_and_incremental(self, tmp_path):
+        dl = tmp_path / "downloads"
+        in_title = self._write(dl / "PL", "a1", title="Sourdough bread basics", description="flour")
+        in_desc = self._write(dl / "PL", "a2", title="Kitchen vlog", description="we bake sourdough today")
+        self._write(dl / "PL", "a3", title="Bike repair", description="", tags=["chain", "gears"])
+        conn = en.open_catalog(str(tmp_path / "index.sqlite"))
+        en.backfill_catalog(conn, str(dl))
+
+        assert [r[0] for r in en.search_catalog(conn, "sourdough")] == [in_title, in_desc]
+        assert [r[0] for r in en.search_catalog(conn, "gear")] == [str(dl / "PL" / "Bike repair [a3].mp4")]
+        assert en.search_catalog(conn, 'bread "unbalanced') == []
+
+        # An item landing later is searchable right away; a re-parse replaces its terms
+        landed = self._write(dl / "PL", "b1", title="Rye bread", description="")
+        en.catalog_landed(conn, landed, str(dl))
+        assert en.search_catalog(conn, "rye")[0][0] == landed
+        en.catalog_landed(conn, landed, str(dl))
+        assert len(en.search_catalog(conn, "rye")) == 1
+
+        os.remove(landed.replace(".mp4", ".info.json"))
+        en.backfill_catalog(conn, str(dl))
+        assert en.search_catalog(conn, "rye") == []
+        conn.close()
+
+    def test_rows_from_older_catalog_get_indexed(self, tmp_path):
+        dl = tmp_path / "downloads"
+        path = self._write(dl, "c1", title="Old entry", description="")
+        conn = ru.open_catalog(str(tmp_path / "index.sqlite"))
+        ru.backfill_catalog(conn, str(dl))
+        conn.execute("DELETE FROM catalog_fts")
+        ru.backfill_catalog(conn, str(dl))
+        assert [r[0] for r in ru.search_catalog(conn, "old")] == [path]
+        conn.close()
+
+
+# ═══════════════════════════════════════════════════════════════
+# Download archive tools
+# ═══════════════════════════════════════════════════════════════
+
+class TestArchiveRebuild:
+    def _tree(self, tmp_path):
+        dl = tmp_path / "downloads"
+        (dl / "PL a").mkdir(parents=True)
+        (dl / "PL b" / "nested").mkdir(parents=True)
+        (dl / "PL a" / "One [AAAAAAAAAAA].mp4").write_bytes(b"v")
+        (dl / "PL a" / "One [AAAAAAAAAAA].info.json").write_text("{}", encoding="utf-8")
+        (dl / "PL b" / "One [AAAAAAAAAAA].mp4").write_bytes(b"v")
+        (dl / "PL b" / "nested" / "Two [BBBBBBBBBBB].mkv").write_bytes(b"v")
+        # Renamed by hand: the id comes from .info.json
+        (dl / "PL b" / "renamed.mp4").write_bytes(b"v")
+        (dl / "PL b" / "renamed.info.json").write_text(
+            json.dumps({"id": "CCCCCCCCCCC", "extractor_key": "Youtube"}), encoding="utf-8")
+        # Metadata without media is not "downloaded"
+        (dl / "PL b" / "Gone [DDDDDDDDDDD].info.json").write_text("{}", encoding="utf-8")
+        return dl
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_scan_ids(self, tmp_path, mod):
+        dl = self._tree(tmp_path)
+        assert mod.scan_library_ids(str(dl), workers=3) == {
+            ("youtube", "AAAAAAAAAAA"), ("youtube", "BBBBBBBBBBB"), ("youtube", "CCCCCCCCCCC")}
+
+    def test_merge_and_replace(self, tmp_path):
+        dl = self._tree(tmp_path)
+        archive = tmp_path / "download_archive.txt"
+        archive.write_text("youtube ZZZZZZZZZZZ\nyoutube AAAAAAAAAAA\nyoutube ZZZZZZZZZZZ\n\n", encoding="utf-8")
+
+        report = en.rebuild_archive(str(archive), str(dl))
+        assert (report["on_disk"], report["added"], report["written"]) == (3, 2, 4)
+        assert report["missing"] == [("youtube", "ZZZZZZZZZZZ")]
+        assert archive.read_text(encoding="utf-8").splitlines() == [
+            "youtube ZZZZZZZZZZZ", "youtube AAAAAAAAAAA", "youtube BBBBBBBBBBB", "youtube CCCCCCCCCCC"]
+
+        report = en.rebuild_archive(str(archive), str(dl), mode="replace")
+        assert report["written"] == 3
+        assert "ZZZZZZZZZZZ" not in archive.read_text(encoding="utf-8")
+        assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".archive_")] == []
+
+
+class TestArchiveMergeCompact:
+    def test_merge_bounded_runs(self, tmp_path):
+        a = tmp_path / "a.txt"
+        b = tmp_path / "b.txt"
+        a.write_text("youtube c\nyoutube a\nyoutube c\nvimeo z\n", encoding="utf-8")
+        b.write_text("youtube b\n\nyoutube a\nbroken\nyoutube d\n", encoding="utf-8")
+        out = tmp_path / "out.txt"
+        # run_size=2 forces several spilled runs
+        assert en.merge_archives([str(a), str(b)], str(out), run_size=2) == 5
+        assert out.read_text(encoding="utf-8").splitlines() == [
+            "vimeo z", "youtube a", "youtube b", "youtube c", "youtube d"]
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_compact_in_place_with_extra(self, tmp_path, mod):
+        live = tmp_path / "download_archive.txt"
+        live.write_text("youtube b\nyoutube a\nyoutube b\n", encoding="utf-8")
+        other = tmp_path / "host2.txt"
+        other.write_text("youtube c\nyoutube a\n", encoding="utf-8")
+        stats = mod.compact_archive(str(live), [str(other)], run_size=2, settle=0)
+        assert stats == {"written": 3, "caught_up": 0}
+        assert live.read_text(encoding="utf-8") == "youtube a\nyoutube b\nyoutube c\n"
+
+    def test_compact_keeps_concurrent_appends(self, tmp_path, monkeypatch):
+        live = tmp_path / "download_archive.txt"
+        live.write_text("youtube b\nyoutube a\nyoutube par", encoding="utf-8")
+        real = en._write_archive_temp
+
+        def append_during_sort(archive_file, entries):
+            result = real(archive_file, entries)
+            with open(archive_file, "a", encoding="utf-8") as f:
+                f.write("tial\nyoutube z\n")  # the writer finishes its line and adds another
+            return result
+
+        monkeypatch.setattr(en, "_write_archive_temp", append_during_sort)
+        stats = en.compact_archive(str(live), settle=0)
+        assert stats == {"written": 2, "caught_up": 2}
+        assert live.read_text(encoding="utf-8") == "youtube a\nyoutube b\nyoutube partial\nyoutube z\n"
+
+
+class TestArchiveIndex:
+    def _archive(self, tmp_path, n):
+        archive = tmp_path / "download_archive.txt"
+        archive.write_text("".join(f"youtube id{i:09d}\n" for i in range(n)), encoding="utf-8")
+        return archive
+
+    def test_build_and_lookup(self, tmp_path):
+        archive = self._archive(tmp_path, 500)
+        index = en.open_archive_index(str(archive))
+        try:
+            assert index["count"] == 500 and not index["delta"]
+            assert all(en.archive_index_contains(index, "youtube", f"id{i:09d}") for i in range(500))
+            assert not any(en.archive_index_contains(index, "youtube", f"no{i:09d}") for i in range(500))
+            assert not en.archive_index_contains(index, "vimeo", "id000000001")
+        finally:
+            en.close_archive_index(index)
+
+    def test_appends_are_incremental_and_merged(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(en, "ARCHIVE_INDEX_DELTA_LIMIT", 3)
+        archive = self._archive(tmp_path, 10)
+        index = en.open_archive_index(str(archive))
+        with open(archive, "a", encoding="utf-8") as f:
+            f.write("youtube new1\nyoutube id000000001\nyoutube new")
+        en.refresh_archive_index(index)
+        # Partial last line is not read yet; the duplicate is not added
+        assert index["delta"] == {en.archive_digest("youtube", "new1")}
+        assert not en.archive_index_contains(index, "youtube", "new")
+
+        # A second process sees the same file plus the tail
+        other = en.open_archive_index(str(archive))
+        assert other["count"] == 10 and en.archive_index_contains(other, "youtube", "new1")
+        en.close_archive_index(other)
+
+        with open(archive, "a", encoding="utf-8") as f:
+            f.write("2\nyoutube new3\n")
+        en.refresh_archive_index(index)
+        # Delta reached the limit: merged into the file
+        assert index["count"] == 13 and not index["delta"]
+        assert all(en.archive_index_contains(index, "youtube", v) for v in ("new1", "new2", "new3", "id000000009"))
+        en.close_archive_index(index)
+
+    def test_rewritten_archive_is_rebuilt(self, tmp_path):
+        archive = self._archive(tmp_path, 20)
+        index = en.open_archive_index(str(archive))
+        en.close_archive_index(index)
+        en.write_archive(str(archive), [("youtube", "only")])
+        index = ru.open_archive_index(str(archive))
+        assert index["count"] == 1
+        assert ru.archive_index_contains(index, "youtube", "only")
+        assert not ru.archive_index_contains(index, "youtube", "id000000001")
+        ru.close_archive_index(index)
+
+
+# ═══════════════════════════════════════════════════════════════
+# Cached browser cookie export
+# ═══════════════════════════════════════════════════════════════
+
+class TestCookieCache:
+    def _setup(self, tmp_path, monkeypatch, mod):
+        profile = tmp_path / "profiles"
+        (profile / "abc.default").mkdir(parents=True)
+        db = profile / "abc.default" / "cookies.sqlite"
+        db.write_bytes(b"db")
+        exports = []
+
+        def fake_export(browser, dest, logger=None):
+            exports.append(browser)
+            Path(dest).write_text("# Netscape HTTP Cookie File\n", encoding="utf-8")
+            return True
+
+        monkeypatch.setattr(mod, "export_browser_cookies", fake_export)
+        monkeypatch.setattr(mod, "COOKIE_CACHE_MIN_INTERVAL", 0)
+        monkeypatch.setattr(mod, "_COOKIE_CACHE", None)
+        cfg = {"cookies": {"mode": "browser", "browser": f"firefox:{profile}",
+                           "cookies_file": "cookies.txt", "cache_file": ".cookies_cache.txt"}}
+        return cfg, db, exports
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_export_once_and_reuse(self, tmp_path, monkeypatch, mod):
+        cfg, db, exports = self._setup(tmp_path, monkeypatch, mod)
+        assert mod._browser_cookie_dbs(cfg["cookies"]["browser"]) == [str(db)]
+        mod.prepare_cookie_cache(cfg, str(tmp_path))
+        cache = str(tmp_path / ".cookies_cache.txt")
+        assert mod._build_cookie_args(cfg, str(tmp_path)) == ["--cookies", cache]
+        assert mod._build_cookie_args(cfg, str(tmp_path)) == ["--cookies", cache]
+        assert len(exports) == 1
+
+        # Browser database changed -> one more export
+        os.utime(db, ns=(db.stat().st_atime_ns, db.stat().st_mtime_ns + 10**9))
+        mod._build_cookie_args(cfg, str(tmp_path))
+        mod._build_cookie_args(cfg, str(tmp_path))
+        assert len(exports) == 2
+
+        # 403 forces a refresh
+        mod.refresh_cookie_cache(cfg, str(tmp_path), force=True)
+        assert len(exports) == 3
+
+    def test_failed_export_falls_back(self, tmp_path, monkeypatch):
+        cfg, _, _ = self._setup(tmp_path, monkeypatch, en)
+        monkeypatch.setattr(en, "export_browser_cookies", lambda *a, **kw: False)
+        en.prepare_cookie_cache(cfg, str(tmp_path))
+        assert en._build_cookie_args(cfg, str(tmp_path)) == ["--cookies-from-browser", cfg["cookies"]["browser"]]
+
+    def test_cookie_errors(self):
+        assert en.is_cookie_error("error: http error 403: forbidden")
+        assert en.is_cookie_error("sign in to confirm you're not a bot")
+        assert not en.is_cookie_error("http error 404: not found")
+
+
+class TestComponentCache:
+    def _warm(self, tmp_path, monkeypatch, mod):
+        cache_dir = tmp_path / ".yt-dlp-cache"
+        calls = []
+
+        def fake_run(cmd, **kwargs):
+            calls.append(cmd)
+            (cache_dir / "youtube-nsig").mkdir(parents=True, exist_ok=True)
+            (cache_dir / "youtube-nsig" / "player.json").write_text("{}", encoding="utf-8")
+            return MagicMock(returncode=0, stdout="", stderr="")
+
+        monkeypatch.setattr(mod.subprocess, "run", fake_run)
+        monkeypatch.setattr(mod, "_ytdlp_version", lambda: "2025.10.22")
+        cfg = {"cache": {"dir": ".yt-dlp-cache", "warm_interval_hours": 24, "probe_url": "https://example.invalid/v"}}
+        return cfg, cache_dir, calls
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_warm_once_then_verified(self, tmp_path, monkeypatch, mod):
+        cfg, cache_dir, calls = self._warm(tmp_path, monkeypatch, mod)
+        assert mod._build_cache_args(cfg, str(tmp_path)) == ["--cache-dir", str(cache_dir)]
+        mod.prepare_component_cache(cfg, str(tmp_path))
+        mod.prepare_component_cache(cfg, str(tmp_path))
+        assert len(calls) == 1
+        assert calls[0][:3] == ["yt-dlp", "--cache-dir", str(cache_dir)]
+        assert "ejs:github" in calls[0]
+
+    def test_damaged_file_and_new_version_trigger_rewarm(self, tmp_path, monkeypatch):
+        cfg, cache_dir, calls = self._warm(tmp_path, monkeypatch, en)
+        en.prepare_component_cache(cfg, str(tmp_path))
+        (cache_dir / "youtube-nsig" / "player.json").write_text("{broken", encoding="utf-8")
+        ok, _ = en.verify_component_cache(str(cache_dir), "2025.10.22", 3600)
+        assert not ok and not (cache_dir / "youtube-nsig" / "player.json").exists()
+        en.prepare_component_cache(cfg, str(tmp_path))
+        assert len(calls) == 2
+        assert en.verify_component_cache(str(cache_dir), "2025.10.22", 3600) == (True, "ok")
+        assert not en.verify_component_cache(str(cache_dir), "2025.11.01", 3600)[0]
+        assert not en.verify_component_cache(str(cache_dir), "2025.10.22", -1)[0]
+
+
+class TestBatchDownload:
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_video_id_and_batch_planning(self, mod):
+        assert mod.video_id_from_url("https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=5") == "dQw4w9WgXcQ"
+        assert mod.video_id_from_url("https://youtu.be/dQw4w9WgXcQ") == "dQw4w9WgXcQ"
+        assert mod.video_id_from_url("https://www.youtube.com/shorts/abcdefghijk") == "abcdefghijk"
+        assert mod.video_id_from_url("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL1") is None
+        links = [
+            "https://youtu.be/aaaaaaaaaaa", "https://youtu.be/bbbbbbbbbbb",
+            "https://www.youtube.com/playlist?list=PL1",
+            "https://youtu.be/ccccccccccc", "https://youtu.be/ccccccccccc",
+            "https://youtu.be/ddddddddddd", "https://youtu.be/eeeeeeeeeee",
+        ]
+        assert mod.plan_url_batches(links, 2) == [
+            links[0:2], [links[2]], [links[3]], links[4:6], [links[6]],
+        ]
+        assert mod.plan_url_batches(links, 1) == [[u] for u in links]
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_outcomes_attributed_per_url(self, tmp_path, monkeypatch, mod):
+        urls = [f"https://youtu.be/{c * 11}" for c in "abcd"]
+        output = [
+            "[youtube] aaaaaaaaaaa: Downloading webpage",
+            "[download] 100% of 1.00MiB",
+            "[youtube] bbbbbbbbbbb: Downloading webpage",
+            "ERROR: [youtube] bbbbbbbbbbb: Private video. Sign in if you've been granted access",
+            "[download] ccccccccccc: has already been recorded in the archive",
+            "[youtube] ddddddddddd: Downloading webpage",
+            "ERROR: unable to download video data: HTTP Error 500: Internal Server Error",
+        ]
+        retried = []
+
+        def fake_popen(cmd, **kwargs):
+            manifest = cmd[cmd.index(mod.LANDED_TEMPLATE) + 1].replace("%%", "%")
+            Path(manifest).write_text("aaaaaaaaaaa\t/lib/a [aaaaaaaaaaa].mp4\n", encoding="utf-8")
+            batch_file = cmd[cmd.index("--batch-file") + 1]
+            assert Path(batch_file).read_text(encoding="utf-8").split() == urls
+            proc = MagicMock()
+            proc.stdout.readline.side_effect = [line + "\n" for line in output] + [""]
+            proc.poll.return_value = 0
+            proc.wait.return_value = 1
+            return proc
+
+        def fake_single(url, *args):
+            retried.append(url)
+            return (0, 0, 1, url, 0, False)
+
+        monkeypatch.setattr(mod.subprocess, "Popen", fake_popen)
+        monkeypatch.setattr(mod, "download_single_url", fake_single)
+        cfg = json.loads(json.dumps(mod.load_config()))  # load_config() caches its dict
+        cfg["downloads"]["generate_nfo"] = False
+        cfg["cookies"]["mode"] = "off"
+        cfg["cache"]["dir"] = ""
+        monkeypatch.setattr(mod, "load_config", lambda: cfg)
+        result = mod.download_video_batch(urls, 1, 4, str(tmp_path), str(tmp_path), str(tmp_path / "a.txt"), MagicMock())
+        assert result == (1, 2, 1, [urls[3]], 0, False)
+        assert retried == [urls[3]]
+        assert not list(tmp_path.glob(".batch_*")) and not list(tmp_path.glob(".landed_*"))
+
+
+class TestDownloadEngine:
+    def _fake_yt_dlp(self):
+        created = []
+
+        class FakeYDL:
+            def __init__(self, opts):
+                self.opts = opts
+                created.append(self)
+
+            def download(self, urls):
+                for url in urls:
+                    video_id = url.rsplit("/", 1)[-1]
+                    if video_id == "private0000":
+                        self.opts["logger"].error(f"ERROR: [youtube] {video_id}: Private video")
+                        continue
+                    info = {"id": video_id, "filepath": f"/lib/{video_id}.mp4"}
+                    for hook in self.opts["progress_hooks"]:
+                        hook({"status": "finished", "downloaded_bytes": 10, "total_bytes": 10, "info_dict": info})
+                    for hook in self.opts["postprocessor_hooks"]:
+                        hook({"postprocessor": "MoveFiles", "status": "finished", "info_dict": info})
+                return 0
+
+            def close(self):
+                self.closed = True
+
+        fake = MagicMock()
+        fake.parse_options.side_effect = lambda argv: MagicMock(ydl_opts={"argv": list(argv)})
+        fake.YoutubeDL = FakeYDL
+        return fake, created
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_jobs_report_typed_events_and_reuse_instance(self, tmp_path, monkeypatch, mod):
+        import queue
+        import threading
+        fake, created = self._fake_yt_dlp()
+        monkeypatch.setattr(mod, "yt_dlp", fake, raising=False)
+        monkeypatch.chdir(tmp_path)
+        engine = {"tasks": queue.Queue(), "events": queue.Queue(), "workers": {}, "next_job": 0}
+        monkeypatch.setattr(mod, "_ENGINE", engine)
+        monkeypatch.setattr(mod, "_LANDED", None)
+        worker = threading.Thread(target=mod._engine_worker, args=(str(tmp_path), engine["tasks"], engine["events"]))
+        worker.start()
+        engine["workers"][os.getpid()] = worker
+        cmd = ["yt-dlp", "--newline", "https://youtu.be/"]
+        try:
+            ok = mod._run_engine_attempt(cmd[:-1] + ["https://youtu.be/aaaaaaaaaaa"], str(tmp_path), 60, 0, MagicMock())
+            bad = mod._run_engine_attempt(cmd[:-1] + ["https://youtu.be/private0000"], str(tmp_path), 60, 0, MagicMock())
+        finally:
+            engine["tasks"].put(None)
+            worker.join(timeout=5)
+        assert ok == (0, [], 1, 0, 0)
+        assert bad[0] == 1 and bad[2] == 0
+        assert bad[1] == ["ERROR: [youtube] private0000: Private video"]
+        assert len(created) == 1 and created[0].opts["argv"] == ["--newline"]
+
+    def test_worker_keeps_one_instance_per_option_change(self, tmp_path, monkeypatch):
+        import queue
+        fake, created = self._fake_yt_dlp()
+        monkeypatch.setattr(en, "yt_dlp", fake, raising=False)
+        monkeypatch.chdir(tmp_path)
+        tasks, events = queue.Queue(), queue.Queue()
+        for job, argv in enumerate((["--playlist-items", "1:20"], ["--playlist-items", "21:40"],
+                                    ["--playlist-items", "21:40"]), 1):
+            tasks.put((job, argv, ["https://youtu.be/aaaaaaaaaaa"]))
+        tasks.put(None)
+        en._engine_worker(str(tmp_path), tasks, events)
+        assert [y.opts["argv"][1] for y in created] == ["1:20", "21:40"]
+        # The first slice's instance is closed as soon as the options change
+        assert getattr(created[0], "closed", False) and getattr(created[1], "closed", False)
+
+    def test_job_timed_out_before_start_is_skipped(self, tmp_path, monkeypatch):
+        import queue
+        import threading
+        from types import SimpleNamespace
+        fake, created = self._fake_yt_dlp()
+        monkeypatch.setattr(en, "yt_dlp", fake, raising=False)
+        monkeypatch.chdir(tmp_path)
+        engine = {"tasks": queue.Queue(), "events": queue.Queue(), "workers": {}, "next_job": 0,
+                  "cancelled": SimpleNamespace(value=0)}
+        monkeypatch.setattr(en, "_ENGINE", engine)
+        monkeypatch.setattr(en, "_LANDED", None)
+        cmd = ["yt-dlp", "--newline"]
+        # No worker picked the job up before the timeout
+        late = en._run_engine_attempt(["yt-dlp", "--late", "https://youtu.be/bbbbbbbbbbb"], str(tmp_path), -1, 0, MagicMock())
+        assert late[0] == -1 and engine["cancelled"].value == 1
+        worker = threading.Thread(target=en._engine_worker,
+                                  args=(str(tmp_path), engine["tasks"], engine["events"], None, engine["cancelled"]))
+        worker.start()
+        engine["workers"][os.getpid()] = worker
+        try:
+            ok = en._run_engine_attempt(cmd + ["https://youtu.be/aaaaaaaaaaa"], str(tmp_path), 60, 0, MagicMock())
+        finally:
+            engine["tasks"].put(None)
+            worker.join(timeout=5)
+        assert ok == (0, [], 1, 0, 0)
+        assert engine["events"].empty()
+        assert [y.opts["argv"] for y in created] == [["--newline"]]
+
+    def test_falls_back_to_cli_without_module(self, monkeypatch):
+        monkeypatch.setattr(en, "YTDLP_API_AVAILABLE", False)
+        monkeypatch.setattr(en, "_ENGINE", None)
+        en.start_download_engine({"downloads": {"engine": "api"}}, ".", MagicMock())
+        assert en._ENGINE is None
+
+
+class TestDeferredPostprocess:
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_embed_cmd_single_pass(self, mod):
+        info = {"title": "T", "upload_date": "20240101", "uploader": "U",
+                "webpage_url": "https://youtu.be/x", "vcodec": "avc1"}
+        cmd = mod.build_embed_cmd("ffmpeg", "a.mp4", "a.jpg", info, "a.temp.mp4")
+        assert cmd[cmd.index("-map", cmd.index("-dn")):cmd.index("-c")] == ["-map", "1", "-disposition:v:1", "attached_pic"]
+        assert "title=T" in cmd and "artist=U" in cmd and "date=20240101" in cmd
+        assert cmd[-1] == "a.temp.mp4"
+        audio = mod.build_embed_cmd("ffmpeg", "a.m4a", "a.jpg", {"vcodec": "none"}, "t.m4a")
+        assert "-disposition:v:0" in audio
+        assert "-disposition:v:1" not in mod.build_embed_cmd("ffmpeg", "a.mp4", None, info, "t.mp4")
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_postprocess_file_replaces_and_hands_to_library(self, tmp_path, monkeypatch, mod):
+        import queue
+        media = tmp_path / "Clip [abcdefghijk].mp4"
+        media.write_bytes(b"raw")
+        (tmp_path / "Clip [abcdefghijk].webp").write_bytes(b"webp")
+        (tmp_path / "Clip [abcdefghijk].info.json").write_text(json.dumps({"title": "Clip"}), encoding="utf-8")
+        os.utime(media, ns=(1_000_000_000, 1_000_000_000))
+        calls = []
+
+        def fake_run(cmd, **kwargs):
+            calls.append(cmd)
+            Path(cmd[-1]).write_bytes(b"embedded" if cmd[-1].endswith(".mp4") else b"jpg")
+            return MagicMock(returncode=0, stderr="")
+
+        library = queue.Queue()
+        monkeypatch.setattr(mod.subprocess, "run", fake_run)
+        monkeypatch.setattr(mod, "_LIBRARY_QUEUE", library)
+        mod.postprocess_file("ffmpeg", "abcdefghijk", str(media), MagicMock())
+        assert len(calls) == 2
+        assert media.read_bytes() == b"embedded" and media.stat().st_mtime_ns == 1_000_000_000
+        assert (tmp_path / "Clip [abcdefghijk].jpg").exists()
+        assert not (tmp_path / "Clip [abcdefghijk].webp").exists()
+        assert not list(tmp_path.glob("*.temp.mp4"))
+        assert library.get_nowait() == ("abcdefghijk", str(media))
+
+    def test_pool_strips_embeds_from_download_cmd(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(en.shutil, "which", lambda name: "/usr/bin/ffmpeg")
+        monkeypatch.setattr(en, "_POSTPROC", None)
+        monkeypatch.setattr(en, "_LANDED", None)
+        cfg = json.loads(json.dumps(en.load_config()))
+        cfg["postprocess"]["deferred"] = True
+        cfg["cookies"]["mode"] = "off"
+        cfg["cache"]["dir"] = ""
+        en.start_postprocess_pool(cfg, str(tmp_path), MagicMock())
+        try:
+            cmd = en._build_download_cmd(cfg, str(tmp_path), "%(id)s.%(ext)s", "a.txt", ["URL"])
+            assert "--embed-thumbnail" not in cmd and "--convert-thumbnails" not in cmd
+            assert "--write-thumbnail" in cmd and en.LANDED_TEMPLATE in cmd
+        finally:
+            en.stop_postprocess_pool()
+        assert en._POSTPROC is None and en._LANDED is None
+        assert not list(tmp_path.glob(".landed_*"))
+
+    def test_landed_files_handed_off_outside_manifest_lock(self, tmp_path, monkeypatch):
+        manifest = en.new_landed_manifest(str(tmp_path))
+        Path(manifest["path"]).write_text("aaaaaaaaaaa\t/a.mp4\nbbbbbbbbbbb\t/b.mp4\n", encoding="utf-8")
+        seen = []
+
+        def fake_landed(video_id, filepath, logger):
+            # A blocked post-processing slot must not keep other slices off the manifest
+            assert not en._LANDED_LOCK.locked()
+            seen.append(video_id)
+
+        monkeypatch.setattr(en, "_LANDED", manifest)
+        monkeypatch.setattr(en, "on_file_landed", fake_landed)
+        en.collect_landed(force=True)
+        assert seen == ["aaaaaaaaaaa", "bbbbbbbbbbb"]
+        en.collect_landed(force=True)
+        assert len(seen) == 2
+
+
+class TestContainerPlanner:
+    VP9_OPUS = {"ext": "webm", "requested_formats": [
+        {"vcodec": "vp09.00.50.08", "acodec": "none"}, {"vcodec": "none", "acodec": "opus"}]}
+    AVC_AAC = {"ext": "mp4", "requested_formats": [
+        {"vcodec": "avc1.640028", "acodec": "none"}, {"vcodec": "none", "acodec": "mp4a.40.2"}]}
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_plan_container(self, mod):
+        assert mod.plan_container(self.VP9_OPUS, "mp4") == ("mp4", False)
+        assert mod.plan_container(self.VP9_OPUS, "compatible") == ("webm", False)
+        assert mod.plan_container(self.AVC_AAC, "compatible") == ("mp4", False)
+        mixed = {"requested_formats": [{"vcodec": "vp9", "acodec": "none"}, {"vcodec": "none", "acodec": "mp4a.40.2"}]}
+        assert mod.plan_container(mixed, "compatible") == ("mkv", False)
+        single = {"ext": "webm", "vcodec": "vp9", "acodec": "opus"}
+        assert mod.plan_container(single, "mp4") == ("mp4", True)
+        assert mod.plan_container(single, "compatible") == ("webm", False)
+        assert mod.plan_container({"ext": "flv"}, "compatible") == ("mp4", True)
+
+    def test_args_and_savings(self, tmp_path):
+        cfg = {"downloads": {"container": "compatible"}}
+        assert en.container_args(cfg) == ["--merge-output-format", "mp4/webm/mkv", "--remux-video", en.COMPATIBLE_REMUX_RULES]
+        assert en.container_args({"downloads": {}})[1] == "mp4"
+        media = tmp_path / "a [abcdefghijk].webm"
+        media.write_bytes(b"x" * 1000)
+        (tmp_path / "a [abcdefghijk].info.json").write_text(json.dumps({"ext": "webm"}), encoding="utf-8")
+        en.reset_container_stats()
+        en.account_container_plan(str(media), "mp4")
+        assert en.container_savings_summary() is None
+        en.account_container_plan(str(media), "compatible")
+        assert en._PLANNER_STATS["kept"] == 1 and en._PLANNER_STATS["bytes"] == 1000
+        assert "1 files" in en.container_savings_summary()
+        en.reset_container_stats()
+
+    def test_embed_cmd_per_container(self):
+        mkv = en.build_embed_cmd("ffmpeg", "a.mkv", "a.jpg", {}, "a.temp.mkv")
+        assert mkv.count("-i") == 1 and "-attach" in mkv and "attached_pic" not in mkv
+        webm = en.build_embed_cmd("ffmpeg", "a.webm", "a.jpg", {"title": "T"}, "a.temp.webm")
+        assert "a.jpg" not in webm and "title=T" in webm
+
+
+class TestScratchStaging:
+    def _cfg(self, mod, scratch):
+        cfg = json.loads(json.dumps(mod.load_config()))
+        cfg["staging"]["dir"] = str(scratch)
+        cfg["cookies"]["mode"] = "off"
+        cfg["cache"]["dir"] = ""
+        return cfg
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_cmd_uses_paths_with_relative_output(self, tmp_path, monkeypatch, mod):
+        monkeypatch.setattr(mod, "_STAGING_WARNED", set())
+        cfg = self._cfg(mod, tmp_path / "scratch")
+        downloads = os.path.join(str(tmp_path), cfg["downloads"]["output_dir"])
+        template = os.path.join(downloads, "%(playlist_title)s", "%(title)s [%(id)s].%(ext)s")
+        cmd = mod._build_download_cmd(cfg, str(tmp_path), template, "a.txt", ["URL"])
+        assert cmd[cmd.index("--output") + 1] == os.path.join("%(playlist_title)s", "%(title)s [%(id)s].%(ext)s")
+        assert f"home:{downloads}" in cmd and f"temp:{tmp_path / 'scratch'}" in cmd
+
+    def test_low_space_falls_back_to_library(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(en, "_STAGING_WARNED", set())
+        monkeypatch.setattr(en, "_free_bytes", lambda path: 1024 if "scratch" in path else 10 ** 15)
+        cfg = self._cfg(en, tmp_path / "scratch")
+        assert en._build_staging_args(cfg, str(tmp_path), str(tmp_path / "dl"), MagicMock()) == []
+        template = str(tmp_path / "downloads" / "%(title)s.%(ext)s")
+        cmd = en._build_download_cmd(cfg, str(tmp_path), template, "a.txt", ["URL"])
+        assert "--paths" not in cmd and cmd[cmd.index("--output") + 1] == template
+
+    def test_cleanup_removes_only_stale_files(self, tmp_path):
+        scratch = tmp_path / "scratch"
+        (scratch / "Playlist").mkdir(parents=True)
+        stale = scratch / "Playlist" / "old [abcdefghijk].f137.mp4.part"
+        fresh = scratch / "new [bbbbbbbbbbb].mp4.part"
+        stale.write_bytes(b"x" * 10)
+        fresh.write_bytes(b"y")
+        old = time.time() - 48 * 3600
+        os.utime(stale, (old, old))
+        cfg = self._cfg(en, scratch)
+        assert en.cleanup_staging(cfg, str(tmp_path)) == (1, 10)
+        assert fresh.exists() and not (scratch / "Playlist").exists()
+
+
+class TestDiskAdmission:
+    def _cfg(self, mod, min_free_gb=1):
+        cfg = json.loads(json.dumps(mod.load_config()))
+        cfg["admission"].update(min_free_gb=min_free_gb, check_interval=0, max_wait_hours=1)
+        return cfg
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_estimate_and_check(self, tmp_path, monkeypatch, mod):
+        assert mod.estimate_item_bytes("1000", "NA", "NA", "2") == 2000
+        assert mod.estimate_item_bytes("NA", "10", "800", "1") == 1_000_000
+        assert mod.estimate_item_bytes("NA", "NA", "NA", "1") == 0
+        gib = 1024 ** 3
+        monkeypatch.setattr(mod, "_free_bytes", lambda path: 3 * gib)
+        cfg = self._cfg(mod)
+        assert mod.check_disk_space(cfg, str(tmp_path), gib) == (True, 3 * gib, gib)
+        assert mod.check_disk_space(cfg, str(tmp_path), 3 * gib)[0] is False
+        assert mod.check_disk_space(self._cfg(mod, 0), str(tmp_path), 10 * gib)[0] is True
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_hook_refuses_and_supervisor_waits(self, tmp_path, monkeypatch, capsys, mod):
+        gib = 1024 ** 3
+        free = iter([gib, gib, 5 * gib])
+        monkeypatch.setattr(mod, "_free_bytes", lambda path: 2 * gib)
+        cfg = self._cfg(mod)
+        cfg["admission"]["ledger_file"] = str(tmp_path / "disk_reservations.sqlite")
+        monkeypatch.setattr(mod, "load_config", lambda: cfg)
+        assert mod.run_admission_check(["abc", str(2 * gib), "NA", "NA", "1"]) == mod.ADMISSION_EXIT_CODE
+        line = capsys.readouterr().out.strip()
+        assert mod.is_admission_error(line.lower())
+        assert mod.classify_error(line.lower())["retry"] is True
+        assert int(mod.ADMISSION_NEED_RE.search(line).group(1)) == 2 * gib
+        assert mod.run_admission_check(["abc", "1000", "NA", "NA", "2"]) == 0
+
+        monkeypatch.setattr(mod, "_free_bytes", lambda path: next(free))
+        monkeypatch.setattr(mod.time, "sleep", lambda s: None)
+        assert mod.wait_for_disk_space(cfg, str(tmp_path), gib, MagicMock()) is True
+
+    def test_exec_hook_args(self):
+        args = en._build_admission_args(self._cfg(en))
+        assert args[0] == "--exec" and args[1].startswith("before_dl:")
+        assert "--admission-check" in args[1] and args[1].endswith(en.ADMISSION_FIELDS)
+        assert en._build_admission_args(self._cfg(en, 0)) == []
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_concurrent_hooks_share_the_reservation_ledger(self, tmp_path, monkeypatch, mod):
+        gib = 1024 ** 3
+        cfg = self._cfg(mod)
+        monkeypatch.setattr(mod, "load_config", lambda: cfg)
+        monkeypatch.setattr(mod, "_free_bytes", lambda path: 5 * gib)
+        cfg["admission"]["ledger_file"] = str(tmp_path / "disk_reservations.sqlite")
+
+        def hook(owner, video_id, need):
+            monkeypatch.setenv(mod.ADMISSION_OWNER_ENV, owner)
+            return mod.run_admission_check([video_id, str(need), "NA", "NA", "1"])
+
+        # Free space alone would admit both: 5 - 3 >= 1
+        assert hook("a", "aaaaaaaaaaa", 2 * gib) == 0
+        assert hook("b", "bbbbbbbbbbb", 3 * gib) == mod.ADMISSION_EXIT_CODE
+        assert mod.outstanding_reservations(cfg, str(tmp_path)) == 2 * gib
+        assert mod.check_disk_space(cfg, str(tmp_path), 0, 2 * gib)[1] == 3 * gib
+        # The next item of run "a" replaces its reservation, the end of the run drops it
+        assert hook("a", "ccccccccccc", gib) == 0
+        assert mod.outstanding_reservations(cfg, str(tmp_path)) == gib
+        mod.release_reservations(mod.ledger_path(cfg, str(tmp_path)), "a")
+        assert hook("b", "bbbbbbbbbbb", 3 * gib) == 0
+        assert (tmp_path / "disk_reservations.sqlite").exists()
+
+    def test_workers_and_postprocess_see_reservations(self, tmp_path, monkeypatch):
+        import threading
+        gib = 1024 ** 3
+        cfg = self._cfg(en)
+        path = en.ledger_path(cfg, str(tmp_path))
+        monkeypatch.setattr(en, "_free_bytes", lambda path: 3 * gib)
+        assert en.admit_item(cfg, str(tmp_path), "1:slice", "aaaaaaaaaaa", gib)[0] is True
+        # A slice worker waiting with need=0 counts the other slice's reservation
+        reserved = en.outstanding_reservations(cfg, str(tmp_path))
+        assert en.check_disk_space(cfg, str(tmp_path), 0, reserved)[0] is True
+        assert en.check_disk_space(cfg, str(tmp_path), gib + 1, reserved)[0] is False
+
+        media = tmp_path / "Clip [bbbbbbbbbbb].mp4"
+        media.write_bytes(b"x" * 1000)
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_postprocess(*args):
+            started.set()
+            finish.wait(timeout=5)
+
+        monkeypatch.setattr(en, "postprocess_file", slow_postprocess)
+        pool = en.ThreadPoolExecutor(max_workers=1)
+        monkeypatch.setattr(en, "_POSTPROC", {"ffmpeg": "ffmpeg", "pool": pool, "ledger": path,
+                                              "slots": threading.BoundedSemaphore(2)})
+        en.submit_postprocess("bbbbbbbbbbb", str(media))
+        assert started.wait(timeout=5)
+        assert en.outstanding_reservations(cfg, str(tmp_path)) == gib + 1000
+        finish.set()
+        pool.shutdown(wait=True)
+        assert en.outstanding_reservations(cfg, str(tmp_path)) == gib
+
+    def test_hook_accepts_id_starting_with_dash(self):
+        import shlex
+        command = en._build_admission_args(self._cfg(en))[1][len("before_dl:"):]
+        filled = command.replace(en.ADMISSION_FIELDS, "'-xYz12345ab' 1000 NA NA 1")
+        argv = shlex.split(filled)[1:]
+        assert en.admission_hook_values(argv) == ["-xYz12345ab", "1000", "NA", "NA", "1"]
+        assert en.admission_hook_values([argv[0], "--check"]) is None
+
+
+class TestPartialResume:
+    def _touch(self, path, size):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_scan_maps_partials_to_library_folders(self, tmp_path, mod):
+        downloads, staging = tmp_path / "downloads", tmp_path / "scratch"
+        self._touch(downloads / "Mix" / "Song [aaaaaaaaaaa].f137.mp4.part", 300)
+        self._touch(downloads / "Mix" / "Song [aaaaaaaaaaa].f137.mp4.ytdl", 10)
+        self._touch(downloads / "Mix" / "Done [ccccccccccc].mp4", 999)
+        self._touch(downloads / "Solo [bbbbbbbbbbb].webm.part", 50)
+        self._touch(staging / "Other" / "Big [ddddddddddd].f248.webm.part-Frag3", 5000)
+
+        partials = mod.scan_partial_downloads(str(downloads), str(staging))
+        assert set(partials) == {"aaaaaaaaaaa", "bbbbbbbbbbb", "ddddddddddd"}
+        assert partials["aaaaaaaaaaa"] == {"folder": str(downloads / "Mix"), "bytes": 310, "files": 2}
+        assert partials["bbbbbbbbbbb"]["folder"] == str(downloads)
+        assert partials["ddddddddddd"]["folder"] == str(downloads / "Other")
+
+        plan = mod.plan_partial_resume(partials)
+        assert [folder for folder, _ in plan] == [str(downloads / "Other"), str(downloads / "Mix"), str(downloads)]
+        assert plan[1][1] == ["https://www.youtube.com/watch?v=aaaaaaaaaaa"]
+
+    def test_staging_inside_library_is_not_scanned_twice(self, tmp_path):
+        downloads = tmp_path / "downloads"
+        self._touch(downloads / ".scratch" / "Mix" / "Song [aaaaaaaaaaa].mp4.part", 100)
+        partials = en.scan_partial_downloads(str(downloads), str(downloads / ".scratch"))
+        assert partials["aaaaaaaaaaa"]["folder"] == str(downloads / "Mix")
+        assert partials["aaaaaaaaaaa"]["files"] == 1
+
+    def test_archived_leftovers_are_removed_not_resumed(self, tmp_path):
+        downloads, staging = tmp_path / "downloads", tmp_path / "scratch"
+        self._touch(downloads / "Mix" / "Song [aaaaaaaaaaa].f137.mp4.part", 300)
+        self._touch(downloads / "Mix" / "Song [aaaaaaaaaaa].mp4", 999)
+        self._touch(staging / "Mix" / "Song [aaaaaaaaaaa].f251.webm.part", 20)
+        self._touch(downloads / "Mix" / "Next [bbbbbbbbbbb].mp4.part", 50)
+        archive = tmp_path / "archive.txt"
+        archive.write_text("youtube aaaaaaaaaaa\n", encoding="utf-8")
+        cfg = json.loads(json.dumps(en.load_config()))
+
+        partials = en.scan_partial_downloads(str(downloads), str(staging))
+        finished = en.archived_ids(cfg, str(archive), partials)
+        assert finished == {"aaaaaaaaaaa"}
+        assert en.remove_partial_leftovers(str(downloads), str(staging), finished, MagicMock()) == (2, 320)
+        assert (downloads / "Mix" / "Song [aaaaaaaaaaa].mp4").exists()
+        assert set(en.scan_partial_downloads(str(downloads), str(staging))) == {"bbbbbbbbbbb"}
+
+    def test_partial_names(self):
+        assert en.partial_video_id("T [abcdefghijk].f137.mp4.part-Frag12.part") == "abcdefghijk"
+        assert en.partial_video_id("T [abcdefghijk].mp4") is None
+        assert en.partial_video_id("T [abcdefghijk].temp.mp4") is None
+
+
+class TestDownloadOrder:
+    ENTRIES = [
+        {"index": 1, "id": "a", "duration": 600.0, "date": 300.0, "size": None},
+        {"index": 2, "id": "b", "duration": 60.0, "date": 100.0, "size": None},
+        {"index": 3, "id": "c", "duration": None, "date": 200.0, "size": 5.0},
+        {"index": 4, "id": "d", "duration": 300.0, "date": None, "size": None},
+    ]
+
+    def _cfg(self, mod, order, seed=0):
+        cfg = json.loads(json.dumps(mod.load_config()))
+        cfg["downloads"].update(order=order, order_seed=seed)
+        return cfg
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_modes(self, mod):
+        assert mod.order_playlist_entries(self.ENTRIES, "newest") == [1, 3, 2, 4]
+        assert mod.order_playlist_entries(self.ENTRIES, "oldest") == [2, 3, 1, 4]
+        assert mod.order_playlist_entries(self.ENTRIES, "shortest") == [2, 4, 1, 3]
+        assert mod.order_playlist_entries(self.ENTRIES, "smallest") == [3, 2, 4, 1]
+        shuffled = mod.order_playlist_entries(self.ENTRIES, "random", seed=7)
+        assert sorted(shuffled) == [1, 2, 3, 4]
+        assert mod.order_playlist_entries(self.ENTRIES, "random", seed=7) == shuffled
+
+    def test_undated_oldest_is_list_reversed(self):
+        entries = [dict(e, date=None) for e in self.ENTRIES]
+        assert en.order_playlist_entries(entries, "oldest") == [4, 3, 2, 1]
+
+    def test_items_spec(self):
+        assert en.playlist_items_spec([5, 1, 2, 3, 4, 9, 8, 7, 6, 11, 12]) == "5,1:4,9:6:-1,11,12,1:"
+        assert en.playlist_items_spec([]) == "1:"
+        assert en.playlist_items_spec(list(range(1, 1000, 2)), limit=10) == "1,3,5,7,9,1:"
+
+    def test_args_per_mode(self):
+        assert en.ordering_args(en.load_config()) == ["--playlist-random"]
+        assert en.playlist_order_args(en.load_config(), "https://x/playlist?list=PL1") == []
+        assert en.ordering_args(self._cfg(en, "shortest")) == []
+        assert en.ordering_args(self._cfg(en, "random", seed=3)) == []
+        assert en.playlist_order_args(self._cfg(en, "playlist"), "u") == []
+        assert en.playlist_order_args(self._cfg(en, "oldest"), "unlisted") == ["--playlist-items", "::-1"]
+        assert en.playlist_order_args(self._cfg(en, "random", seed=3), "unlisted") == ["--playlist-random"]
+
+    def test_listing_feeds_the_plan(self, tmp_path, monkeypatch):
+        url = "https://www.youtube.com/playlist?list=PL1"
+        archive = tmp_path / "archive.txt"
+        archive.write_text("youtube a\n", encoding="utf-8")
+        out = "a\t600\tNA\t20240101\tNA\nb\t60.0\tNA\tNA\tNA\nc\t30\t1700000000\tNA\t123\n"
+        monkeypatch.setattr(en.subprocess, "run", lambda *a, **k: MagicMock(returncode=0, stdout=out))
+        monkeypatch.setattr(en, "_PLAYLIST_ENTRIES", {})
+        cfg = self._cfg(en, "shortest")
+        assert en.get_playlist_info(url, str(archive), cfg, str(tmp_path)) == (3, 1, 2)
+        assert [e["id"] for e in en._PLAYLIST_ENTRIES[url]] == ["b", "c"]
+        assert en.playlist_order_args(cfg, url) == ["--playlist-items", "3,2,1:"]
+
+
+class TestFairShareScheduler:
+    def _cfg(self, mod, **scheduler):
+        cfg = json.loads(json.dumps(mod.load_config()))
+        cfg["downloads"]["order"] = "playlist"
+        cfg["scheduler"].update(enabled=True, **scheduler)
+        return cfg
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_slices_interleave_sources(self, tmp_path, monkeypatch, mod):
+        big = "https://www.youtube.com/playlist?list=PLbig"
+        small = "https://www.youtube.com/playlist?list=PLsmall"
+        video = "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+        entries = {
+            big: [{"index": i, "id": f"b{i}", "duration": None, "date": None, "size": None} for i in range(1, 7)],
+            small: [{"index": 1, "id": "s1", "duration": None, "date": None, "size": None}],
+        }
+
+        def fake_info(url, archive_file, cfg, script_dir, logger=None):
+            mod._PLAYLIST_ENTRIES[url] = entries[url]
+            return (len(entries[url]) + 1, 1, len(entries[url]))
+
+        calls = []
+
+        def fake_single(url, idx, total, script_dir, downloads_dir, archive_file, logger, playlist_items=None):
+            calls.append((url, playlist_items))
+            return (1, 0, 0, None, 0, False)
+
+        monkeypatch.setattr(mod, "_PLAYLIST_ENTRIES", {})
+        monkeypatch.setattr(mod, "get_playlist_info", fake_info)
+        monkeypatch.setattr(mod, "download_single_url", fake_single)
+        monkeypatch.setattr(mod, "wait_for_disk_space", lambda *a: True)
+        cfg = self._cfg(mod, workers=1, slice=2, sources={"PLsmall": {"weight": 2}})
+        work = [(str(tmp_path), [big]), (str(tmp_path), [small]), (str(tmp_path), [video])]
+
+        result = mod.run_fair_share(work, cfg, str(tmp_path), "archive.txt", MagicMock())
+        assert calls == [(video, None), (big, "1,2"), (small, "1"), (big, "3,4"), (big, "5,6")]
+        assert result == (5, 0, 0, [], False)
+
+    def test_source_settings_and_concurrency(self):
+        cfg = self._cfg(en, sources={"WL": {"weight": 3, "max_concurrency": 2}})
+        assert en.source_settings(cfg, ["https://www.youtube.com/playlist?list=WL"]) == (3, 2)
+        assert en.source_settings(cfg, ["https://www.youtube.com/watch?v=x"]) == (1, 1)
+
+        a = {"jobs": en.deque([("download", "1"), ("download", "2"), ("download", "3")]),
+             "running": 0, "max_concurrency": 2}
+        b = {"jobs": en.deque([("download", None)]), "running": 0, "max_concurrency": 1}
+        done = {"jobs": en.deque(), "running": 0, "max_concurrency": 1}
+        rotation = en.deque([a, done, b])
+        picks = []
+        while (picked := en.next_slice(rotation)) is not None:
+            source, job = picked
+            source["running"] += 1
+            picks.append(job[1])
+        assert picks == ["1", None, "2"]
+        assert done not in rotation
+
+    def test_playlist_slices_follow_the_planned_order(self):
+        cfg = self._cfg(en, slice=2)
+        cfg["downloads"]["order"] = "shortest"
+        entries = [{"index": i, "id": str(i), "duration": d, "date": None, "size": None}
+                   for i, d in enumerate([50, 10, 40, 20, 30], 1)]
+        assert en.plan_playlist_slices(cfg, entries, weight=2) == ["2,4,5,3", "1"]
+        assert en.plan_playlist_slices(cfg, entries, weight=2, batch=True) == [["2", "4", "5", "3"], ["1"]]
+
+    def test_relisting_slices_grow_with_the_playlist(self):
+        cfg = self._cfg(en, slice=1)
+        entries = [{"index": i, "id": str(i), "duration": None, "date": None, "size": None} for i in range(1, 26)]
+        assert en.plan_playlist_slices(cfg, entries, weight=1)[:2] == ["1:3", "4:6"]
+        assert len(en.plan_playlist_slices(cfg, entries, weight=1)) == 9
+        assert len(en.plan_playlist_slices(cfg, entries, weight=1, batch=True)) == 25
+
+    def test_slices_are_batches_into_the_playlist_folder(self, tmp_path, monkeypatch):
+        url = "https://www.youtube.com/playlist?list=PLx"
+        folder = str(tmp_path / "My list")
+
+        def fake_info(url, archive_file, cfg, script_dir, logger=None):
+            en._PLAYLIST_ENTRIES[url] = [en.parse_playlist_entry(f"v{i}\tNA\tNA\tNA\tNA\tMy list", i)
+                                         for i in range(1, 4)]
+            return (3, 0, 3)
+
+        batches = []
+
+        def fake_batch(urls, idx, total, script_dir, downloads_dir, archive_file, logger):
+            batches.append((urls, downloads_dir))
+            return (len(urls), 0, 0, [], 0, False)
+
+        monkeypatch.setattr(en, "_PLAYLIST_ENTRIES", {})
+        monkeypatch.setattr(en, "get_playlist_info", fake_info)
+        monkeypatch.setattr(en, "playlist_folder", lambda target, title: folder if title == "My list" else None)
+        monkeypatch.setattr(en, "download_video_batch", fake_batch)
+        monkeypatch.setattr(en, "download_single_url", MagicMock(side_effect=AssertionError("re-listed")))
+        monkeypatch.setattr(en, "wait_for_disk_space", lambda *a: True)
+        result = en.run_fair_share([(str(tmp_path), [url])], self._cfg(en, workers=1, slice=2),
+                                   str(tmp_path), "a.txt", MagicMock())
+        watch = "https://www.youtube.com/watch?v="
+        assert batches == [([watch + "v1", watch + "v2"], folder), ([watch + "v3"], folder)]
+        assert result == (3, 0, 0, [], False)
+
+    def test_concurrent_slices_admit_through_one_ledger(self, tmp_path, monkeypatch):
+        import threading
+        gib = 1024 ** 3
+        cfg = self._cfg(en)
+        cfg["admission"].update(min_free_gb=1, ledger_file=str(tmp_path / "ledger.sqlite"))
+        cfg["downloads"]["generate_nfo"] = False
+        cfg["cookies"]["mode"] = "off"
+        cfg["cache"]["dir"] = ""
+        monkeypatch.setattr(en, "load_config", lambda: cfg)
+        monkeypatch.setattr(en, "_free_bytes", lambda path: 3 * gib)
+        monkeypatch.setattr(en, "download_single_url", lambda url, *a: (0, 0, 1, url, 0, False))
+        both_running = threading.Barrier(2, timeout=5)
+        admitted = {}
+
+        def fake_popen(cmd, **kwargs):
+            # What the before_dl hook of each slice's yt-dlp run would do
+            owner = kwargs["env"][en.ADMISSION_OWNER_ENV]
+            both_running.wait()
+            admitted[owner] = en.admit_item(cfg, str(tmp_path), owner, owner[-11:], gib + gib // 2)[0]
+            proc = MagicMock()
+            proc.stdout.readline.side_effect = [""]
+            proc.poll.return_value = 0
+            proc.wait.return_value = 0
+            return proc
+
+        monkeypatch.setattr(en.subprocess, "Popen", fake_popen)
+        slices = [[f"https://www.youtube.com/watch?v={c * 11}"] for c in "ab"]
+        threads = [threading.Thread(target=en.download_video_batch,
+                                    args=(urls, 1, 1, str(tmp_path), str(tmp_path), "a.txt", MagicMock()))
+                   for urls in slices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        # Free space alone would admit both items; the ledger lets only one of them in
+        assert len(admitted) == 2 and sorted(admitted.values()) == [False, True]
+        assert en.outstanding_reservations(cfg, str(tmp_path)) == 0
+
+    def test_disk_stop_marks_unstarted_sources_failed(self, tmp_path, monkeypatch):
+        video = "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+        monkeypatch.setattr(en, "wait_for_disk_space", lambda *a: False)
+        result = en.run_fair_share([(str(tmp_path), [video])], self._cfg(en), str(tmp_path), "a.txt", MagicMock())
+        assert result == (0, 0, 0, [video], False)
+
+    def test_disk_wait_does_not_hold_up_other_sources(self, tmp_path, monkeypatch):
+        import threading
+        video = "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+        playlist = "https://www.youtube.com/playlist?list=PLx"
+        freed = threading.Event()
+        waits = []
+
+        def fake_disk(*args):
+            # The first slice waits for space that the second source's slice frees
+            waits.append(1)
+            if len(waits) == 1:
+                return freed.wait(timeout=5)
+            freed.set()
+            return True
+
+        def fake_info(url, archive_file, cfg, script_dir, logger=None):
+            en._PLAYLIST_ENTRIES[url] = [{"index": 1, "id": "p1", "duration": None, "date": None, "size": None}]
+            return (1, 0, 1)
+
+        monkeypatch.setattr(en, "_PLAYLIST_ENTRIES", {})
+        monkeypatch.setattr(en, "wait_for_disk_space", fake_disk)
+        monkeypatch.setattr(en, "get_playlist_info", fake_info)
+        monkeypatch.setattr(en, "download_single_url",
+                            lambda url, *a, playlist_items=None: (1, 0, 0, None, 0, False))
+        work = [(str(tmp_path), [video]), (str(tmp_path), [playlist])]
+        result = en.run_fair_share(work, self._cfg(en, workers=2), str(tmp_path), "a.txt", MagicMock())
+        assert freed.is_set()
+        assert result == (2, 0, 0, [], False)
+
+
+class TestTimeOfDaySchedule:
+    WINDOWS = [
+        {"start": "09:00", "end": "18:00", "rate": "4M", "workers": 2, "politeness": "polite"},
+        {"start": "22:00", "end": "06:00", "politeness": "fast", "workers": 4},
+    ]
+
+    def _cfg(self, mod, scheduler=True):
+        cfg = json.loads(json.dumps(mod.load_config()))
+        cfg["schedule"]["windows"] = self.WINDOWS
+        cfg["scheduler"]["enabled"] = scheduler
+        cfg["cookies"]["mode"] = "off"
+        cfg["cache"]["dir"] = ""
+        return cfg
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_windows_rates_and_politeness(self, monkeypatch, mod):
+        from datetime import datetime
+        cfg = self._cfg(mod)
+        assert mod.active_window(cfg, datetime(2026, 1, 5, 9, 0)) == 0
+        assert mod.active_window(cfg, datetime(2026, 1, 5, 18, 0)) is None
+        assert mod.active_window(cfg, datetime(2026, 1, 5, 23, 30)) == 1
+        assert mod.active_window(cfg, datetime(2026, 1, 5, 5, 59)) == 1
+        assert mod.parse_rate("4M") == 4 * 1024 ** 2
+        assert mod.parse_rate("1.5KiB") == 1536 and mod.parse_rate("") == 0 and mod.parse_rate("fast") == 0
+
+        monkeypatch.setattr(mod, "_ENGINE", None)
+        monkeypatch.setattr(mod, "active_window", lambda cfg, now=None: 0)
+        assert mod.scheduled_workers(cfg) == 2
+        assert mod.schedule_args(cfg) == ["--limit-rate", str(2 * 1024 ** 2)]
+        assert mod.schedule_args(self._cfg(mod, scheduler=False)) == ["--limit-rate", str(4 * 1024 ** 2)]
+        cmd = mod._build_download_cmd(cfg, "/tmp", "%(id)s.%(ext)s", "a.txt", ["URL"])
+        assert cmd[cmd.index("--sleep-interval") + 1] == "60"
+        assert cmd[cmd.index("--limit-rate") + 1] == str(2 * 1024 ** 2)
+
+        monkeypatch.setattr(mod, "active_window", lambda cfg, now=None: None)
+        assert mod.schedule_args(cfg) == []
+        assert mod.network_settings(cfg) == cfg["network"]
+        assert mod.scheduled_workers(cfg) == cfg["scheduler"]["workers"]
+
+    def test_cli_attempt_restarts_at_window_boundary(self, tmp_path, monkeypatch):
+        cfg = self._cfg(en)
+        windows = iter([0, 0, 1])
+        monkeypatch.setattr(en, "load_config", lambda: cfg)
+        monkeypatch.setattr(en, "active_window", lambda cfg, now=None: next(windows, 1))
+        monkeypatch.setattr(en, "SCHEDULE_CHECK_INTERVAL", 0)
+        monkeypatch.setattr(en, "_LANDED", None)
+        process = MagicMock()
+        process.stdout.readline.side_effect = ["[download]  10.0% of 1MiB\n"] * 10 + [""]
+        process.poll.return_value = None
+        process.wait.return_value = -9
+        monkeypatch.setattr(en.subprocess, "Popen", lambda *a, **k: process)
+        result = en._run_cli_attempt(["yt-dlp", "URL"], str(tmp_path), 3600, 0, MagicMock())
+        assert result[0] == en.SCHEDULE_RESTART_CODE
+        process.kill.assert_called_once()
+
+    def test_window_boundary_while_child_is_silent(self, tmp_path, monkeypatch):
+        cfg = self._cfg(en)
+        boundary = time.time() + 0.5
+        monkeypatch.setattr(en, "load_config", lambda: cfg)
+        monkeypatch.setattr(en, "active_window", lambda cfg, now=None: 0 if time.time() < boundary else 1)
+        monkeypatch.setattr(en, "SCHEDULE_CHECK_INTERVAL", 0)
+        monkeypatch.setattr(en, "_LANDED", None)
+        silent = [sys.executable, "-c", "import time; time.sleep(60)"]
+        start = time.time()
+        result = en._run_cli_attempt(silent, str(tmp_path), 3600, 0, MagicMock())
+        assert result[0] == en.SCHEDULE_RESTART_CODE
+        assert time.time() - start < 10
+
+    def test_restart_is_not_a_failed_attempt(self, tmp_path, monkeypatch):
+        outcomes = iter([
+            (en.SCHEDULE_RESTART_CODE, [], 1, 0, 0),
+            (en.SCHEDULE_RESTART_CODE, [], 0, 0, 0),
+            (en.SCHEDULE_RESTART_CODE, [], 0, 0, 0),
+            (0, [], 1, 1, 0),
+        ])
+        cmds = []
+
+        def fake_attempt(cmd, *args):
+            cmds.append(cmd)
+            return next(outcomes)
+
+        monkeypatch.setattr(en, "_ENGINE", None)
+        monkeypatch.setattr(en, "_run_cli_attempt", fake_attempt)
+        monkeypatch.setattr(en, "_build_download_cmd", lambda *a, **k: ["yt-dlp", str(len(cmds))])
+        monkeypatch.setattr(en, "_write_missing_nfos", lambda *a: None)
+        monkeypatch.setattr(en.time, "sleep", lambda s: None)
+        result = en.download_single_url("https://www.youtube.com/playlist?list=PL1", 1, 1, str(tmp_path),
+                                        str(tmp_path), "a.txt", MagicMock())
+        assert result[:4] == (2, 0, 0, None)
+        assert len(cmds) == 4 and cmds[-1] == ["yt-dlp", "3"]
+
+
+class TestQuotaBudgets:
+    def _cfg(self, mod, **budgets):
+        cfg = json.loads(json.dumps(mod.load_config()))
+        cfg["quota"].update(budgets)
+        cfg["cookies"]["mode"] = "off"
+        return cfg
+
+    @pytest.mark.parametrize("mod", [en, ru])
+    def test_rolling_windows_and_resume_time(self, tmp_path, mod):
+        cfg = self._cfg(mod, hourly_requests=100, daily_videos=10)
+        conn = mod.open_quota_db(str(tmp_path / "q.sqlite"))
+        now = 1_000_000.0
+        mod.record_quota_usage(conn, "anonymous", {"requests": 60, "videos": 4, "bytes": 0}, now - 7200)
+        mod.record_quota_usage(conn, "anonymous", {"requests": 50, "videos": 3, "bytes": 0}, now - 1800)
+        mod.record_quota_usage(conn, "anonymous", {"requests": 50, "videos": 3, "bytes": 0}, now - 600)
+        mod.record_quota_usage(conn, "browser:firefox", {"requests": 500, "videos": 0, "bytes": 0}, now - 60)
+        assert mod.quota_usage(conn, "anonymous", 3600, now) == {"requests": 100, "videos": 6, "bytes": 0}
+        assert mod.quota_usage(conn, "anonymous", 86400, now)["videos"] == 10
+
+        # Both budgets are full; the daily one frees up last (when the row of now - 7200 expires)
+        key, used, budget, resume_at = mod.exceeded_budget(conn, "anonymous", cfg, now)
+        assert (key, used, budget) == ("daily_videos", 10, 10)
+        assert resume_at == now - 7200 + 86400
+        assert mod.quota_resume_time(conn, "anonymous", "requests", 100, 3600, now) == now - 1800 + 3600
+        assert mod.exceeded_budget(conn, "anonymous", self._cfg(mod), now) is None
+
+        # Rows older than QUOTA_HISTORY_DAYS are dropped on the next write
+        mod.record_quota_usage(conn, "anonymous", {"requests": 0, "videos": 0, "bytes": 0},
+                               now - 600 + mod.QUOTA_HISTORY_DAYS * 86400)
+        assert conn.execute("SELECT COUNT(*) FROM quota_usage").fetchone()[0] == 2
+        conn.close()
+
+    def test_request_lines(self):
+        counted = [
+            "[youtube] jNQXAC9IVRw: Downloading webpage",
+            "[youtube] jNQXAC9IVRw: Downloading tv client config",
+            "[youtube:tab] PL123 page 2: Downloading API JSON",
+        ]
+        ignored = [
+            "[youtube:tab] Playlist WL: Downloading 50 items of 4000",
+            "[download] Downloading item 3 of 5",
+            "[info] jNQXAC9IVRw: Downloading 1 format(s): 137+140",
+            "[youtube] Extracting URL: https://www.youtube.com/watch?v=jNQXAC9IVRw",
+        ]
+        assert all(en._QUOTA_REQUEST_RE.match(line) for line in counted)
+        assert not any(en._QUOTA_REQUEST_RE.match(line) for line in ignored)
+
+    def test_cookie_identity(self, tmp_path):
+        cfg = self._cfg(en)
+        assert en.cookie_identity(cfg, str(tmp_path)) == "anonymous"
+        cfg["cookies"].update({"mode": "file", "cookies_file": "c.txt", "browser": "chrome"})
+        assert en.cookie_identity(cfg, str(tmp_path)) == "browser:chrome"  # missing file: browser fallback
+        (tmp_path / "c.txt").write_text("")
+        assert en.cookie_identity(cfg, str(tmp_path)) == "file:c.txt"
+
+    def test_accounting_persists_across_runs(self, tmp_path, monkeypatch):
+        cfg = self._cfg(en, file=str(tmp_path / "q.sqlite"))
+        monkeypatch.setattr(en, "load_config", lambda: cfg)
+        monkeypatch.setattr(en, "_LANDED", None)
+        monkeypatch.setattr(en, "_POSTPROC", None)
+        monkeypatch.setattr(en, "_LIBRARY_QUEUE", None)
+        en.start_quota_accounting(cfg, str(tmp_path))
+        try:
+            manifest = en._LANDED
+            assert manifest is not None and en._QUOTA["identity"] == "anonymous"
+            en.count_quota_request("[youtube] jNQXAC9IVRw: Downloading webpage")
+            en.count_quota_request("[youtube:tab] WL page 2: Downloading API JSON")
+            en.count_quota_request("[download] Destination: a.mp4")
+            video = tmp_path / "a [jNQXAC9IVRw].mp4"
+            video.write_bytes(b"x" * 1000)
+            with open(manifest["path"], "a", encoding="utf-8") as f:
+                f.write(f"jNQXAC9IVRw\t{video}\n")
+        finally:
+            en.stop_quota_accounting()
+        assert en._QUOTA is None and en._LANDED is None
+        assert not os.path.exists(manifest["path"])
+
+        conn = en.open_quota_db(cfg["quota"]["file"])
+        assert en.quota_usage(conn, "anonymous", 3600) == {"requests": 2, "videos": 1, "bytes": 1000}
+        conn.close()
+
+        # Next run: the saved usage counts against the budget
+        cfg["quota"]["hourly_videos"] = 1
+        en.start_quota_accounting(cfg, str(tmp_path))
+        try:
+            assert en.check_quota(cfg)[:3] == ("hourly_videos", 1, 1)
+            assert en.restart_reason(cfg, en.active_window(cfg)) == "Quota reached (hourly_videos 1 of 1)"
+        finally:
+            en.stop_quota_accounting()
+
+    def test_wait_for_quota_sleeps_until_resume(self, monkeypatch):
+        now = time.time()
+        checks = iter([("daily_requests", 5, 5, now + 120), ("daily_requests", 5, 5, now + 300), None])
+        sleeps = []
+        monkeypatch.setattr(en, "check_quota", lambda cfg: next(checks))
+        monkeypatch.setattr(en.time, "sleep", sleeps.append)
+        en.wait_for_quota(self._cfg(en), MagicMock())
+        assert len(sleeps) == 2 and 100 < sleeps[0] <= 120 and 280 < sleeps[1] <= 300
+
+    def test_cli_attempt_stops_when_quota_runs_out(self, tmp_path, monkeypatch):
+        cfg = self._cfg(en)
+        reasons = iter([None, "Quota reached (hourly_requests 10 of 10)"])
+        monkeypatch.setattr(en, "load_config", lambda: cfg)
+        monkeypatch.setattr(en, "quota_reason", lambda cfg: next(reasons))
+        monkeypatch.setattr(en, "SCHEDULE_CHECK_INTERVAL", 0)
+        monkeypatch.setattr(en, "_LANDED", None)
+        process = MagicMock()
+        process.stdout.readline.side_effect = ["[youtube] jNQXAC9IVRw: Downloading webpage\n"] * 10 + [""]
+        process.poll.return_value = None
+        process.wait.return_value = -9
+        monkeypatch.setattr(en.subprocess, "Popen", lambda *a, **k: process)
+        result = en._run_cli_attempt(["yt-dlp", "URL"], str(tmp_path), 3600, 0, MagicMock())
+        assert result[0] == en.SCHEDULE_RESTART_CODE
+        process.kill.assert_called_once()
+
+    def test_batch_stops_when_quota_runs_out_while_child_is_silent(self, tmp_path, monkeypatch):
+        cfg = self._cfg(en)
+        boundary = time.time() + 0.5
+        urls = ["https://www.youtube.com/watch?v=aaaaaaaaaaa", "https://www.youtube.com/watch?v=bbbbbbbbbbb"]
+        retried = []
+        monkeypatch.setattr(en, "load_config", lambda: cfg)
+        monkeypatch.setattr(en, "wait_for_quota", lambda cfg, logger=None: None)
+        monkeypatch.setattr(en, "quota_reason",
+                            lambda cfg: "Quota reached (hourly_requests 10 of 10)" if time.time() >= boundary else None)
+        monkeypatch.setattr(en, "SCHEDULE_CHECK_INTERVAL", 0)
+        monkeypatch.setattr(en, "_LANDED", None)
+        monkeypatch.setattr(en, "_build_download_cmd",
+                            lambda *a: [sys.executable, "-c", "import time; time.sleep(60)"])
+
+        def fake_single(url, *args, **kwargs):
+            retried.append(url)
+            return (0, 0, 0, None, 0, False)
+
+        monkeypatch.setattr(en, "download_single_url", fake_single)
+        start = time.time()
+        result = en.download_video_batch(urls, 1, 2, str(tmp_path), str(tmp_path), "a.txt", MagicMock())
+        assert time.time() - start < 10
+        assert retried == urls and result[5] is False
+        assert not list(tmp_path.glob(".batch_*")) and not list(tmp_path.glob(".landed_*"))
+
+    def test_projection_and_status(self, tmp_path, monkeypatch, capsys):
+        cfg = self._cfg(en, daily_videos=100, hourly_bytes_gb=1)
+        history = {"requests": 400, "videos": 20, "bytes": 20 * 512 * 1024 ** 2}
+        # 1 GB/h at 512 MB per video = 48 videos/day, tighter than daily_videos
+        seconds, key = en.projected_drain_seconds(cfg, history, 96)
+        assert key == "hourly_bytes_gb" and seconds == pytest.approx(2 * 86400)
+        assert en.projected_drain_seconds(self._cfg(en), history, 96) is None
+        assert en.projected_drain_seconds(self._cfg(en, daily_requests=100), dict.fromkeys(history, 0), 5) is None
+
+        cfg["quota"]["file"] = str(tmp_path / "q.sqlite")
+        cfg["downloads"]["archive_file"] = str(tmp_path / "archive.txt")
+        (tmp_path / "archive.txt").write_text("youtube jNQXAC9IVRw\n")
+        (tmp_path / "links.txt").write_text(
+            "https://www.youtube.com/watch?v=jNQXAC9IVRw\n"
+            "https://www.youtube.com/watch?v=aaaaaaaaaaa\n"
+            "https://www.youtube.com/playlist?list=PL1\n")
+        conn = en.open_quota_db(cfg["quota"]["file"])
+        en.record_quota_usage(conn, "anonymous", {"requests": 40, "videos": 2, "bytes": 2 * 512 * 1024 ** 2})
+        conn.close()
+        monkeypatch.setattr(en, "load_config", lambda: cfg)
+        monkeypatch.setattr(en, "get_playlist_info", lambda *a, **k: (10, 3, 7))
+        assert en.show_quota_status(str(tmp_path / "links.txt"))
+        out = capsys.readouterr().out
+        assert "anonymous (current)" in out
+        assert "daily_videos: 2 of 100 (98 left)" in out
+        assert "hourly_requests: 40 (no limit)" in out
+        assert "Queue: 8 videos" in out
+        assert "bound by hourly_bytes_gb" in out
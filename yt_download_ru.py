@@ -8,7 +8,22 @@
 import socket
 import json
 import re
+import random
+import shlex
 import glob
+import heapq
+import mmap
+import shutil
+import struct
+import hashlib
+import sqlite3
+import threading
+import queue
+import multiprocessing
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
 from xml.sax.saxutils import escape as xml_escape
 # ── Config loading ─────────────────────────────────────────────
 _CONFIG: dict | None = None
@@ -33,11 +48,22 @@ def load_config(config_path: str | None = None) -> dict:
             "max_attempts": 3,
             "generate_nfo": True,
             "save_thumbnails": True,
+            "library_index": "library_index.sqlite",
+            "fingerprint": "partial",
+            "fingerprint_algorithm": "sha256",
+            "archive_index": False,
+            "batch_size": 20,
+            "engine": "cli",
+            "container": "mp4",
+            "resume_partials": True,
+            "order": "random",
+            "order_seed": 0,
         },
         "cookies": {
             "mode": "browser",
             "browser": "firefox",
             "cookies_file": "cookies.txt",
+            "cache_file": ".cookies_cache.txt",
         },
         "network": {
             "dns_check": True,
@@ -58,6 +84,45 @@ def load_config(config_path: str | None = None) -> dict:
             "concurrent_fragments": 1,
             "buffer_size": "16K",
         },
+        "cache": {
+            "dir": ".yt-dlp-cache",
+            "warm_interval_hours": 24,
+            "probe_url": "https://www.youtube.com/watch?v=jNQXAC9IVRw",
+        },
+        "staging": {
+            "dir": "",
+            "min_free_gb": 10,
+            "stale_hours": 24,
+        },
+        "scheduler": {
+            "enabled": False,
+            "workers": 2,
+            "slice": 20,
+            "sources": {},
+        },
+        "schedule": {
+            "windows": [],
+        },
+        "quota": {
+            "file": "quota_usage.sqlite",
+            "hourly_requests": 0,
+            "daily_requests": 0,
+            "hourly_videos": 0,
+            "daily_videos": 0,
+            "hourly_bytes_gb": 0,
+            "daily_bytes_gb": 0,
+        },
+        "admission": {
+            "min_free_gb": 20,
+            "check_interval": 60,
+            "max_wait_hours": 12,
+            "ledger_file": "disk_reservations.sqlite",
+        },
+        "postprocess": {
+            "deferred": False,
+            "workers": 2,
+            "max_pending": 8,
+        },
         "logging": {
             "max_bytes": 10 * 1024 * 1024,
             "backup_count": 5,
@@ -129,6 +194,1540 @@ def load_config(config_path: str | None = None) -> dict:
     COLORS_AVAILABLE = False
     print("Для цветного вывода: pip install colorama\n")
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
+
+try:
+    import yt_dlp
+    YTDLP_API_AVAILABLE = True
+except ImportError:
+    YTDLP_API_AVAILABLE = False
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# ── Индекс библиотеки (общий с yt_media_cleaner) ───────────────
+# Каждый файл, который yt-dlp переместил в библиотеку, сразу хэшируется
+# фоновым потоком, пока его байты ещё в кэше страниц. Строки пишутся в схему
+# file_hashes cleaner'а с ключом (dev, inode, size, mtime_ns), поэтому
+# поиск дублей находит их в кэше и не перечитывает файл.
+
+PARTIAL_HASH_SIZE = 65536
+FINGERPRINT_BUFFER_SIZE = 1024 * 1024
+
+# yt-dlp дописывает строку "<id>\t<итоговый путь>" на каждое готовое видео
+LANDED_TEMPLATE = 'after_move:%(id)s\t%(filepath)s'
+
+_LIBRARY_QUEUE = None
+_LIBRARY_THREAD = None
+_LANDED = None
+# Срезы планировщика опрашивают манифест из нескольких потоков
+_LANDED_LOCK = threading.Lock()
+
+
+def _library_index_path(cfg, script_dir):
+    """Абсолютный путь к индексу библиотеки или None, если он отключён."""
+    raw = cfg["downloads"].get("library_index", "")
+    if not raw:
+        return None
+    return raw if os.path.isabs(raw) else os.path.join(script_dir, raw)
+
+
+def open_library_index(path):
+    """Открывает (или создаёт) индекс библиотеки. WAL позволяет cleaner'у читать во время записи."""
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS file_hashes ("
+        " dev INTEGER NOT NULL,"
+        " ino INTEGER NOT NULL,"
+        " algo TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " mtime_ns INTEGER NOT NULL,"
+        " path TEXT NOT NULL,"
+        " partial TEXT,"
+        " full TEXT,"
+        " PRIMARY KEY (dev, ino, algo))"
+    )
+    conn.commit()
+    return conn
+
+
+def resolve_fingerprint_algorithm(cfg):
+    # Must match hash_algorithm of yt_media_cleaner, otherwise its scan ignores our rows
+    algorithm = cfg["downloads"].get("fingerprint_algorithm", 'sha256')
+    if algorithm not in ('sha256', 'blake2b', 'xxhash'):
+        return 'sha256'
+    if algorithm == 'xxhash' and not XXHASH_AVAILABLE:
+        return 'blake2b'
+    return algorithm
+
+
+def _new_hasher(algorithm):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b()
+    if algorithm == 'xxhash':
+        return xxhash.xxh3_128()
+    return hashlib.sha256()
+
+
+def fingerprint_file(filepath, mode='partial', algorithm='sha256'):
+    """
+    Хэширует файл за один последовательный проход.
+    mode='partial': только первые и последние 64 КиБ; mode='full': плюс хэш всего файла.
+    Возвращает (key, partial, full) или None, если файл изменился во время чтения
+    или ФС не выдаёт номера inode.
+    """
+    st = os.stat(filepath)
+    size = st.st_size
+    partial_h = _new_hasher(algorithm)
+    full_h = _new_hasher(algorithm) if mode == 'full' else None
+    small = size <= 2 * PARTIAL_HASH_SIZE
+    tail_start = size - PARTIAL_HASH_SIZE
+    buf = memoryview(bytearray(FINGERPRINT_BUFFER_SIZE))
+
+    with open(filepath, 'rb', buffering=0) as f:
+        if full_h is None and not small:
+            partial_h.update(f.read(PARTIAL_HASH_SIZE))
+            f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            partial_h.update(f.read(PARTIAL_HASH_SIZE))
+        else:
+            pos = 0
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                chunk = buf[:n]
+                if full_h is not None:
+                    full_h.update(chunk)
+                if small:
+                    partial_h.update(chunk)
+                else:
+                    if pos < PARTIAL_HASH_SIZE:
+                        partial_h.update(chunk[:PARTIAL_HASH_SIZE - pos])
+                    if pos + n > tail_start:
+                        partial_h.update(chunk[max(0, tail_start - pos):])
+                pos += n
+
+    after = os.stat(filepath)
+    if (after.st_size, after.st_mtime_ns) != (size, st.st_mtime_ns) or not st.st_ino:
+        return None
+    partial = partial_h.hexdigest()
+    if full_h is not None:
+        full = full_h.hexdigest()
+    else:
+        full = partial if small else None
+    return (st.st_dev, st.st_ino, size, st.st_mtime_ns), partial, full
+
+
+def store_fingerprint(conn, key, filepath, algorithm, partial, full):
+    """Upsert в формате cleaner'а; непосчитанный хэш сохраняется, если файл не менялся."""
+    dev, ino, size, mtime_ns = key
+    conn.execute(
+        "INSERT INTO file_hashes (dev, ino, algo, size, mtime_ns, path, partial, full)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT (dev, ino, algo) DO UPDATE SET"
+        "  partial = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns"
+        "   THEN COALESCE(excluded.partial, partial) ELSE excluded.partial END,"
+        "  full = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns"
+        "   THEN COALESCE(excluded.full, full) ELSE excluded.full END,"
+        "  size = excluded.size, mtime_ns = excluded.mtime_ns, path = excluded.path",
+        (dev, ino, algorithm, size, mtime_ns, os.path.abspath(filepath), partial, full),
+    )
+
+# ── Каталог библиотеки ─────────────────────────────────────────
+# Одна строка на скачанное видео (ключ — его .info.json) в том же индексе
+# библиотеки. Строки добавляются по мере скачивания и через --build-catalog
+# для уже существующего дерева, поэтому «что есть, где и сколько весит» —
+# это запрос, а не обход папок.
+
+CATALOG_MEDIA_EXTENSIONS = ('.mp4', '.mkv', '.webm', '.m4a', '.mp3', '.opus')
+CATALOG_THUMB_EXTENSIONS = ('.jpg', '.jpeg', '.webp', '.png')
+
+# Полнотекстовый поиск по названию, описанию, каналу и тегам (SQLite FTS5).
+# Строки catalog_fts имеют тот же rowid, что и строка каталога.
+
+def _fts5_available():
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE t USING fts5(x)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+FTS5_AVAILABLE = _fts5_available()
+
+# Веса bm25: название, описание, канал, теги
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0, 3.0)
+
+CATALOG_COLUMNS = ('info_json', 'video_id', 'folder', 'title', 'channel', 'upload_date',
+                   'duration', 'media_path', 'size', 'has_nfo', 'has_thumb', 'info_mtime_ns')
+
+
+def open_catalog(path):
+    """Открывает индекс библиотеки и создаёт таблицу каталога, если её нет."""
+    conn = open_library_index(path)
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS catalog ("
+        " info_json TEXT PRIMARY KEY,"
+        " video_id TEXT NOT NULL,"
+        " folder TEXT NOT NULL,"
+        " title TEXT,"
+        " channel TEXT,"
+        " upload_date TEXT,"
+        " duration INTEGER,"
+        " media_path TEXT,"
+        " size INTEGER,"
+        " has_nfo INTEGER NOT NULL,"
+        " has_thumb INTEGER NOT NULL,"
+        " info_mtime_ns INTEGER NOT NULL);"
+        "CREATE INDEX IF NOT EXISTS catalog_video_id ON catalog (video_id);"
+        "CREATE INDEX IF NOT EXISTS catalog_folder ON catalog (folder);"
+        "CREATE INDEX IF NOT EXISTS catalog_no_nfo ON catalog (info_json) WHERE has_nfo = 0;"
+        "CREATE INDEX IF NOT EXISTS catalog_no_media ON catalog (info_json) WHERE media_path IS NULL;"
+        "CREATE TABLE IF NOT EXISTS playlist_entries ("
+        " playlist TEXT NOT NULL,"
+        " video_id TEXT NOT NULL,"
+        " PRIMARY KEY (playlist, video_id)) WITHOUT ROWID;"
+    )
+    if FTS5_AVAILABLE:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5("
+            " title, description, channel, tags, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+    return conn
+
+
+def _probe_sizes(stem):
+    """Размеры сопутствующих файлов видео — через stat, без чтения всей папки."""
+    sizes = {}
+    for ext in CATALOG_MEDIA_EXTENSIONS + CATALOG_THUMB_EXTENSIONS + ('.nfo',):
+        try:
+            sizes[stem + ext] = os.stat(stem + ext).st_size
+        except OSError:
+            pass
+    return sizes
+
+
+def _item_files(stem, sizes):
+    """(media_path, size, has_nfo, has_thumb) для видео по списку {путь: размер}."""
+    media = next((stem + ext for ext in CATALOG_MEDIA_EXTENSIONS if stem + ext in sizes), None)
+    has_thumb = any(stem + ext in sizes for ext in CATALOG_THUMB_EXTENSIONS)
+    return media, sizes.get(media), int(stem + '.nfo' in sizes), int(has_thumb)
+
+
+def catalog_record(info_json, downloads_dir, sizes=None):
+    """
+    Строит строку каталога по .info.json и файлам рядом с ним;
+    в конце — описание и теги для полнотекстового индекса.
+    sizes: {путь: размер} для папки, если она уже прочитана.
+    Для .info.json самого плейлиста возвращает None.
+    """
+    mtime_ns = os.stat(info_json).st_mtime_ns
+    with open(info_json, 'r', encoding='utf-8') as f:
+        info = json.load(f)
+    if info.get('_type') == 'playlist':
+        return None
+
+    stem = info_json[:-len('.info.json')]
+    if sizes is None:
+        sizes = _probe_sizes(stem)
+    media, size, has_nfo, has_thumb = _item_files(stem, sizes)
+    folder = os.path.relpath(os.path.dirname(info_json), downloads_dir)
+    duration = info.get('duration')
+    return (
+        info_json,
+        info.get('id') or '',
+        '' if folder == '.' else folder,
+        info.get('title'),
+        info.get('uploader') or info.get('channel'),
+        info.get('upload_date'),
+        int(duration) if duration else None,
+        media,
+        size,
+        has_nfo,
+        has_thumb,
+        mtime_ns,
+        info.get('description') or '',
+        ' '.join(info.get('tags') or []),
+    )
+
+
+def catalog_put(conn, record):
+    row = record[:len(CATALOG_COLUMNS)]
+    conn.execute(
+        f"INSERT INTO catalog ({', '.join(CATALOG_COLUMNS)})"
+        f" VALUES ({', '.join('?' * len(CATALOG_COLUMNS))})"
+        " ON CONFLICT (info_json) DO UPDATE SET "
+        + ', '.join(f"{col} = excluded.{col}" for col in CATALOG_COLUMNS[1:]),
+        row,
+    )
+    if FTS5_AVAILABLE:
+        rowid = conn.execute("SELECT rowid FROM catalog WHERE info_json = ?", (row[0],)).fetchone()[0]
+        description, tags = record[len(CATALOG_COLUMNS):]
+        conn.execute("DELETE FROM catalog_fts WHERE rowid = ?", (rowid,))
+        conn.execute(
+            "INSERT INTO catalog_fts (rowid, title, description, channel, tags) VALUES (?, ?, ?, ?, ?)",
+            (rowid, row[3] or '', description, row[4] or '', tags),
+        )
+
+
+def catalog_delete(conn, info_jsons):
+    for info_json in info_jsons:
+        if FTS5_AVAILABLE:
+            conn.execute(
+                "DELETE FROM catalog_fts WHERE rowid IN (SELECT rowid FROM catalog WHERE info_json = ?)",
+                (info_json,),
+            )
+        conn.execute("DELETE FROM catalog WHERE info_json = ?", (info_json,))
+
+
+def catalog_landed(conn, filepath, downloads_dir, generate_nfo=False, logger=None):
+    """Добавляет в каталог только что скачанное видео; создаёт .nfo, если его нет."""
+    info_json = os.path.splitext(filepath)[0] + '.info.json'
+    if not os.path.isfile(info_json):
+        return
+    record = catalog_record(info_json, downloads_dir)
+    if record is None:
+        return
+    catalog_put(conn, record)
+    if generate_nfo and not record[CATALOG_COLUMNS.index('has_nfo')]:
+        if generate_nfo_file(info_json, logger):
+            conn.execute("UPDATE catalog SET has_nfo = 1 WHERE info_json = ?", (info_json,))
+
+
+def _walk_info_files(downloads_dir):
+    """Один проход scandir: {info_json: (mtime_ns, {путь: размер} его папки)}."""
+    found = {}
+    stack = [downloads_dir]
+    while stack:
+        current = stack.pop()
+        sizes = {}
+        infos = []
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            stack.append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        sizes[entry.path] = st.st_size
+                        if entry.name.endswith('.info.json'):
+                            infos.append((entry.path, st.st_mtime_ns))
+        except OSError:
+            continue
+        for path, mtime_ns in infos:
+            found[path] = (mtime_ns, sizes)
+    return found
+
+
+def backfill_catalog(conn, downloads_dir, workers=0, logger=None):
+    """
+    Параллельно импортирует существующее дерево в каталог.
+    Разбираются только новые и изменённые .info.json; для остальных
+    наличие видео/.nfo/обложки обновляется по списку файлов папки.
+    Возвращает счётчики {items, parsed, removed, errors}.
+    """
+    known = dict(conn.execute("SELECT info_json, info_mtime_ns FROM catalog"))
+    if FTS5_AVAILABLE:
+        # Строки, внесённые до появления поискового индекса, разбираются ещё раз
+        for (path,) in conn.execute(
+                "SELECT info_json FROM catalog WHERE rowid NOT IN (SELECT rowid FROM catalog_fts)"):
+            known[path] = None
+    found = _walk_info_files(downloads_dir)
+    changed = [p for p, (mtime_ns, _) in found.items() if known.get(p) != mtime_ns]
+    stats = {'items': 0, 'parsed': 0, 'removed': 0, 'errors': 0}
+
+    def parse(path):
+        try:
+            return catalog_record(path, downloads_dir, found[path][1])
+        except (OSError, ValueError) as e:
+            if logger:
+                logger.warning(f"  Каталог: не удалось прочитать {path}: {e}")
+            return False
+
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for record in pool.map(parse, changed):
+            if record is False:
+                stats['errors'] += 1
+            elif record is not None:
+                catalog_put(conn, record)
+                stats['parsed'] += 1
+
+    for path in set(found) - set(changed):
+        if path in known:
+            stem = path[:-len('.info.json')]
+            conn.execute(
+                "UPDATE catalog SET media_path = ?, size = ?, has_nfo = ?, has_thumb = ?"
+                " WHERE info_json = ?",
+                (*_item_files(stem, found[path][1]), path),
+            )
+
+    gone = [p for p in known if p not in found]
+    catalog_delete(conn, gone)
+    stats['removed'] = len(gone)
+    conn.commit()
+    stats['items'] = conn.execute("SELECT COUNT(*) FROM catalog").fetchone()[0]
+    return stats
+
+
+def catalog_pending_nfo(conn):
+    """Видео, у которых ещё нет .nfo."""
+    return [r[0] for r in conn.execute(
+        "SELECT info_json FROM catalog WHERE has_nfo = 0 AND media_path IS NOT NULL")]
+
+
+def catalog_orphans(conn):
+    """Метаданные без видеофайла."""
+    return [r[0] for r in conn.execute(
+        "SELECT info_json FROM catalog WHERE media_path IS NULL")]
+
+
+def store_playlist_listing(conn, playlist, video_ids):
+    """Заменяет запомненный листинг плейлиста (ключ — его URL) на video_ids."""
+    conn.execute("DELETE FROM playlist_entries WHERE playlist = ?", (playlist,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO playlist_entries (playlist, video_id) VALUES (?, ?)",
+        ((playlist, video_id) for video_id in video_ids))
+
+
+def catalog_playlist_missing(conn, playlist):
+    """(число элементов последнего листинга, ID среди них без медиафайла в каталоге)."""
+    total = conn.execute(
+        "SELECT COUNT(*) FROM playlist_entries WHERE playlist = ?", (playlist,)).fetchone()[0]
+    missing = [r[0] for r in conn.execute(
+        "SELECT p.video_id FROM playlist_entries AS p WHERE p.playlist = ? AND NOT EXISTS"
+        " (SELECT 1 FROM catalog AS c WHERE c.video_id = p.video_id AND c.media_path IS NOT NULL)",
+        (playlist,))]
+    return total, missing
+
+
+def catalog_stats(conn):
+    """Итоги, разбивка по папкам и число проблем — всё из индекса."""
+    items, size, seconds = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(duration), 0)"
+        " FROM catalog WHERE media_path IS NOT NULL").fetchone()
+    folders = conn.execute(
+        "SELECT folder, COUNT(media_path), COALESCE(SUM(size), 0) FROM catalog"
+        " GROUP BY folder ORDER BY folder").fetchall()
+    return {
+        'items': items,
+        'size': size,
+        'duration': seconds,
+        'folders': folders,
+        'orphans': conn.execute(
+            "SELECT COUNT(*) FROM catalog WHERE media_path IS NULL").fetchone()[0],
+        'no_nfo': conn.execute(
+            "SELECT COUNT(*) FROM catalog WHERE has_nfo = 0 AND media_path IS NOT NULL").fetchone()[0],
+        'no_thumb': conn.execute(
+            "SELECT COUNT(*) FROM catalog WHERE has_thumb = 0 AND media_path IS NOT NULL").fetchone()[0],
+        'multi_folder': conn.execute(
+            "SELECT COUNT(*) FROM (SELECT video_id FROM catalog WHERE media_path IS NOT NULL"
+            " GROUP BY video_id HAVING COUNT(*) > 1)").fetchone()[0],
+        'incomplete_playlists': conn.execute(
+            "SELECT COUNT(DISTINCT p.playlist) FROM playlist_entries AS p WHERE NOT EXISTS"
+            " (SELECT 1 FROM catalog AS c WHERE c.video_id = p.video_id AND c.media_path IS NOT NULL)"
+        ).fetchone()[0],
+    }
+
+
+def _fts_query(text):
+    """Превращает текст в запрос FTS5: каждое слово — префикс в кавычках, нужны все."""
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+
+def search_catalog(conn, text, limit=50):
+    """Поиск с ранжированием: [(путь, название, папка)], лучшие первыми; путь — к видео, если оно есть."""
+    query = _fts_query(text)
+    if not query:
+        return []
+    return conn.execute(
+        "SELECT COALESCE(c.media_path, c.info_json), c.title, c.folder"
+        " FROM catalog_fts JOIN catalog AS c ON c.rowid = catalog_fts.rowid"
+        f" WHERE catalog_fts MATCH ? ORDER BY bm25(catalog_fts, {', '.join(map(str, SEARCH_WEIGHTS))})"
+        " LIMIT ?",
+        (query, limit),
+    ).fetchall()
+
+
+def _library_worker(index_path, cfg, downloads_dir, work_queue, logger):
+    """Фоновый поток: хэширует и вносит в каталог готовые файлы по одному."""
+    mode = cfg["downloads"]["fingerprint"]
+    algorithm = resolve_fingerprint_algorithm(cfg)
+    generate_nfo = cfg["downloads"].get("generate_nfo", True)
+    try:
+        conn = open_catalog(index_path)
+    except sqlite3.Error as e:
+        if logger:
+            logger.warning(f"Индекс библиотеки недоступен ({index_path}): {e}")
+        conn = None
+
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        if conn is None:
+            continue
+        video_id, filepath = item
+        try:
+            if mode != 'off':
+                result = fingerprint_file(filepath, mode, algorithm)
+                if result:
+                    key, partial, full = result
+                    store_fingerprint(conn, key, filepath, algorithm, partial, full)
+            catalog_landed(conn, filepath, downloads_dir, generate_nfo, logger)
+            conn.commit()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            if logger:
+                logger.warning(f"  Не удалось захэшировать {filepath}: {e}")
+
+    if conn is not None:
+        conn.close()
+
+
+def start_library_worker(cfg, script_dir, logger=None):
+    """Запускает post-move обработчик, если индекс библиотеки включён."""
+    global _LIBRARY_QUEUE, _LIBRARY_THREAD, _LANDED
+    stop_library_worker()
+    index_path = _library_index_path(cfg, script_dir)
+    if index_path is None:
+        return
+    downloads_dir = os.path.join(script_dir, cfg["downloads"]["output_dir"])
+    _LIBRARY_QUEUE = queue.Queue()
+    _LIBRARY_THREAD = threading.Thread(
+        target=_library_worker,
+        args=(index_path, cfg, downloads_dir, _LIBRARY_QUEUE, logger),
+        name='library-index',
+        daemon=True,
+    )
+    _LIBRARY_THREAD.start()
+    _LANDED = new_landed_manifest(script_dir)
+
+
+def stop_library_worker():
+    """Дожидается хэширования всех файлов из очереди и останавливает поток."""
+    global _LIBRARY_QUEUE, _LIBRARY_THREAD, _LANDED
+    if _LIBRARY_THREAD is None:
+        return
+    collect_landed(force=True)
+    remove_landed_manifest(_LANDED)
+    _LANDED = None
+    pending = _LIBRARY_QUEUE.qsize()
+    if pending:
+        print(colored(f"Хэширование оставшихся файлов: {pending}...", Fore.CYAN))
+    _LIBRARY_QUEUE.put(None)
+    _LIBRARY_THREAD.join()
+    _LIBRARY_QUEUE = None
+    _LIBRARY_THREAD = None
+
+
+def on_file_landed(video_id, filepath, logger=None):
+    """Post-move хук: вызывается для каждого файла, который yt-dlp переместил в библиотеку."""
+    account_container_plan(filepath, load_config()["downloads"].get("container", "mp4"))
+    if _QUOTA is not None:
+        try:
+            size = os.path.getsize(filepath)
+        except OSError:
+            size = 0
+        account_quota(videos=1, size=size)
+    if _POSTPROC is not None:
+        submit_postprocess(video_id, filepath, logger)
+    elif _LIBRARY_QUEUE is not None:
+        _LIBRARY_QUEUE.put((video_id, filepath))
+
+
+def new_landed_manifest(script_dir):
+    """Создаёт пустой манифест для --print-to-file; возвращает состояние опроса."""
+    fd, path = tempfile.mkstemp(prefix='.landed_', suffix='.txt', dir=script_dir)
+    os.close(fd)
+    return {'path': path, 'offset': 0, 'checked': 0.0}
+
+
+def landed_manifest_args(state):
+    # --print-to-file трактует FILE как шаблон вывода: экранируем '%'
+    return ['--print-to-file', LANDED_TEMPLATE, state['path'].replace('%', '%%')]
+
+
+def read_landed(state, force=False):
+    """
+    Возвращает новые полные строки (video_id, filepath) из манифеста.
+    Без force файл опрашивается не чаще раза в 2 секунды.
+    """
+    now = time.time()
+    if not force and now - state['checked'] < 2:
+        return []
+    state['checked'] = now
+    try:
+        with open(state['path'], 'rb') as f:
+            f.seek(state['offset'])
+            data = f.read()
+    except OSError:
+        return []
+    end = data.rfind(b'\n')
+    if end < 0:
+        return []
+    state['offset'] += end + 1
+    landed = []
+    for raw in data[:end].split(b'\n'):
+        video_id, _, filepath = raw.decode('utf-8', errors='replace').rstrip('\r').partition('\t')
+        if filepath:
+            landed.append((video_id, filepath))
+    return landed
+
+
+def collect_landed(force=False, logger=None):
+    """Ставит в очередь файлы, о перемещении которых yt-dlp сообщил с прошлого вызова."""
+    if _LANDED is None:
+        return
+    with _LANDED_LOCK:
+        landed = read_landed(_LANDED, force)
+    # Вне блокировки: submit_postprocess() может ждать свободного слота, а другие
+    # срезы тем временем должны читать манифест
+    for video_id, filepath in landed:
+        on_file_landed(video_id, filepath, logger)
+
+
+def remove_landed_manifest(state):
+    try:
+        os.remove(state['path'])
+    except OSError:
+        pass
+
+# ── Отложенная постобработка ───────────────────────────────────
+# С postprocess.deferred процесс yt-dlp только скачивает и склеивает потоки;
+# конвертация обложки и встраивание метаданных/обложки (каждое — полная
+# перезапись файла) переходят в ограниченный пул воркеров ffmpeg, который
+# получает файлы из манифеста after_move. Следующая загрузка начинается сразу,
+# и сеть не простаивает, пока работает ffmpeg. Оба встраивания выполняются
+# за один проход ffmpeg. Готовый файл затем уходит обработчику библиотеки,
+# так что отпечатки соответствуют итоговым байтам. Когда ждут max_pending
+# файлов, on_file_landed() блокируется, а вместе с ним и yt-dlp (backpressure).
+
+THUMBNAIL_EXTENSIONS = ('.jpg', '.webp', '.png', '.jpeg')
+
+_POSTPROC = None
+
+
+def start_postprocess_pool(cfg, script_dir, logger=None):
+    """Запускает воркеры постобработки, если включен postprocess.deferred и есть ffmpeg."""
+    global _POSTPROC, _LANDED
+    if not cfg["postprocess"].get("deferred") or _POSTPROC is not None:
+        return
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        print(colored("⚠ ffmpeg не найден: постобработка остается внутри yt-dlp", Fore.YELLOW))
+        if logger:
+            logger.warning("ffmpeg не найден, отложенная постобработка отключена")
+        return
+    workers = max(1, cfg["postprocess"].get("workers", 2))
+    _POSTPROC = {
+        'ffmpeg': ffmpeg,
+        'pool': ThreadPoolExecutor(max_workers=workers, thread_name_prefix='postprocess'),
+        'slots': threading.BoundedSemaphore(max(workers, cfg["postprocess"].get("max_pending", 8))),
+        'own_manifest': _LANDED is None,
+        'ledger': ledger_path(cfg, script_dir),
+        'logger': logger,
+    }
+    # Без обработчика библиотеки манифест after_move у yt-dlp еще никто не запросил
+    if _LANDED is None:
+        _LANDED = new_landed_manifest(script_dir)
+    if logger:
+        logger.info(f"Отложенная постобработка: воркеров ffmpeg {workers}")
+
+
+def stop_postprocess_pool():
+    """Завершает все задания постобработки из очереди и останавливает пул."""
+    global _POSTPROC, _LANDED
+    if _POSTPROC is None:
+        return
+    collect_landed(force=True)
+    print(colored("Ожидание завершения постобработки...", Fore.CYAN))
+    _POSTPROC['pool'].shutdown(wait=True)
+    if _POSTPROC['own_manifest'] and _LANDED is not None:
+        remove_landed_manifest(_LANDED)
+        _LANDED = None
+    _POSTPROC = None
+
+
+def submit_postprocess(video_id, filepath, logger=None):
+    """Ставит готовый файл в очередь постобработки; блокируется, пока ждут max_pending заданий."""
+    state = _POSTPROC
+    state['slots'].acquire()
+    # Пока задание не закончено, проходу встраивания нужно место под переписанную копию файла
+    owner = new_admission_owner('postprocess')
+    try:
+        hold_reservation(state.get('ledger'), owner, video_id, os.path.getsize(filepath))
+    except OSError:
+        pass
+
+    def finished(_):
+        release_reservations(state.get('ledger'), owner, video_id)
+        state['slots'].release()
+
+    future = state['pool'].submit(postprocess_file, state['ffmpeg'], video_id, filepath, logger)
+    future.add_done_callback(finished)
+
+
+def find_thumbnail(base):
+    """Обложка, записанная рядом с медиафайлом через --write-thumbnail, или None."""
+    for ext in THUMBNAIL_EXTENSIONS:
+        if os.path.isfile(base + ext):
+            return base + ext
+    return None
+
+
+def metadata_args(info):
+    """Аргументы -metadata с теми же тегами, что пишет --embed-metadata в yt-dlp."""
+    genres = info.get('genres') or info.get('categories') or []
+    artist = info.get('artist') or info.get('creator') or info.get('uploader') or info.get('uploader_id')
+    fields = [
+        ('title', info.get('title') or info.get('track')),
+        ('date', info.get('upload_date')),
+        ('description', info.get('description')),
+        ('synopsis', info.get('description')),
+        ('purl', info.get('webpage_url')),
+        ('comment', info.get('webpage_url')),
+        ('artist', artist),
+        ('genre', info.get('genre') or (genres[0] if genres else None)),
+        ('album', info.get('album')),
+    ]
+    args = []
+    for key, value in fields:
+        if value:
+            args += ['-metadata', f'{key}={value}']
+    return args
+
+
+def build_embed_cmd(ffmpeg, media_path, thumbnail, info, output_path):
+    """Один проход ffmpeg: копирование потоков, теги и (если есть) обложка как attached_pic."""
+    ext = os.path.splitext(output_path)[1].lower()
+    if ext == '.webm':
+        thumbnail = None  # в WebM нет обложек
+    cmd = [ffmpeg, '-y', '-loglevel', 'error', '-i', media_path]
+    if thumbnail and ext != '.mkv':
+        cmd += ['-i', thumbnail]
+    cmd += ['-map', '0', '-dn']
+    if thumbnail and ext == '.mkv':
+        # Matroska хранит обложку как вложение
+        cmd += ['-attach', thumbnail, '-metadata:s:t', 'mimetype=image/jpeg', '-metadata:s:t', 'filename=cover.jpg']
+    elif thumbnail:
+        # Обложка — поток после видеодорожки (у файлов только со звуком ее нет)
+        video_streams = 0 if info.get('vcodec') == 'none' else 1
+        cmd += ['-map', '1', '-disposition:v:%d' % video_streams, 'attached_pic']
+    cmd += ['-c', 'copy', *metadata_args(info), output_path]
+    return cmd
+
+
+def postprocess_file(ffmpeg, video_id, filepath, logger=None):
+    """
+    Конвертирует обложку в JPEG и встраивает ее вместе с метаданными.
+    При ошибке файл остается как скачан. Результат передается обработчику библиотеки.
+    """
+    base, ext = os.path.splitext(filepath)
+    try:
+        info = {}
+        try:
+            with open(base + '.info.json', 'r', encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        thumbnail = find_thumbnail(base)
+        if thumbnail and not thumbnail.endswith('.jpg'):
+            if convert_thumbnail(ffmpeg, thumbnail, base + '.jpg'):
+                os.remove(thumbnail)
+                thumbnail = base + '.jpg'
+            else:
+                thumbnail = None
+
+        temp_path = base + '.temp' + ext
+        st = os.stat(filepath)
+        result = subprocess.run(build_embed_cmd(ffmpeg, filepath, thumbnail, info, temp_path),
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            os.replace(temp_path, filepath)
+            os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns))
+        else:
+            _remove_quietly(temp_path)
+            if logger:
+                logger.warning(f"  Ошибка постобработки {filepath}: {result.stderr.strip()[-300:]}")
+    except OSError as e:
+        if logger:
+            logger.warning(f"  Ошибка постобработки {filepath}: {e}")
+    finally:
+        if _LIBRARY_QUEUE is not None:
+            _LIBRARY_QUEUE.put((video_id, filepath))
+
+
+# ── Планировщик контейнера ─────────────────────────────────────
+# downloads.container = "mp4" всегда дает MP4: загрузка одним файлом в другом
+# контейнере (WebM, MKV) переписывается через --remux-video. "compatible"
+# позволяет yt-dlp выбрать для каждого элемента по выбранным форматам первый
+# контейнер, который принимает кодеки как есть (--merge-output-format
+# mp4/webm/mkv), и оставляет одиночные файлы в их родном контейнере. Готовые
+# файлы сравниваются с планом "mp4", чтобы показать сэкономленные байты и
+# время ffmpeg. Обложки в пуле постобработки конвертируются через Pillow
+# прямо в процессе, если он установлен.
+
+# Семейства кодеков, которые контейнер принимает без перекодирования (как в yt-dlp)
+CONTAINER_CODECS = {
+    'mp4': {'av1', 'hevc', 'avc1', 'h264', 'mp4a', 'aacl', 'ac-4', 'ec-3'},
+    'webm': {'av1', 'vp9', 'vp8', 'opus', 'vrbs', 'vp9x', 'vp8x'},
+}
+NATIVE_CONTAINERS = ('mp4', 'webm', 'mkv', 'm4a')
+COMPATIBLE_REMUX_RULES = 'webm>webm/mkv>mkv/m4a>m4a/mp4'
+_CODEC_ALIASES = {'vp09': 'vp9', 'av01': 'av1', 'hev1': 'hevc', 'hvc1': 'hevc', 'vorbis': 'vrbs'}
+# Примерная скорость копирования потоков и цена запуска ffmpeg — для оценки экономии
+REMUX_COPY_RATE = 150 * 1024 * 1024
+THUMBNAIL_FFMPEG_SECONDS = 0.2
+
+_PLANNER_STATS = {'kept': 0, 'bytes': 0, 'thumbnails': 0}
+_PLANNER_LOCK = threading.Lock()
+
+
+def _codec_family(codec):
+    if not codec or codec == 'none':
+        return None
+    base = codec.lower().split('.')[0]
+    return _CODEC_ALIASES.get(base, base)
+
+
+def plan_container(info, policy):
+    """
+    Контейнер элемента при политике policy ("mp4" или "compatible") по форматам,
+    выбранным в его метаданных. Возвращает (container, remux): remux = True, если
+    загрузку одним файлом приходится переписывать в другой контейнер.
+    """
+    formats = info.get('requested_formats') or [info]
+    if len(formats) > 1:
+        if policy != 'compatible':
+            return 'mp4', False
+        codecs = {_codec_family(f.get(key)) for f in formats for key in ('vcodec', 'acodec')} - {None}
+        for container in ('mp4', 'webm'):
+            if codecs <= CONTAINER_CODECS[container]:
+                return container, False
+        return 'mkv', False
+    ext = info.get('ext') or 'mp4'
+    target = ext if policy == 'compatible' and ext in NATIVE_CONTAINERS else 'mp4'
+    return target, target != ext
+
+
+def container_args(cfg):
+    """Аргументы --merge-output-format / --remux-video для downloads.container."""
+    if cfg["downloads"].get("container", "mp4") == "compatible":
+        return ['--merge-output-format', 'mp4/webm/mkv', '--remux-video', COMPATIBLE_REMUX_RULES]
+    return ['--merge-output-format', 'mp4', '--remux-video', 'mp4']
+
+
+def account_container_plan(filepath, policy):
+    """Учитывает готовый файл, который политика "mp4" переписала бы, а policy оставила как есть."""
+    if policy != 'compatible':
+        return
+    try:
+        with open(os.path.splitext(filepath)[0] + '.info.json', 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        size = os.path.getsize(filepath)
+    except (OSError, ValueError):
+        return
+    if plan_container(info, 'mp4')[1] and not plan_container(info, policy)[1]:
+        with _PLANNER_LOCK:
+            _PLANNER_STATS['kept'] += 1
+            _PLANNER_STATS['bytes'] += size
+
+
+def convert_thumbnail(ffmpeg, src, dst):
+    """Конвертирует обложку в JPEG: через Pillow в процессе, иначе через ffmpeg. Возвращает успех."""
+    if PIL_AVAILABLE:
+        try:
+            with Image.open(src) as image:
+                image.convert('RGB').save(dst, 'JPEG', quality=90)
+            with _PLANNER_LOCK:
+                _PLANNER_STATS['thumbnails'] += 1
+            return True
+        except (OSError, ValueError):
+            pass
+    result = subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', src, dst],
+                            capture_output=True, text=True)
+    return result.returncode == 0
+
+
+def reset_container_stats():
+    with _PLANNER_LOCK:
+        _PLANNER_STATS.update(kept=0, bytes=0, thumbnails=0)
+
+
+def container_savings_summary():
+    """Одна строка о перезаписях, которых удалось избежать за запуск, или None."""
+    with _PLANNER_LOCK:
+        kept, size, thumbnails = _PLANNER_STATS['kept'], _PLANNER_STATS['bytes'], _PLANNER_STATS['thumbnails']
+    if not kept and not thumbnails:
+        return None
+    seconds = size / REMUX_COPY_RATE + thumbnails * THUMBNAIL_FFMPEG_SECONDS
+    return (f"Без перезаписи: файлов {kept}, {format_size(size)}; "
+            f"обложек сконвертировано в процессе: {thumbnails} (сэкономлено ≈{format_time(seconds)} работы ffmpeg)")
+
+# ── Кэш cookies браузера ───────────────────────────────────────
+# С --cookies-from-browser каждый запуск yt-dlp открывает и расшифровывает
+# базу cookies браузера. Вместо этого cookies один раз экспортируются в файл
+# формата Netscape (доступ только владельцу), который все запуски получают
+# через --cookies. Экспорт повторяется, когда база браузера меняется или
+# YouTube отвечает 403 / проверкой на бота.
+
+# Срок жизни кэша, если базу cookies браузера найти не удалось
+COOKIE_CACHE_MAX_AGE = 12 * 3600
+# Открытый браузер постоянно трогает базу: повторный экспорт не чаще этого
+COOKIE_CACHE_MIN_INTERVAL = 600
+
+# Корни профилей браузеров; базы cookies ищутся на один-два уровня ниже
+_COOKIE_DB_ROOTS = {
+    'linux': {
+        'firefox': ['~/.mozilla/firefox', '~/snap/firefox/common/.mozilla/firefox',
+                    '~/.var/app/org.mozilla.firefox/.mozilla/firefox'],
+        'chrome': ['~/.config/google-chrome'],
+        'chromium': ['~/.config/chromium', '~/snap/chromium/common/chromium'],
+        'brave': ['~/.config/BraveSoftware/Brave-Browser'],
+        'edge': ['~/.config/microsoft-edge'],
+        'opera': ['~/.config/opera'],
+        'vivaldi': ['~/.config/vivaldi'],
+    },
+    'darwin': {
+        'firefox': ['~/Library/Application Support/Firefox/Profiles'],
+        'chrome': ['~/Library/Application Support/Google/Chrome'],
+        'chromium': ['~/Library/Application Support/Chromium'],
+        'brave': ['~/Library/Application Support/BraveSoftware/Brave-Browser'],
+        'edge': ['~/Library/Application Support/Microsoft Edge'],
+        'opera': ['~/Library/Application Support/com.operasoftware.Opera'],
+        'vivaldi': ['~/Library/Application Support/Vivaldi'],
+        'safari': ['~/Library/Containers/com.apple.Safari/Data/Library/Cookies', '~/Library/Cookies'],
+    },
+    'win32': {
+        'firefox': ['%APPDATA%/Mozilla/Firefox/Profiles'],
+        'chrome': ['%LOCALAPPDATA%/Google/Chrome/User Data'],
+        'chromium': ['%LOCALAPPDATA%/Chromium/User Data'],
+        'brave': ['%LOCALAPPDATA%/BraveSoftware/Brave-Browser/User Data'],
+        'edge': ['%LOCALAPPDATA%/Microsoft/Edge/User Data'],
+        'opera': ['%APPDATA%/Opera Software/Opera Stable'],
+        'vivaldi': ['%LOCALAPPDATA%/Vivaldi/User Data'],
+    },
+}
+
+_COOKIE_DB_NAMES = {'firefox': 'cookies.sqlite', 'safari': 'Cookies.binarycookies'}
+
+# Путь к экспортированному файлу cookies после prepare_cookie_cache()
+_COOKIE_CACHE = None
+# Потоки планировщика могут поймать ошибку cookies одновременно
+_COOKIE_LOCK = threading.Lock()
+
+
+def _browser_cookie_dbs(browser):
+    """Файлы баз cookies для браузера в формате yt-dlp (BROWSER[+KEYRING][:PROFILE][::CONTAINER])."""
+    name, _, profile = browser.partition(':')
+    name = name.split('+')[0].strip().lower()
+    profile = profile.split('::')[0]
+    if profile and os.path.isdir(os.path.expanduser(profile)):
+        roots = [os.path.expanduser(profile)]
+    else:
+        platform = 'linux' if sys.platform.startswith('linux') else sys.platform
+        roots = [os.path.expandvars(os.path.expanduser(r))
+                 for r in _COOKIE_DB_ROOTS.get(platform, {}).get(name, [])]
+    db_name = _COOKIE_DB_NAMES.get(name, 'Cookies')
+    found = []
+    for root in roots:
+        for pattern in (db_name, os.path.join('*', db_name), os.path.join('*', 'Network', db_name),
+                        os.path.join('Network', db_name)):
+            found.extend(glob.glob(os.path.join(glob.escape(root), pattern)))
+    return found
+
+
+def _cookie_db_mtime(browser):
+    """Наибольший mtime_ns баз cookies браузера или None, если они не найдены."""
+    mtimes = []
+    for path in _browser_cookie_dbs(browser):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            pass
+    return max(mtimes) if mtimes else None
+
+
+def export_browser_cookies(browser, dest, logger=None):
+    """
+    Экспортирует cookies браузера в файл Netscape, доступный только владельцу.
+    yt-dlp сохраняет cookies в файл --cookies при выходе, поэтому хватает запуска без URL.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.cookies_', dir=os.path.dirname(os.path.abspath(dest)))
+    tmp_path = os.path.join(tmp_dir, 'cookies.txt')
+    try:
+        try:
+            subprocess.run(
+                ['yt-dlp', '--cookies-from-browser', browser, '--cookies', tmp_path],
+                capture_output=True, text=True, timeout=120,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            if logger:
+                logger.warning(f"Не удалось экспортировать cookies: {e}")
+            return False
+        try:
+            with open(tmp_path, 'r', encoding='utf-8') as f:
+                header = f.readline()
+        except OSError:
+            header = ''
+        if 'Netscape HTTP Cookie File' not in header:
+            if logger:
+                logger.warning(f"Экспорт cookies из {browser} не создал файл cookies")
+            return False
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, dest)
+        return True
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _cookie_cache_path(cfg, script_dir):
+    raw = cfg["cookies"].get("cache_file", "")
+    if not raw:
+        return None
+    return raw if os.path.isabs(raw) else os.path.join(script_dir, raw)
+
+
+def _cookie_cache_fresh(path, browser, db_mtime):
+    try:
+        with open(path + '.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        exported = os.path.getmtime(path)
+    except (OSError, ValueError):
+        return False
+    if meta.get('browser') != browser:
+        return False
+    age = time.time() - exported
+    if age < COOKIE_CACHE_MIN_INTERVAL:
+        return True
+    if db_mtime is None:
+        return age < COOKIE_CACHE_MAX_AGE
+    return meta.get('db_mtime_ns') == db_mtime
+
+
+def refresh_cookie_cache(cfg, script_dir, logger=None, force=False):
+    """
+    Проверяет актуальность экспортированного файла cookies и возвращает его путь.
+    None, если кэш отключён или экспорт не удался — тогда используется
+    --cookies-from-browser.
+    """
+    global _COOKIE_CACHE
+    with _COOKIE_LOCK:
+        path = _cookie_cache_path(cfg, script_dir)
+        if path is None:
+            _COOKIE_CACHE = None
+            return None
+        browser = cfg["cookies"]["browser"]
+        db_mtime = _cookie_db_mtime(browser)
+        if force or not _cookie_cache_fresh(path, browser, db_mtime):
+            print(colored(f"Экспорт cookies {browser} в {os.path.basename(path)}...", Fore.CYAN))
+            if not export_browser_cookies(browser, path, logger):
+                print(colored(f"  ⚠ Экспорт cookies не удался, используется --cookies-from-browser {browser}", Fore.YELLOW))
+                _COOKIE_CACHE = None
+                return None
+            with open(path + '.json', 'w', encoding='utf-8') as f:
+                json.dump({'browser': browser, 'db_mtime_ns': db_mtime}, f)
+            if logger:
+                logger.info(f"Cookies экспортированы из {browser} в {path}")
+        _COOKIE_CACHE = path
+        return path
+
+
+def prepare_cookie_cache(cfg, script_dir, logger=None):
+    """Экспортирует cookies браузера один раз за запуск, если они берутся из браузера."""
+    global _COOKIE_CACHE
+    _COOKIE_CACHE = None
+    mode = cfg["cookies"]["mode"]
+    cookies_path = os.path.join(script_dir, cfg["cookies"]["cookies_file"])
+    if mode == "browser" or (mode == "file" and not os.path.isfile(cookies_path)):
+        refresh_cookie_cache(cfg, script_dir, logger)
+
+
+def is_cookie_error(line_lower):
+    """403 и проверка на бота обычно означают устаревшие cookies."""
+    return 'http error 403' in line_lower or ('sign in' in line_lower and 'bot' in line_lower)
+
+
+def _browser_cookie_args(cfg, script_dir, logger=None):
+    if _COOKIE_CACHE is not None:
+        path = refresh_cookie_cache(cfg, script_dir, logger)
+        if path:
+            return ["--cookies", path]
+    return ["--cookies-from-browser", cfg["cookies"]["browser"]]
+
+# ── Кэш yt-dlp (remote components, данные player/nsig) ─────────
+# Все запуски делят один --cache-dir рядом со скриптом. Он прогревается
+# один раз за запуск (не чаще cache.warm_interval_hours) пробным извлечением,
+# которое скачивает player и компоненты ejs, а каждый прогрев записывает
+# SHA-256 файлов кэша и версию yt-dlp. Следующий запуск с той же версией и
+# целыми файлами не ходит в сеть, поэтому сбой GitHub больше не тормозит
+# каждую загрузку.
+
+COMPONENT_MANIFEST = 'components.manifest.json'
+
+
+def _build_cache_args(cfg, script_dir):
+    """Аргументы --cache-dir для каждого запуска yt-dlp ([] — расположение yt-dlp по умолчанию)."""
+    cache_dir = _ytdlp_cache_dir(cfg, script_dir)
+    return ['--cache-dir', cache_dir] if cache_dir else []
+
+
+def _ytdlp_cache_dir(cfg, script_dir):
+    raw = cfg["cache"].get("dir", "")
+    if not raw:
+        return None
+    return raw if os.path.isabs(raw) else os.path.join(script_dir, raw)
+
+
+def _ytdlp_version():
+    try:
+        result = subprocess.run(['yt-dlp', '--version'], capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def _hash_cache_files(cache_dir):
+    """{относительный путь: sha256} всех файлов кэша, кроме манифеста."""
+    hashes = {}
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, cache_dir)
+            if rel == COMPONENT_MANIFEST:
+                continue
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(FINGERPRINT_BUFFER_SIZE), b''):
+                    h.update(chunk)
+            hashes[rel.replace(os.sep, '/')] = h.hexdigest()
+    return hashes
+
+
+def verify_component_cache(cache_dir, version, max_age):
+    """
+    Проверяет прогретый кэш. Возвращает (ok, причина); файлы, не совпадающие
+    с манифестом, удаляются, чтобы следующий прогрев скачал их заново.
+    """
+    try:
+        with open(os.path.join(cache_dir, COMPONENT_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False, 'ещё не прогрет'
+    if manifest.get('yt_dlp') != version:
+        return False, f"yt-dlp обновился ({manifest.get('yt_dlp')} -> {version})"
+    if time.time() - manifest.get('warmed_at', 0) > max_age:
+        return False, 'плановое обновление'
+
+    current = _hash_cache_files(cache_dir)
+    damaged = [rel for rel, digest in manifest.get('files', {}).items() if current.get(rel) != digest]
+    for rel in damaged:
+        _remove_quietly(os.path.join(cache_dir, rel))
+    if damaged:
+        return False, f"изменено или отсутствует файлов кэша: {len(damaged)}"
+    return True, 'ok'
+
+
+def warm_component_cache(cfg, script_dir, cache_dir, version, logger=None):
+    """Выполняет одно пробное извлечение в кэш и записывает, что было скачано."""
+    os.makedirs(cache_dir, exist_ok=True)
+    cmd = [
+        'yt-dlp',
+        '--cache-dir', cache_dir,
+        '--remote-components', 'ejs:github',
+        '--skip-download',
+        '--no-warnings',
+        '--quiet',
+        cfg["cache"]["probe_url"],
+    ]
+    try:
+        result = subprocess.run(cmd, cwd=script_dir, capture_output=True, text=True, timeout=300)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        if logger:
+            logger.warning(f"Не удалось прогреть кэш yt-dlp: {e}")
+        return False
+    if result.returncode != 0:
+        if logger:
+            logger.warning(f"Не удалось прогреть кэш yt-dlp: {result.stderr.strip()[:300]}")
+        return False
+
+    manifest = {'yt_dlp': version, 'warmed_at': time.time(), 'files': _hash_cache_files(cache_dir)}
+    with open(os.path.join(cache_dir, COMPONENT_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    return True
+
+
+def prepare_component_cache(cfg, script_dir, logger=None):
+    """Проверяет общий кэш yt-dlp один раз за запуск и при необходимости прогревает его."""
+    cache_dir = _ytdlp_cache_dir(cfg, script_dir)
+    if cache_dir is None:
+        return
+    version = _ytdlp_version()
+    max_age = cfg["cache"]["warm_interval_hours"] * 3600
+    ok, reason = verify_component_cache(cache_dir, version, max_age)
+    if ok:
+        return
+    print(colored(f"Прогрев кэша yt-dlp ({reason})...", Fore.CYAN))
+    if warm_component_cache(cfg, script_dir, cache_dir, version, logger):
+        print(colored("✓ Кэш yt-dlp готов", Fore.GREEN))
+        if logger:
+            logger.info(f"Кэш yt-dlp прогрет: {cache_dir} ({reason})")
+    else:
+        print(colored("  ⚠ Прогрев кэша yt-dlp не удался, загрузки скачают компоненты сами", Fore.YELLOW))
+
+
+# ── Промежуточный каталог (staging) ────────────────────────────
+# Если задан staging.dir, yt-dlp держит все незавершенное (фрагменты, .part,
+# отдельные потоки до склейки, результаты ремукса и встраивания) на быстром
+# scratch-диске через --paths temp:, а финальный шаг MoveFiles делает одно
+# последовательное копирование в библиотеку (или rename на том же устройстве).
+# Для абсолютного --output параметр --paths игнорируется, поэтому шаблон
+# делается относительным к --paths home:. На обеих сторонах должно оставаться
+# staging.min_free_gb свободного места, иначе запуск качает прямо в
+# библиотеку. Файлы scratch, не менявшиеся staging.stale_hours, удаляются при
+# старте; более свежие остаются, чтобы yt-dlp мог их докачать.
+
+_STAGING_WARNED = set()
+
+
+def _staging_dir(cfg, script_dir):
+    raw = cfg["staging"].get("dir", "")
+    if not raw:
+        return None
+    raw = os.path.expanduser(raw)
+    return raw if os.path.isabs(raw) else os.path.join(script_dir, raw)
+
+
+def _free_bytes(path):
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
+
+
+def _warn_staging_once(key, msg, logger=None):
+    if key in _STAGING_WARNED:
+        return
+    _STAGING_WARNED.add(key)
+    print(colored(f"⚠ {msg}", Fore.YELLOW))
+    if logger:
+        logger.warning(msg)
+
+
+def _build_staging_args(cfg, script_dir, downloads_dir, logger=None):
+    """Аргументы --paths home:/temp: или [], если staging выключен или на одной из сторон мало места."""
+    staging = _staging_dir(cfg, script_dir)
+    if staging is None:
+        return []
+    try:
+        os.makedirs(staging, exist_ok=True)
+        os.makedirs(downloads_dir, exist_ok=True)
+    except OSError as e:
+        _warn_staging_once('mkdir', f"Каталог scratch недоступен ({e}), загрузка идет прямо в библиотеку", logger)
+        return []
+    min_free = cfg["staging"].get("min_free_gb", 10) * 1024 ** 3
+    for key, path, label in (('scratch', staging, 'каталоге scratch'), ('library', downloads_dir, 'библиотеке')):
+        free = _free_bytes(path)
+        if free is not None and free < min_free:
+            _warn_staging_once(key, f"Свободно меньше {format_size(min_free)} в {label} "
+                                    f"({format_size(free)}): staging пропущен", logger)
+            return []
+    return ['--paths', f'home:{downloads_dir}', '--paths', f'temp:{staging}']
+
+
+def cleanup_staging(cfg, script_dir, logger=None):
+    """Удаляет файлы scratch, не менявшиеся staging.stale_hours. Возвращает (файлов, байт) удалено."""
+    staging = _staging_dir(cfg, script_dir)
+    if staging is None or not os.path.isdir(staging):
+        return 0, 0
+    cutoff = time.time() - cfg["staging"].get("stale_hours", 24) * 3600
+    removed = freed = 0
+    for root, dirs, files in os.walk(staging, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+                if st.st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+                    freed += st.st_size
+            except OSError:
+                pass
+        if root != staging:
+            try:
+                os.rmdir(root)  # удается только для пустой папки
+            except OSError:
+                pass
+    if removed:
+        msg = f"Очистка scratch: удалено брошенных файлов {removed} ({format_size(freed)})"
+        print(colored(msg, Fore.CYAN))
+        if logger:
+            logger.info(msg)
+    return removed, freed
+
+
+# ── Допуск по свободному месту ─────────────────────────────────
+# Раньше переполненный диск проявлялся только как "No space left" посреди
+# склейки, а classify_error() считает это фатальной ошибкой. Теперь каждый
+# элемент проходит проверку допуска до начала загрузки: yt-dlp запускает
+# --exec before_dl:<этот скрипт> --admission-check с filesize/filesize_approx
+# выбранных форматов (или длительность x битрейт). Склеиваемые элементы
+# считаются дважды: отдельные потоки плюс итоговый файл. Элемент, после
+# которого свободного места осталось бы меньше admission.min_free_gb,
+# отклоняется с кодом ADMISSION_EXIT_CODE до записи первого байта. Тогда
+# супервизор приостанавливает допуск, пока место не освободится, и повторяет
+# URL; уже скачанное пропускает архив. Перед каждым URL порог тоже проверяется.
+#
+# Срезы планировщика, отложенная постобработка и промежуточная папка пишут,
+# пока качаются другие элементы, поэтому одного свободного места мало.
+# Допущенный элемент резервирует свою оценку в журнале (admission.ledger_file,
+# SQLite рядом с архивом), общем для хуков и супервизора. Элемент допускается,
+# пока свободно - резервы - need остаётся выше порога. Каждый запуск yt-dlp —
+# один владелец резервов (ADMISSION_OWNER_ENV): он пишет по одному элементу,
+# поэтому его следующий хук заменяет прежний резерв, а остаток снимает
+# супервизор по окончании запуска. Задание постобработки держит размер своего
+# файла, пока переписанная копия его не заменит.
+
+ADMISSION_EXIT_CODE = 75
+ADMISSION_FIELDS = '%(id)q %(filesize,filesize_approx)s %(duration)s %(tbr)s %(requested_formats&2|1)s'
+ADMISSION_NEED_RE = re.compile(r'need=(\d+)')
+ADMISSION_OWNER_ENV = 'YT_DOWNLOAD_ADMISSION_OWNER'
+ADMISSION_RESERVATION_HOURS = 24
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def estimate_item_bytes(filesize, duration, tbr, factor):
+    """Место на диске для элемента по значениям, которые yt-dlp передает хуку допуска ('NA', если неизвестно)."""
+    size = _to_number(filesize)
+    if not size:
+        seconds, kbps = _to_number(duration), _to_number(tbr)
+        size = seconds * kbps * 1000 / 8
+    return int(size * max(1.0, _to_number(factor)))
+
+
+def _admission_paths(cfg, script_dir):
+    paths = [os.path.join(script_dir, cfg["downloads"]["output_dir"])]
+    staging = _staging_dir(cfg, script_dir)
+    if staging:
+        paths.append(staging)
+    return paths
+
+
+def check_disk_space(cfg, script_dir, need=0, reserved=0):
+    """
+    (fits, минимум свободных байт за вычетом резерва, порог): fits, если после need
+    байт и зарезервированного другими элементами везде остается min_free_gb.
+    """
+    watermark = cfg["admission"].get("min_free_gb", 20) * 1024 ** 3
+    frees = [free for free in map(_free_bytes, _admission_paths(cfg, script_dir)) if free is not None]
+    if watermark <= 0 or not frees:
+        return True, None, watermark
+    available = min(frees) - reserved
+    return available - need >= watermark, available, watermark
+
+
+def ledger_path(cfg, script_dir):
+    """Путь журнала резервов или None, если допуск выключен."""
+    if cfg["admission"].get("min_free_gb", 20) <= 0:
+        return None
+    return os.path.join(script_dir, cfg["admission"].get("ledger_file", "disk_reservations.sqlite"))
+
+
+def open_reservation_ledger(path):
+    """Открыть (или создать) журнал; автокоммит, транзакции явные."""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS reservations ("
+        " owner TEXT NOT NULL, item TEXT NOT NULL, bytes INTEGER NOT NULL, ts REAL NOT NULL,"
+        " PRIMARY KEY (owner, item))")
+    return conn
+
+
+def reserved_bytes(conn, now=None):
+    """Зарезервированные и не истекшие байты (упавший запуск оставляет строки на ADMISSION_RESERVATION_HOURS)."""
+    now = now or time.time()
+    return conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE ts > ?",
+                        (now - ADMISSION_RESERVATION_HOURS * 3600,)).fetchone()[0]
+
+
+def admit_item(cfg, script_dir, owner, item, need):
+    """
+    Допускает item и резервирует need байт в одной пишущей транзакции, чтобы
+    параллельные хуки видели друг друга. Прежний резерв владельца снимается:
+    его запуск тот элемент закончил. Возвращает check_disk_space() решения.
+    """
+    path = ledger_path(cfg, script_dir)
+    if path is None:
+        return check_disk_space(cfg, script_dir, need)
+    try:
+        conn = open_reservation_ledger(path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            conn.execute("DELETE FROM reservations WHERE owner = ? OR ts <= ?",
+                         (owner, now - ADMISSION_RESERVATION_HOURS * 3600))
+            result = check_disk_space(cfg, script_dir, need, reserved_bytes(conn, now))
+            if result[0]:
+                conn.execute("INSERT OR REPLACE INTO reservations (owner, item, bytes, ts) VALUES (?, ?, ?, ?)",
+                             (owner, item, need, now))
+            conn.execute("COMMIT")
+            return result
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return check_disk_space(cfg, script_dir, need)
+
+
+def hold_reservation(path, owner, item, size):
+    """Резервирует size байт без решения о допуске (копии постобработки)."""
+    if path is None or size <= 0:
+        return
+    try:
+        conn = open_reservation_ledger(path)
+        try:
+            conn.execute("INSERT OR REPLACE INTO reservations (owner, item, bytes, ts) VALUES (?, ?, ?, ?)",
+                         (owner, item, size, time.time()))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def release_reservations(path, owner, item=None):
+    """Снимает резервы owner (только резерв item, если он задан)."""
+    if path is None or not os.path.exists(path):
+        return
+    try:
+        conn = open_reservation_ledger(path)
+        try:
+            if item is None:
+                conn.execute("DELETE FROM reservations WHERE owner = ?", (owner,))
+            else:
+                conn.execute("DELETE FROM reservations WHERE owner = ? AND item = ?", (owner, item))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def outstanding_reservations(cfg, script_dir):
+    """Байты, которые журнал держит за элементами в процессе записи (0 без журнала)."""
+    path = ledger_path(cfg, script_dir)
+    if path is None or not os.path.exists(path):
+        return 0
+    try:
+        conn = open_reservation_ledger(path)
+        try:
+            return reserved_bytes(conn)
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return 0
+
+
+def new_admission_owner(tag=None):
+    """Владелец резервов одного запуска yt-dlp этого процесса; по умолчанию tag уникален."""
+    return f"{os.getpid()}:{tag if tag is not None else time.monotonic_ns()}"
+
+
+def admission_env(owner):
+    """Окружение запуска yt-dlp, хуки допуска которого резервируют от имени owner."""
+    return {**os.environ, ADMISSION_OWNER_ENV: owner}
+
+
+def wait_for_disk_space(cfg, script_dir, need=0, logger=None):
+    """Приостанавливает допуск, пока need байт не поместятся выше порога. False после admission.max_wait_hours."""
+    fits, free, watermark = check_disk_space(cfg, script_dir, need, outstanding_reservations(cfg, script_dir))
+    if fits:
+        return True
+    msg = (f"⏸ Допуск приостановлен: свободно {format_size(free)}, "
+           f"нужно {format_size(need)} + порог {format_size(watermark)}")
+    print(colored(msg, Fore.YELLOW))
+    if logger:
+        logger.warning(msg)
+    max_wait = cfg["admission"].get("max_wait_hours", 12) * 3600
+    started = time.time()
+    while not fits:
+        if time.time() - started >= max_wait:
+            msg = "✗ Место на диске не освободилось вовремя"
+            print(colored(msg, Fore.RED))
+            if logger:
+                logger.error(msg)
+            return False
+        time.sleep(cfg["admission"].get("check_interval", 60))
+        fits, free, watermark = check_disk_space(cfg, script_dir, need, outstanding_reservations(cfg, script_dir))
+    msg = f"▶ Допуск возобновлен: свободно {format_size(free)}"
+    print(colored(msg, Fore.GREEN))
+    if logger:
+        logger.info(msg)
+    return True
+
+
+def is_admission_error(line_lower):
+    """True для строк об элементе, отклоненном хуком допуска."""
+    return '[admission]' in line_lower or f'error code {ADMISSION_EXIT_CODE}' in line_lower
+
+
+def _shell_join(args):
+    return subprocess.list2cmdline(args) if os.name == 'nt' else ' '.join(shlex.quote(a) for a in args)
+
+
+def _build_admission_args(cfg):
+    """Хук допуска --exec before_dl: или [], если admission.min_free_gb равен 0."""
+    if cfg["admission"].get("min_free_gb", 20) <= 0:
+        return []
+    hook = [sys.executable, os.path.abspath(__file__), '--admission-check']
+    # --exec — шаблон вывода: экранируем литеральный '%'
+    command = _shell_join([a.replace('%', '%%') for a in hook])
+    return ['--exec', f'before_dl:{command} {ADMISSION_FIELDS}']
+
+
+def admission_hook_values(argv):
+    """
+    Пять значений хука, если argv — вызов --admission-check, иначе None.
+    Читается до argparse: ID видео может начинаться с '-' и сойти за опцию.
+    """
+    if len(argv) == 7 and argv[1] == '--admission-check':
+        return argv[2:]
+    return None
+
+
+def run_admission_check(values):
+    """Тело --admission-check: 0, если элемент помещается, иначе ADMISSION_EXIT_CODE."""
+    video_id, filesize, duration, tbr, factor = values
+    cfg = load_config()
+    script_dir = os.path.dirname(os.path.abspath(__file__)) or os.getcwd()
+    need = estimate_item_bytes(filesize, duration, tbr, factor)
+    fits, free, watermark = admit_item(cfg, script_dir, os.environ.get(ADMISSION_OWNER_ENV, ''), video_id, need)
+    if fits:
+        return 0
+    print(f"ERROR: [admission] {video_id}: not enough disk space "
+          f"(need={need}, free {format_size(free)}, watermark {format_size(watermark)})", flush=True)
+    return ADMISSION_EXIT_CODE
+
+
 def _build_cookie_args(cfg: dict, script_dir: str, logger=None):
     """Build yt-dlp cookie CLI args based on config.
 
@@ -139,7 +1738,7 @@ def _build_cookie_args(cfg: dict, script_dir: str, logger=None):
     cookie_file = cfg["cookies"]["cookies_file"]
 
     if mode == "browser":
-        return ["--cookies-from-browser", browser]
+        return _browser_cookie_args(cfg, script_dir, logger)
 
     if mode == "file":
         cookies_path = os.path.join(script_dir, cookie_file)
@@ -149,7 +1748,7 @@ def _build_cookie_args(cfg: dict, script_dir: str, logger=None):
         print(colored(f"    Fallback to browser mode ({browser})", Fore.YELLOW))
         if logger:
             logger.warning(f"Cookies file not found: {cookie_file}, fallback to browser mode ({browser})")
-        return ["--cookies-from-browser", browser]
+        return _browser_cookie_args(cfg, script_dir, logger)
 
     # mode == "off"
     return []
@@ -208,6 +1807,1095 @@ def is_playlist_url(url):
     ]
     return any(re.search(pattern, url) for pattern in playlist_patterns)
 
+# ── Архив загрузок ─────────────────────────────────────────────
+# Файл --download-archive yt-dlp: по строке "<extractor> <id>" на видео.
+
+# "Название [VIDEO_ID]" — имя файла по шаблону вывода
+ARCHIVE_ID_RE = re.compile(r'\[([A-Za-z0-9_-]{11})\]$')
+
+
+def parse_archive_line(line):
+    """(extractor, id) для строки архива или None для пустых/битых строк."""
+    parts = line.split()
+    if len(parts) < 2:
+        return None
+    return parts[0], parts[1]
+
+
+def read_archive_entries(archive_file):
+    """Записи архива в порядке файла, без повторов."""
+    entries = {}
+    if os.path.exists(archive_file):
+        with open(archive_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = parse_archive_line(line)
+                if entry:
+                    entries[entry] = None
+    return list(entries)
+
+
+def _write_archive_temp(archive_file, entries):
+    """Пишет записи во временный файл рядом с архивом; возвращает (tmp_path, count)."""
+    fd, tmp_path = tempfile.mkstemp(prefix='.archive_', dir=os.path.dirname(os.path.abspath(archive_file)))
+    count = 0
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as f:
+            for extractor, video_id in entries:
+                f.write(f"{extractor} {video_id}\n")
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    return tmp_path, count
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_archive(archive_file, entries):
+    """Атомарная запись архива: временный файл рядом, fsync, переименование. Возвращает число записей."""
+    tmp_path, count = _write_archive_temp(archive_file, entries)
+    try:
+        os.replace(tmp_path, archive_file)
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    return count
+
+
+# Сколько записей сортируется в памяти за раз при слиянии/сжатии; большие
+# входы сбрасываются в отсортированные временные файлы и сливаются,
+# поэтому память ограничена.
+ARCHIVE_RUN_SIZE = 200_000
+
+
+def _spill_run(entries):
+    run = tempfile.TemporaryFile('w+', encoding='utf-8', newline='\n')
+    run.writelines(f"{extractor} {video_id}\n" for extractor, video_id in entries)
+    run.seek(0)
+    return run
+
+
+def _sorted_unique_entries(line_sources, stack, run_size=ARCHIVE_RUN_SIZE):
+    """
+    Отдаёт записи всех источников строк, отсортированные по (extractor, id), без повторов.
+    Временные файлы регистрируются в stack и закрываются вместе с ним.
+    """
+    runs = []
+    chunk = set()
+    for lines in line_sources:
+        for line in lines:
+            entry = parse_archive_line(line)
+            if entry:
+                chunk.add(entry)
+                if len(chunk) >= run_size:
+                    run = stack.enter_context(_spill_run(sorted(chunk)))
+                    runs.append(parse_archive_line(raw) for raw in run)
+                    chunk = set()
+    runs.append(iter(sorted(chunk)))
+
+    previous = None
+    for entry in heapq.merge(*runs):
+        if entry != previous:
+            yield entry
+            previous = entry
+
+
+def _read_lines(path, end=None):
+    """Строки файла; с end — только целиком лежащие до этого смещения."""
+    with open(path, 'rb') as f:
+        pos = 0
+        for raw in f:
+            pos += len(raw)
+            if end is not None and pos > end:
+                break
+            yield raw.decode('utf-8', errors='replace')
+
+
+def merge_archives(sources, dest, run_size=ARCHIVE_RUN_SIZE):
+    """k-way слияние архивов в dest: сортировка, без повторов по (extractor, id), атомарно."""
+    with ExitStack() as stack:
+        entries = _sorted_unique_entries((_read_lines(p) for p in sources), stack, run_size)
+        return write_archive(dest, entries)
+
+
+def _complete_lines_end(f, size):
+    """Смещение сразу за последним переводом строки не дальше size (запись может быть не дописана)."""
+    start = max(0, size - 4096)
+    f.seek(start)
+    cut = f.read(size - start).rfind(b'\n')
+    return start + cut + 1 if cut >= 0 else 0
+
+
+def _lock_archive(f):
+    # yt-dlp берёт ту же блокировку flock, когда дописывает архив
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_archive(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def compact_archive(archive_file, extra_sources=(), run_size=ARCHIVE_RUN_SIZE, settle=0.2):
+    """
+    Сортирует и удаляет повторы в рабочем архиве на месте, при желании вливая в него другие архивы.
+    Основная работа идёт без блокировок; блокировку архива yt-dlp держат только
+    дозапись строк, добавленных за это время, и переименование.
+    Возвращает {written, caught_up}: отсортированные записи и строки, дописанные во время работы.
+    """
+    stats = {'written': 0, 'caught_up': 0}
+    with open(archive_file, 'rb') as live, ExitStack() as stack:
+        end = _complete_lines_end(live, os.fstat(live.fileno()).st_size)
+        sources = [_read_lines(archive_file, end)] + [_read_lines(p) for p in extra_sources]
+        tmp_path, stats['written'] = _write_archive_temp(
+            archive_file, _sorted_unique_entries(sources, stack, run_size))
+
+        try:
+            _lock_archive(live)
+            try:
+                live.seek(end)
+                tail = live.read()
+                if tail:
+                    with open(tmp_path, 'ab') as out:
+                        out.write(tail if tail.endswith(b'\n') else tail + b'\n')
+                    end += len(tail)
+                    stats['caught_up'] += tail.count(b'\n')
+                if os.name == 'nt':
+                    # Windows не даёт переименовать поверх открытого файла
+                    live.close()
+                os.replace(tmp_path, archive_file)
+            finally:
+                if not live.closed:
+                    _unlock_archive(live)
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+
+        if not live.closed:
+            # Писатель, открывший старый файл перед переименованием, допишет именно в него
+            time.sleep(settle)
+            live.seek(end)
+            late = live.read()
+            if late:
+                with open(archive_file, 'ab') as out:
+                    out.write(late if late.endswith(b'\n') else late + b'\n')
+                stats['caught_up'] += late.count(b'\n')
+
+    return stats
+
+
+def _archive_scan_dir(dirpath):
+    """ID видеофайлов одной папки: из суффикса [id], иначе из .info.json рядом."""
+    found, fallback, subdirs = set(), [], []
+    with os.scandir(dirpath) as it:
+        entries = list(it)
+    names = {e.name for e in entries}
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not entry.name.startswith('.'):
+                subdirs.append(entry.path)
+            continue
+        stem, ext = os.path.splitext(entry.name)
+        if ext.lower() not in CATALOG_MEDIA_EXTENSIONS:
+            continue
+        match = ARCHIVE_ID_RE.search(stem)
+        if match:
+            found.add(('youtube', match.group(1)))
+        elif stem + '.info.json' in names:
+            fallback.append(os.path.join(dirpath, stem + '.info.json'))
+    return found, fallback, subdirs
+
+
+def _archive_entry_from_info(info_json):
+    with open(info_json, 'r', encoding='utf-8') as f:
+        info = json.load(f)
+    if not info.get('id'):
+        return None
+    extractor = info.get('extractor_key') or info.get('extractor') or 'youtube'
+    return extractor.lower(), info['id']
+
+
+def _safe_archive_entry(info_json):
+    try:
+        return _archive_entry_from_info(info_json)
+    except (OSError, ValueError):
+        return None
+
+
+def scan_library_ids(downloads_dir, workers=0, logger=None):
+    """Записи архива для всех видео в downloads_dir; папки читаются параллельно."""
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+    found = set()
+    fallback = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_archive_scan_dir, downloads_dir)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    ids, infos, subdirs = future.result()
+                except OSError as e:
+                    if logger:
+                        logger.warning(f"  Пересборка архива: не удалось прочитать папку: {e}")
+                    continue
+                found |= ids
+                fallback.extend(infos)
+                pending |= {pool.submit(_archive_scan_dir, d) for d in subdirs}
+
+        for info_json, entry in zip(fallback, pool.map(_safe_archive_entry, fallback)):
+            if entry:
+                found.add(entry)
+            elif logger:
+                logger.warning(f"  Пересборка архива: нет id в {info_json}")
+    return found
+
+
+def rebuild_archive(archive_file, downloads_dir, mode='merge', workers=0, logger=None):
+    """
+    Пересобирает архив загрузок по файлам на диске.
+    mode='merge' сохраняет существующие записи и дописывает найденные на диске;
+    mode='replace' записывает ровно то, что есть на диске.
+    Возвращает {on_disk, added, written, missing}; missing — записи архива,
+    для которых нет файла на диске.
+    """
+    on_disk = scan_library_ids(downloads_dir, workers, logger)
+    existing = read_archive_entries(archive_file)
+    existing_set = set(existing)
+    missing = [entry for entry in existing if entry not in on_disk]
+    added = sorted(on_disk - existing_set)
+
+    if mode == 'replace':
+        entries = sorted(on_disk)
+    else:
+        entries = existing + added
+    write_archive(archive_file, entries)
+    return {'on_disk': len(on_disk), 'added': len(added), 'written': len(entries), 'missing': missing}
+
+# ── Индекс принадлежности к архиву ─────────────────────────────
+# Необязательная (downloads.archive_index) замена множества ID архива.
+# "<archive>.idx" содержит заголовок, фильтр Блума для быстрых отрицательных
+# ответов и отсортированные 16-байтные BLAKE2b-дайджесты "<extractor> <id>"
+# для точной проверки. Файл отображается в память (mmap), поэтому процессы
+# делят его через кэш страниц; строки, дописанные в архив после записи файла,
+# читаются с сохранённого смещения и держатся в памяти, пока их не станет
+# достаточно для слияния.
+
+ARCHIVE_INDEX_MAGIC = b'YTARCIX1'
+# magic, k, count, bloom_bytes, покрытое смещение в архиве, inode архива
+ARCHIVE_INDEX_HEADER = struct.Struct('<8sIQQQQ')
+ARCHIVE_INDEX_HEADER_SIZE = 64
+ARCHIVE_INDEX_DIGEST_SIZE = 16
+ARCHIVE_INDEX_K = 7
+# Бит фильтра Блума на запись при полной ёмкости (~1% ложных срабатываний при k=7);
+# фильтр рассчитан на вдвое большее число записей, чтобы пережить слияния.
+ARCHIVE_INDEX_BITS_PER_ENTRY = 10
+# Сколько дописанных записей держится в памяти до перезаписи файла индекса
+ARCHIVE_INDEX_DELTA_LIMIT = 50_000
+
+
+def archive_digest(extractor, video_id):
+    return hashlib.blake2b(f"{extractor} {video_id}".encode('utf-8'),
+                           digest_size=ARCHIVE_INDEX_DIGEST_SIZE).digest()
+
+
+def _bloom_positions(digest, nbits):
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % nbits for i in range(ARCHIVE_INDEX_K)]
+
+
+def _bloom_add(bloom, digest):
+    for pos in _bloom_positions(digest, len(bloom) * 8):
+        bloom[pos >> 3] |= 1 << (pos & 7)
+
+
+def _new_bloom(count):
+    nbits = max(2 * count, 4096) * ARCHIVE_INDEX_BITS_PER_ENTRY
+    return bytearray((nbits + 7) // 8)
+
+
+def _archive_digests(archive_file, start, end):
+    """Дайджесты полных строк архива между двумя смещениями."""
+    for line in _read_lines_between(archive_file, start, end):
+        entry = parse_archive_line(line)
+        if entry:
+            yield archive_digest(*entry)
+
+
+def _read_lines_between(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for raw in f:
+            pos += len(raw)
+            if pos > end:
+                break
+            yield raw.decode('utf-8', errors='replace')
+
+
+def _iter_digest_file(f):
+    f.seek(0)
+    while True:
+        digest = f.read(ARCHIVE_INDEX_DIGEST_SIZE)
+        if len(digest) < ARCHIVE_INDEX_DIGEST_SIZE:
+            return
+        yield digest
+
+
+def _sorted_unique_digests(digests, stack, run_size=ARCHIVE_RUN_SIZE):
+    """Внешняя сортировка дайджестов порциями по run_size, как при слиянии архивов."""
+    runs = []
+    chunk = set()
+    for digest in digests:
+        chunk.add(digest)
+        if len(chunk) >= run_size:
+            run = stack.enter_context(tempfile.TemporaryFile())
+            run.writelines(sorted(chunk))
+            runs.append(_iter_digest_file(run))
+            chunk = set()
+    runs.append(iter(sorted(chunk)))
+
+    previous = None
+    for digest in heapq.merge(*runs):
+        if digest != previous:
+            yield digest
+            previous = digest
+
+
+def _write_archive_index(index_path, digests, archive_offset, archive_ino, bloom=None):
+    """
+    Записывает отсортированные уникальные дайджесты в новый файл индекса (атомарно).
+    bloom: существующий фильтр, уже содержащий все дайджесты, кроме новых, —
+    используется повторно, если он достаточно велик; новые биты добавляет вызывающий.
+    """
+    with tempfile.TemporaryFile() as ids:
+        count = 0
+        for digest in digests:
+            ids.write(digest)
+            count += 1
+        if bloom is None or len(bloom) * 8 < count * ARCHIVE_INDEX_BITS_PER_ENTRY:
+            bloom = _new_bloom(count)
+            for digest in _iter_digest_file(ids):
+                _bloom_add(bloom, digest)
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.archive_idx_', dir=os.path.dirname(os.path.abspath(index_path)))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                header = ARCHIVE_INDEX_HEADER.pack(ARCHIVE_INDEX_MAGIC, ARCHIVE_INDEX_K, count,
+                                                   len(bloom), archive_offset, archive_ino)
+                out.write(header.ljust(ARCHIVE_INDEX_HEADER_SIZE, b'\0'))
+                out.write(bloom)
+                ids.seek(0)
+                shutil.copyfileobj(ids, out, FINGERPRINT_BUFFER_SIZE)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+
+
+def _map_archive_index(state):
+    """(Пере)отображает файл индекса; False, если его нет или он не читается."""
+    _unmap_archive_index(state)
+    try:
+        f = open(state['path'], 'rb')
+    except OSError:
+        return False
+    try:
+        header = f.read(ARCHIVE_INDEX_HEADER.size)
+        magic, k, count, bloom_bytes, offset, ino = ARCHIVE_INDEX_HEADER.unpack(header)
+        if magic != ARCHIVE_INDEX_MAGIC or k != ARCHIVE_INDEX_K:
+            raise ValueError('unknown index format')
+        state['mm'] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (struct.error, ValueError, OSError):
+        f.close()
+        return False
+    state.update(file=f, count=count, bloom_bytes=bloom_bytes, offset=offset, ino=ino,
+                 file_id=os.fstat(f.fileno()).st_ino, pos=offset, delta=set())
+    return True
+
+
+def _unmap_archive_index(state):
+    if state.get('mm') is not None:
+        state['mm'].close()
+        state['file'].close()
+    state.update(mm=None, file=None)
+
+
+def _rebuild_archive_index(state, st, end):
+    with ExitStack() as stack:
+        digests = _sorted_unique_digests(_archive_digests(state['archive'], 0, end), stack)
+        _unmap_archive_index(state)
+        _write_archive_index(state['path'], digests, end, st.st_ino)
+
+
+def _merge_archive_delta(state):
+    """Вливает накопленную в памяти дельту в новый файл индекса."""
+    mm = state['mm']
+    base = ARCHIVE_INDEX_HEADER_SIZE + state['bloom_bytes']
+    bloom = bytearray(mm[ARCHIVE_INDEX_HEADER_SIZE:base])
+    delta = sorted(state['delta'])
+    for digest in delta:
+        _bloom_add(bloom, digest)
+    existing = (bytes(mm[base + i * ARCHIVE_INDEX_DIGEST_SIZE:base + (i + 1) * ARCHIVE_INDEX_DIGEST_SIZE])
+                for i in range(state['count']))
+    merged = heapq.merge(existing, delta)
+    offset, ino = state['pos'], state['ino']
+    with tempfile.TemporaryFile() as staged:
+        # Сначала пишем слияние во временный файл: текущее отображение нужно закрыть до переименования
+        for digest in merged:
+            staged.write(digest)
+        _unmap_archive_index(state)
+        _write_archive_index(state['path'], _iter_digest_file(staged), offset, ino, bloom)
+
+
+def _read_archive_tail(state, size):
+    """Добавляет в дельту записи, дописанные после покрытого смещения."""
+    if size <= state['pos']:
+        return
+    with open(state['archive'], 'rb') as f:
+        end = _complete_lines_end(f, size)
+    for digest in _archive_digests(state['archive'], state['pos'], end):
+        if not _index_has(state, digest):
+            state['delta'].add(digest)
+    state['pos'] = max(state['pos'], end)
+
+
+def refresh_archive_index(state):
+    """
+    Приводит индекс в соответствие с архивом. Читаются только строки, дописанные
+    с прошлого обновления; файл пересобирается, если архив был переписан
+    (сжатие, пересборка), и перезаписывается, когда дельта достигает предела.
+    """
+    try:
+        st = os.stat(state['archive'])
+    except FileNotFoundError:
+        _unmap_archive_index(state)
+        state.update(count=0, delta=set(), pos=0)
+        return
+
+    try:
+        current_id = os.stat(state['path']).st_ino
+    except OSError:
+        current_id = None
+    if state['mm'] is None or current_id != state.get('file_id'):
+        _map_archive_index(state)
+
+    if state['mm'] is None or state['ino'] != st.st_ino or state['offset'] > st.st_size:
+        with open(state['archive'], 'rb') as f:
+            end = _complete_lines_end(f, st.st_size)
+        try:
+            _rebuild_archive_index(state, st, end)
+        except OSError:
+            pass  # например, в Windows старый файл ещё отображён другим процессом
+        if not _map_archive_index(state):
+            # Файла нет: весь архив держится в памяти
+            state.update(count=0, delta=set(), pos=0, offset=0, ino=st.st_ino)
+
+    _read_archive_tail(state, st.st_size)
+
+    if len(state['delta']) >= ARCHIVE_INDEX_DELTA_LIMIT and state['mm'] is not None:
+        try:
+            _merge_archive_delta(state)
+        except OSError:
+            pass
+        if not _map_archive_index(state):
+            state.update(count=0, delta=set(), pos=0)
+        _read_archive_tail(state, st.st_size)
+
+
+def _index_has(state, digest):
+    mm = state['mm']
+    if mm is None or not state['count']:
+        return False
+    nbits = state['bloom_bytes'] * 8
+    for pos in _bloom_positions(digest, nbits):
+        if not mm[ARCHIVE_INDEX_HEADER_SIZE + (pos >> 3)] & (1 << (pos & 7)):
+            return False
+    base = ARCHIVE_INDEX_HEADER_SIZE + state['bloom_bytes']
+    lo, hi = 0, state['count']
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = base + mid * ARCHIVE_INDEX_DIGEST_SIZE
+        probe = mm[start:start + ARCHIVE_INDEX_DIGEST_SIZE]
+        if probe < digest:
+            lo = mid + 1
+        elif probe > digest:
+            hi = mid
+        else:
+            return True
+    return False
+
+
+def open_archive_index(archive_file):
+    """Открывает индекс архива, при необходимости строя или обновляя его."""
+    state = {'archive': archive_file, 'path': archive_file + '.idx', 'mm': None, 'file': None,
+             'count': 0, 'bloom_bytes': 0, 'offset': 0, 'ino': 0, 'pos': 0, 'delta': set()}
+    refresh_archive_index(state)
+    return state
+
+
+def archive_index_contains(state, extractor, video_id):
+    digest = archive_digest(extractor, video_id)
+    return digest in state['delta'] or _index_has(state, digest)
+
+
+def close_archive_index(state):
+    _unmap_archive_index(state)
+
+
+# ── Расписание по времени суток ────────────────────────────────
+# schedule.windows сопоставляет окна местного времени ("09:00"-"18:00"; конец
+# раньше начала переходит через полночь) с общим лимитом полосы (rate, в
+# синтаксисе yt-dlp, например "2M"), числом воркеров планировщика (workers)
+# и уровнем вежливости, который заменяет задержки из [network]. Лимит
+# делится поровну между одновременно идущими срезами и передается как
+# --limit-rate. Вне всех окон настройки [network] и [scheduler] действуют без
+# изменений. На границе окна запущенный процесс yt-dlp перезапускается с
+# новыми лимитами (он докачивает свои .part); воркеры движка получают новую
+# скорость при следующем обновлении прогресса, без перезапуска.
+
+POLITENESS_LEVELS = {
+    'polite': {'sleep_requests': 10, 'sleep_interval': 60, 'max_sleep_interval': 180, 'concurrent_fragments': 1},
+    'normal': {},
+    'fast': {'sleep_requests': 1, 'sleep_interval': 5, 'max_sleep_interval': 20, 'concurrent_fragments': 4},
+}
+# Такого кода возврата у процесса не бывает: попытку прервала граница окна или квота
+SCHEDULE_RESTART_CODE = -1000
+SCHEDULE_CHECK_INTERVAL = 30
+_RATE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*$', re.IGNORECASE)
+
+
+def _clock_minutes(text):
+    hours, _, minutes = str(text).partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+def active_window(cfg, now=None):
+    """Индекс окна schedule.windows, в которое попадает now (местное время), None вне всех окон."""
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    for i, window in enumerate(cfg["schedule"].get("windows", [])):
+        start = _clock_minutes(window.get("start", "00:00"))
+        end = _clock_minutes(window.get("end", "24:00"))
+        if start <= minute < end or (end < start and (minute >= start or minute < end)):
+            return i
+    return None
+
+
+def current_window(cfg):
+    index = active_window(cfg)
+    return {} if index is None else cfg["schedule"]["windows"][index]
+
+
+def parse_rate(text):
+    """Байт в секунду для скорости в стиле yt-dlp ("500K", "2M", "1.5G"); 0, если пусто или неверно."""
+    match = _RATE_RE.match(str(text or ''))
+    if not match:
+        return 0
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' '))
+
+
+def network_settings(cfg):
+    """[network] с задержками уровня вежливости активного окна."""
+    return {**cfg["network"], **POLITENESS_LEVELS.get(current_window(cfg).get("politeness", "normal"), {})}
+
+
+def scheduled_workers(cfg):
+    """Сколько срезов идет одновременно сейчас (1 без планировщика или со встроенным движком)."""
+    if not cfg["scheduler"].get("enabled") or _ENGINE is not None:
+        return 1
+    return max(1, current_window(cfg).get("workers") or cfg["scheduler"].get("workers", 2))
+
+
+def scheduled_rate(cfg):
+    """Лимит скорости на процесс в байт/с для активного окна, 0 — без лимита."""
+    return parse_rate(current_window(cfg).get("rate", "")) // scheduled_workers(cfg)
+
+
+def schedule_args(cfg):
+    rate = scheduled_rate(cfg)
+    return ['--limit-rate', str(rate)] if rate else []
+
+
+def describe_window(cfg):
+    window = current_window(cfg)
+    if not window:
+        return "вне окон расписания"
+    return (f"окно {window.get('start', '00:00')}-{window.get('end', '24:00')}: "
+            f"скорость {window.get('rate') or 'без лимита'}, воркеров {scheduled_workers(cfg)}, "
+            f"вежливость {window.get('politeness', 'normal')}")
+
+
+# ── Бюджеты квот ───────────────────────────────────────────────
+# YouTube замедляет, а затем и блокирует аккаунт или IP, который делает
+# слишком много запросов. [quota] задает часовые и суточные бюджеты запросов,
+# готовых видео и скачанных байт (0 = без лимита) для каждой cookie-личности:
+# используемого браузера или файла cookies, либо "anonymous". Расход
+# считается по ходу работы и сохраняется в quota.file (SQLite), так что
+# скользящие окна переживают перезапуски. Запросы — это шаги
+# "<id>: Downloading ...", о которых сообщает yt-dlp (страницы, API JSON,
+# конфиги плеера), плюс оценка для листинга плейлистов; видео и байты
+# берутся из файлов, попадающих в библиотеку. Перед группой, срезом
+# планировщика или попыткой загрузки исчерпанный бюджет приостанавливает
+# работу, пока достаточная часть расхода не выйдет из окна. Идущая загрузка
+# останавливается при следующей проверке расписания и докачивает свои .part,
+# когда в бюджете снова есть место.
+# --quota-status показывает расход, остаток и когда очередь будет разобрана
+# в темпе бюджета.
+
+QUOTA_BUDGETS = (
+    # (счетчик, ключ [quota], окно в секундах, единиц счетчика на единицу конфига)
+    ('requests', 'hourly_requests', 3600, 1),
+    ('requests', 'daily_requests', 86400, 1),
+    ('videos', 'hourly_videos', 3600, 1),
+    ('videos', 'daily_videos', 86400, 1),
+    ('bytes', 'hourly_bytes_gb', 3600, 1024 ** 3),
+    ('bytes', 'daily_bytes_gb', 86400, 1024 ** 3),
+)
+QUOTA_COUNTERS = ('requests', 'videos', 'bytes')
+QUOTA_FLUSH_INTERVAL = 60
+QUOTA_HISTORY_DAYS = 7
+# Плоский листинг — примерно один запрос на 50 записей (~87 на 4000+ видео)
+PLAYLIST_LISTING_PAGE = 50
+_QUOTA_REQUEST_RE = re.compile(r'^\[(?!download\]|info\])[\w:.-]+\] (?!Playlist ).+?: Downloading ')
+
+_QUOTA = None
+
+
+def _quota_path(cfg, script_dir):
+    """Абсолютный путь к базе расхода квот или None, если учет отключен."""
+    raw = cfg["quota"].get("file", "")
+    if not raw:
+        return None
+    return raw if os.path.isabs(raw) else os.path.join(script_dir, raw)
+
+
+def cookie_identity(cfg, script_dir):
+    """Чей бюджет расходуют запросы (тот же выбор, что и в _build_cookie_args)."""
+    mode = cfg["cookies"]["mode"]
+    cookie_file = cfg["cookies"]["cookies_file"]
+    if mode == "file" and os.path.isfile(os.path.join(script_dir, cookie_file)):
+        return f"file:{cookie_file}"
+    if mode in ("browser", "file"):
+        return f"browser:{cfg['cookies']['browser']}"
+    return "anonymous"
+
+
+def open_quota_db(path):
+    """Открывает (или создает) базу расхода; потоки планировщика делят ее под блокировкой квот."""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS quota_usage ("
+        " identity TEXT NOT NULL, ts REAL NOT NULL,"
+        " requests INTEGER NOT NULL, videos INTEGER NOT NULL, bytes INTEGER NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS quota_usage_identity_ts ON quota_usage (identity, ts)")
+    conn.commit()
+    return conn
+
+
+def record_quota_usage(conn, identity, usage, now=None):
+    """Сохраняет расход ({счетчик: количество}) на момент now и удаляет строки старше QUOTA_HISTORY_DAYS."""
+    now = now or time.time()
+    if any(usage.values()):
+        conn.execute(
+            "INSERT INTO quota_usage (identity, ts, requests, videos, bytes) VALUES (?, ?, ?, ?, ?)",
+            (identity, now, *(usage[counter] for counter in QUOTA_COUNTERS)))
+    conn.execute("DELETE FROM quota_usage WHERE ts < ?", (now - QUOTA_HISTORY_DAYS * 86400,))
+    conn.commit()
+
+
+def quota_usage(conn, identity, seconds, now=None):
+    """{счетчик: сумма} личности за последние seconds секунд."""
+    now = now or time.time()
+    row = conn.execute(
+        "SELECT COALESCE(SUM(requests), 0), COALESCE(SUM(videos), 0), COALESCE(SUM(bytes), 0)"
+        " FROM quota_usage WHERE identity = ? AND ts > ?", (identity, now - seconds)).fetchone()
+    return dict(zip(QUOTA_COUNTERS, row))
+
+
+def quota_resume_time(conn, identity, counter, budget, seconds, now=None):
+    """Когда расход counter в окне снова опустится ниже бюджета по мере устаревания старых строк."""
+    now = now or time.time()
+    rows = conn.execute(
+        f"SELECT ts, {counter} FROM quota_usage WHERE identity = ? AND ts > ? ORDER BY ts",
+        (identity, now - seconds)).fetchall()
+    used = sum(value for _, value in rows)
+    resume = now
+    for ts, value in rows:
+        if used < budget:
+            break
+        used -= value
+        resume = ts + seconds
+    return resume
+
+
+def exceeded_budget(conn, identity, cfg, now=None):
+    """(key, used, budget, resume_at) исчерпанного бюджета, который освободится последним; None, если место есть во всех."""
+    now = now or time.time()
+    worst = None
+    for counter, key, seconds, unit in QUOTA_BUDGETS:
+        budget = cfg["quota"].get(key, 0) * unit
+        if budget <= 0:
+            continue
+        used = quota_usage(conn, identity, seconds, now)[counter]
+        if used >= budget:
+            resume_at = quota_resume_time(conn, identity, counter, budget, seconds, now)
+            if worst is None or resume_at > worst[3]:
+                worst = (key, used, budget, resume_at)
+    return worst
+
+
+def describe_budget(key, used, budget):
+    if key.endswith('_gb'):
+        return f"{key} {format_size(used)} из {format_size(budget)}"
+    return f"{key} {used} из {budget}"
+
+
+def start_quota_accounting(cfg, script_dir, logger=None):
+    """Открывает базу расхода для текущей cookie-личности, если quota.file не пуст."""
+    global _QUOTA, _LANDED
+    stop_quota_accounting()
+    path = _quota_path(cfg, script_dir)
+    if path is None:
+        return
+    try:
+        conn = open_quota_db(path)
+    except sqlite3.Error as e:
+        print(colored(f"⚠ Учет квот недоступен ({path}): {e}", Fore.YELLOW))
+        if logger:
+            logger.warning(f"Учет квот недоступен ({path}): {e}")
+        return
+    # Видео и байты берутся из манифеста after_move: просим его у yt-dlp, если этого еще никто не сделал
+    manifest = None
+    if _LANDED is None:
+        manifest = _LANDED = new_landed_manifest(script_dir)
+    _QUOTA = {
+        'conn': conn,
+        'identity': cookie_identity(cfg, script_dir),
+        'pending': dict.fromkeys(QUOTA_COUNTERS, 0),
+        'flushed': time.time(),
+        'lock': threading.Lock(),
+        'manifest': manifest,
+        'logger': logger,
+    }
+    if logger:
+        logger.info(f"Учет квот: {_QUOTA['identity']} ({path})")
+
+
+def stop_quota_accounting():
+    """Учитывает уже попавшие в библиотеку файлы, сохраняет накопленный расход и закрывает базу."""
+    global _QUOTA, _LANDED
+    if _QUOTA is None:
+        return
+    if _QUOTA['manifest'] is not None and _LANDED is _QUOTA['manifest']:
+        collect_landed(force=True)
+        remove_landed_manifest(_LANDED)
+        _LANDED = None
+    flush_quota(force=True)
+    _QUOTA['conn'].close()
+    _QUOTA = None
+
+
+def flush_quota(force=False):
+    """Записывает накопленный расход; без force — не чаще раза в QUOTA_FLUSH_INTERVAL секунд."""
+    state = _QUOTA
+    if state is None:
+        return
+    with state['lock']:
+        now = time.time()
+        if not force and now - state['flushed'] < QUOTA_FLUSH_INTERVAL:
+            return
+        state['flushed'] = now
+        usage, state['pending'] = state['pending'], dict.fromkeys(QUOTA_COUNTERS, 0)
+        try:
+            record_quota_usage(state['conn'], state['identity'], usage, now)
+        except sqlite3.Error as e:
+            if state['logger']:
+                state['logger'].warning(f"Расход квоты не сохранен: {e}")
+
+
+def account_quota(requests=0, videos=0, size=0):
+    """Добавляет расход текущей личности (без учета ничего не делает)."""
+    state = _QUOTA
+    if state is None:
+        return
+    with state['lock']:
+        state['pending']['requests'] += requests
+        state['pending']['videos'] += videos
+        state['pending']['bytes'] += size
+    flush_quota()
+
+
+def count_quota_request(line):
+    """Учитывает строку вывода yt-dlp, которая означает запрос к сайту."""
+    if _QUOTA is not None and _QUOTA_REQUEST_RE.match(line):
+        account_quota(requests=1)
+
+
+def check_quota(cfg):
+    """exceeded_budget() текущей личности с учетом несохраненного расхода; None без учета."""
+    state = _QUOTA
+    if state is None:
+        return None
+    flush_quota(force=True)
+    with state['lock']:
+        return exceeded_budget(state['conn'], state['identity'], cfg)
+
+
+def quota_reason(cfg):
+    exceeded = check_quota(cfg)
+    return None if exceeded is None else f"Квота исчерпана ({describe_budget(*exceeded[:3])})"
+
+
+def restart_reason(cfg, window):
+    """Почему запущенный yt-dlp должен остановиться: новое окно расписания или исчерпанный бюджет. None — продолжать."""
+    if active_window(cfg) != window:
+        return f"Расписание изменилось ({describe_window(cfg)})"
+    return quota_reason(cfg)
+
+
+def wait_for_quota(cfg, logger=None):
+    """Приостанавливает работу, пока во всех бюджетах текущей личности снова не появится место."""
+    exceeded = check_quota(cfg)
+    if exceeded is None:
+        return
+    key, used, budget, resume_at = exceeded
+    msg = (f"⏸ Квота исчерпана: {describe_budget(key, used, budget)}, "
+           f"продолжение в {datetime.fromtimestamp(resume_at):%Y-%m-%d %H:%M}")
+    print(colored(msg, Fore.YELLOW))
+    if logger:
+        logger.warning(msg)
+    while exceeded is not None:
+        time.sleep(max(1, exceeded[3] - time.time()))
+        exceeded = check_quota(cfg)
+    msg = "▶ Квота снова доступна"
+    print(colored(msg, Fore.GREEN))
+    if logger:
+        logger.info(msg)
+
+
+def count_queued_videos(links, archive_file, cfg, script_dir, logger=None):
+    """(видео из links, которых еще нет в архиве; плейлисты, которые не удалось получить)."""
+    archived = {video_id for _, video_id in read_archive_entries(archive_file)}
+    remaining = unlisted = 0
+    for url in links:
+        if is_playlist_url(url):
+            total, downloaded, left = get_playlist_info(url, archive_file, cfg, script_dir, logger)
+            if total == 0 and downloaded == 0 and left == 0:
+                unlisted += 1
+            remaining += left
+        elif video_id_from_url(url) not in archived:
+            remaining += 1
+    return remaining, unlisted
+
+
+def projected_drain_seconds(cfg, history, remaining):
+    """
+    (seconds, key) для загрузки remaining видео в темпе самого жесткого бюджета,
+    None без бюджетов. Бюджеты запросов и байт переводятся в видео через
+    средние затраты на видео из history ({счетчик: сумма}).
+    """
+    tightest = None
+    for counter, key, seconds, unit in QUOTA_BUDGETS:
+        budget = cfg["quota"].get(key, 0) * unit
+        if counter == 'videos':
+            cost = 1
+        else:
+            cost = history[counter] / history['videos'] if history['videos'] else 0
+        if budget <= 0 or cost <= 0:
+            continue
+        rate = budget / cost / seconds  # видео в секунду
+        if tightest is None or rate < tightest[0]:
+            tightest = (rate, key)
+    if tightest is None:
+        return None
+    return remaining / tightest[0], tightest[1]
+
+
+# ── Порядок загрузки ───────────────────────────────────────────
+# Раньше --playlist-random был зашит жестко: терялась локальность докачки, а
+# прогресс запуска был непредсказуем. downloads.order выбирает стратегию:
+# "random" (по умолчанию; перемешивает yt-dlp, а при ненулевом order_seed —
+# воспроизводимое перемешивание), "playlist" (порядок списка), "newest",
+# "oldest", "shortest" (больше всего элементов в час) и "smallest".
+# Планируемые режимы используют плоский список, который get_playlist_info()
+# получает перед каждым плейлистом: элементы, которых еще нет в архиве,
+# сортируются и передаются в --playlist-items, а в конце идет "1:", чтобы
+# добавленные после получения списка элементы тоже скачались (дубликаты
+# yt-dlp пропускает, элементы из архива пропускаются без запроса).
+
+ORDER_MODES = ('random', 'playlist', 'newest', 'oldest', 'shortest', 'smallest')
+PLAYLIST_ENTRY_FIELDS = '%(id)s\t%(duration)s\t%(timestamp,release_timestamp)s\t%(upload_date,release_date)s\t%(filesize_approx)s\t%(playlist_title)s'
+PLAYLIST_FOLDER_TEMPLATE = '%(playlist_title,uploader,channel).100s'
+# Не больше стольких срезов с повторным списком (см. "Справедливый планировщик") на плейлист
+PLAYLIST_RELISTING_SLICES = 10
+# Командная строка остается заметно короче лимита Windows в 32767 символов
+ORDER_SPEC_MAX = 16000
+
+_PLAYLIST_ENTRIES = {}  # url -> элементы последнего списка, которых нет в архиве
+
+
+def _field_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_playlist_entry(line, index):
+    """Одна строка PLAYLIST_ENTRY_FIELDS плоского списка; неизвестные yt-dlp значения — None."""
+    video_id, duration, timestamp, upload_date, size, playlist = (line.split('\t', 5) + ['NA'] * 5)[:6]
+    date = _field_number(timestamp)
+    if date is None:
+        try:
+            date = datetime.strptime(upload_date, '%Y%m%d').timestamp()
+        except ValueError:
+            pass
+    return {'index': index, 'id': video_id, 'duration': _field_number(duration),
+            'date': date, 'size': _field_number(size), 'playlist': None if playlist in ('', 'NA') else playlist}
+
+
+def order_playlist_entries(entries, mode, seed=0):
+    """
+    Индексы плейлиста в порядке загрузки. Элементы без значения для сортировки
+    идут последними в порядке списка; без дат "oldest" — это список наоборот,
+    так как YouTube выдает загрузки от новых к старым. "smallest" при
+    отсутствии размера сортирует по длительности.
+    """
+    if mode == 'random':
+        indices = [e['index'] for e in entries]
+        random.Random(seed).shuffle(indices)
+        return indices
+    keys = {
+        'newest': lambda e: (e['date'] is None, -(e['date'] or 0), e['index']),
+        'oldest': lambda e: (e['date'] is None, e['date'] or 0, -e['index']),
+        'shortest': lambda e: (e['duration'] is None, e['duration'] or 0, e['index']),
+        'smallest': lambda e: (e['size'] is None, e['size'] or 0,
+                               e['duration'] is None, e['duration'] or 0, e['index']),
+    }
+    return [e['index'] for e in sorted(entries, key=keys[mode])]
+
+
+def playlist_items_spec(indices, limit=ORDER_SPEC_MAX, rest=True):
+    """
+    Значение --playlist-items: серии подряд идущих индексов становятся
+    диапазонами ("3:7", "9:4:-1"), список обрезается до limit символов и
+    заканчивается на "1:" (все остальное), если rest не False.
+    """
+    parts, length, i = [], 0, 0
+    while i < len(indices):
+        j = i
+        step = indices[i + 1] - indices[i] if i + 1 < len(indices) else 0
+        if step in (1, -1):
+            while j + 1 < len(indices) and indices[j + 1] - indices[j] == step:
+                j += 1
+        if j - i >= 2:
+            part = f'{indices[i]}:{indices[j]}' + (':-1' if step < 0 else '')
+        else:
+            j = i
+            part = str(indices[i])
+        if length + len(part) + 1 > limit:
+            break
+        parts.append(part)
+        length += len(part) + 1
+        i = j + 1
+    return ','.join(parts + ['1:'] if rest else parts)
+
+
+def ordering_args(cfg):
+    """--playlist-random, если перемешивает yt-dlp ("random" без seed), [] для планируемых режимов."""
+    order = cfg["downloads"].get("order", "random")
+    if order not in ORDER_MODES or (order == 'random' and not cfg["downloads"].get("order_seed", 0)):
+        return ['--playlist-random']
+    return []
+
+
+def playlist_order_args(cfg, url):
+    """--playlist-items в запланированном порядке для URL плейлиста."""
+    order = cfg["downloads"].get("order", "random")
+    if order == 'playlist' or ordering_args(cfg):
+        return []
+    entries = _PLAYLIST_ENTRIES.get(url)
+    if not entries:
+        # Списка нет (таймаут, ошибка сети): только то, что yt-dlp умеет сам
+        return {'random': ['--playlist-random'], 'oldest': ['--playlist-items', '::-1']}.get(order, [])
+    indices = order_playlist_entries(entries, order, cfg["downloads"].get("order_seed", 0))
+    return ['--playlist-items', playlist_items_spec(indices)]
+
+
+def archived_ids(cfg, archive_file, video_ids):
+    """Те из video_ids, что записаны в архиве загрузок."""
+    if cfg["downloads"].get("archive_index"):
+        # Фильтр Блума + отсортированные дайджесты на диске вместо множества всех ID архива
+        index = open_archive_index(archive_file)
+        try:
+            return {video_id for video_id in video_ids if archive_index_contains(index, 'youtube', video_id)}
+        finally:
+            close_archive_index(index)
+    downloaded_ids = set()
+    if os.path.exists(archive_file):
+        with open(archive_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    parts = line.split()
+                    if len(parts) >= 2:
+                        downloaded_ids.add(parts[1])
+    return set(video_ids).intersection(downloaded_ids)
+
+
+def record_playlist_listing(cfg, script_dir, url, video_ids, logger=None):
+    """Запоминает листинг плейлиста в каталоге, чтобы проверке полноты не нужен был новый листинг."""
+    index_path = _library_index_path(cfg, script_dir)
+    if index_path is None:
+        return
+    try:
+        conn = open_catalog(index_path)
+        try:
+            store_playlist_listing(conn, url, video_ids)
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        if logger:
+            logger.warning(f"  Листинг плейлиста не сохранен в каталог: {e}")
+
+
+def playlist_completeness(url, archive_file, cfg, script_dir, logger=None):
+    """
+    (total_videos, downloaded_videos, remaining_videos), как get_playlist_info(), но по
+    последнему листингу из каталога: элемент готов, если в каталоге есть его медиафайл
+    или его ID есть в архиве. Плейлист запрашивается заново, только если листинга нет.
+    """
+    index_path = _library_index_path(cfg, script_dir)
+    total = 0
+    if index_path is not None and os.path.isfile(index_path):
+        try:
+            conn = open_catalog(index_path)
+            try:
+                total, missing = catalog_playlist_missing(conn, url)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            if logger:
+                logger.warning(f"  Каталог недоступен для проверки плейлиста: {e}")
+    if not total:
+        return get_playlist_info(url, archive_file, cfg, script_dir, logger)
+    remaining = len(set(missing) - archived_ids(cfg, archive_file, missing))
+    return (total, total - remaining, remaining)
+
+
 def get_playlist_info(url, archive_file, cfg, script_dir, logger=None):
     """
     Получает информацию о плейлисте: общее количество видео и сколько уже скачано.
@@ -227,8 +2915,9 @@ def get_playlist_info(url, archive_file, cfg, script_dir, logger=None):
         cmd = [
             'yt-dlp',
             '--flat-playlist',
-            '--print', 'id',
+            '--print', PLAYLIST_ENTRY_FIELDS,
             *cookie_args,
+            *_build_cache_args(cfg, script_dir),
             '--no-warnings',
             url
         ]
@@ -239,29 +2928,23 @@ def get_playlist_info(url, archive_file, cfg, script_dir, logger=None):
             text=True,
             timeout=600
         )
+        account_quota(requests=1 + result.stdout.count('\n') // PLAYLIST_LISTING_PAGE)
 
         if result.returncode != 0:
             if logger:
                 logger.warning(f"   Не удалось получить список видео плейлиста")
             return (0, 0, 0)
 
-        all_video_ids = set(result.stdout.strip().split('\n'))
-        all_video_ids.discard('')
+        lines = [line for line in result.stdout.splitlines() if line.strip()]
+        entries = [parse_playlist_entry(line, index) for index, line in enumerate(lines, 1)]
+        all_video_ids = {entry['id'] for entry in entries}
         total_videos = len(all_video_ids)
 
-        downloaded_ids = set()
-        if os.path.exists(archive_file):
-            with open(archive_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        parts = line.split()
-                        if len(parts) >= 2:
-                            downloaded_ids.add(parts[1])
-
-        downloaded_from_playlist = all_video_ids.intersection(downloaded_ids)
+        downloaded_from_playlist = archived_ids(cfg, archive_file, all_video_ids)
         downloaded_count = len(downloaded_from_playlist)
+        record_playlist_listing(cfg, script_dir, url, all_video_ids, logger)
         remaining_count = total_videos - downloaded_count
+        _PLAYLIST_ENTRIES[url] = [entry for entry in entries if entry['id'] not in downloaded_from_playlist]
 
         if logger:
             logger.info(f"   Плейлист: всего {total_videos}, скачано {downloaded_count}, осталось {remaining_count}")
@@ -391,6 +3074,14 @@ def format_time(seconds):
     else:
         return f"{secs}с"
 
+def format_size(size):
+    """Форматирует размер в байтах в читаемый вид"""
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} PB"
+
 def read_links_file(links_path):
     """Читает файл со ссылками"""
     with open(links_path, 'r', encoding='utf-8') as f:
@@ -413,6 +3104,14 @@ def classify_error(line_lower):
         'message': ''
     }
 
+    # Допуск по месту на диске отклонил элемент (см. run_admission_check)
+    if is_admission_error(line_lower):
+        error_type.update({
+            'retry': True,
+            'message': 'Недостаточно места на диске - ожидание места перед повтором'
+        })
+        return error_type
+
     # DNS ошибки
     if 'failed to resolve' in line_lower or 'getaddrinfo failed' in line_lower:
         error_type.update({
@@ -540,11 +3239,509 @@ def classify_error(line_lower):
             'message': 'ffmpeg не найден - невозможно объединить форматы'
         })
 
-    return error_type
+    return error_type
+
+# ── Встроенный движок yt-dlp ───────────────────────────────────
+# engine = "api" выполняет загрузки через yt_dlp.YoutubeDL в долгоживущих
+# процессах-воркерах вместо запуска CLI на каждый URL. Параметры разбираются
+# из того же argv, который запустил бы CLI (yt_dlp.parse_options), поэтому
+# оба движка качают одинаково. Воркер держит один экземпляр YoutubeDL, пока
+# параметры не меняются — HTTP-соединения и загруженные экстракторы переиспользуются —
+# и отправляет точные типизированные события (progress_hooks,
+# postprocessor_hooks, записи лога) через очередь. engine = "cli" (по
+# умолчанию) оставляет запуск подпроцесса.
+
+_ENGINE = None
+
+
+class _EngineLogger:
+    """Логгер yt-dlp в процессе-воркере: пересылает записи как события."""
+
+    def __init__(self, send, job):
+        self._send = send
+        self._job = job
+
+    def debug(self, msg):
+        # Без логгера yt-dlp печатает это на экран; строки '[debug] ' — только с --verbose
+        if not msg.startswith('[debug] '):
+            self._send('log', ('info', msg))
+
+    def info(self, msg):
+        self._send('log', ('info', msg))
+
+    def warning(self, msg):
+        self._send('log', ('warning', f"WARNING: {msg}"))
+
+    def error(self, msg):
+        self._job['errors'] += 1
+        self._send('log', ('error', msg))
+
+
+def _engine_worker(script_dir, tasks, events, rate=None, cancelled=None):
+    """
+    Процесс-воркер: выполняет задания загрузки через yt_dlp.YoutubeDL, пока не получит None.
+    rate: общий лимит скорости на процесс (байт/с, 0 — без лимита), применяется к идущим загрузкам на лету.
+    cancelled: общий наибольший ID задания, брошенного до старта; такие задания пропускаются.
+    """
+    os.chdir(script_dir)
+    pid = os.getpid()
+    job = {'id': None, 'errors': 0, 'last_progress': 0.0, 'ydl': None}
+    ydl, ydl_argv = None, None
+
+    def send(kind, payload):
+        events.put((job['id'], kind, payload))
+
+    def on_progress(d):
+        if rate is not None and job['ydl'] is not None:
+            # Загрузчики используют тот же ydl.params и читают ratelimit на каждом блоке
+            job['ydl'].params['ratelimit'] = rate.value or None
+        now = time.time()
+        if d.get('status') == 'downloading' and now - job['last_progress'] < 0.5:
+            return
+        job['last_progress'] = now
+        info = d.get('info_dict') or {}
+        send('progress', {
+            'id': info.get('id'),
+            'status': d.get('status'),
+            'downloaded': d.get('downloaded_bytes'),
+            'total': d.get('total_bytes') or d.get('total_bytes_estimate'),
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+        })
+
+    def on_postprocess(d):
+        info = d.get('info_dict') or {}
+        send('postprocess', {
+            'id': info.get('id'),
+            'postprocessor': d.get('postprocessor'),
+            'status': d.get('status'),
+            'filepath': info.get('filepath'),
+        })
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job['id'], argv, urls = task
+        if cancelled is not None and job['id'] <= cancelled.value:
+            continue  # брошено до старта: его события никто не читает
+        job['errors'] = 0
+            # Хуки допуска из --exec резервируют от имени владельца этого задания в супервизоре
+        os.environ[ADMISSION_OWNER_ENV] = f"{os.getppid()}:engine{job['id']}"
+        send('start', pid)
+        try:
+            if argv != ydl_argv:
+                # Срезы и окна расписания меняют параметры: держим один экземпляр,
+                # чтобы HTTP-сессии и cookie прежних параметров не копились
+                if ydl is not None:
+                    ydl.close()
+                ydl, ydl_argv = None, None
+                ydl_opts = yt_dlp.parse_options(argv).ydl_opts
+                ydl_opts.update({
+                    'logger': _EngineLogger(send, job),
+                    'progress_hooks': [on_progress],
+                    'postprocessor_hooks': [on_postprocess],
+                    'noprogress': True,
+                    'consoletitle': False,
+                })
+                ydl, ydl_argv = yt_dlp.YoutubeDL(ydl_opts), argv
+            job['ydl'] = ydl
+            ydl.download(urls)
+            # YoutubeDL сохраняет код возврата между вызовами: определяем его по ошибкам этого задания
+            retcode = 1 if job['errors'] else 0
+        except SystemExit as e:
+            # parse_options() завершается с кодом 2 при неверных параметрах, как и CLI
+            retcode = e.code if isinstance(e.code, int) else 2
+        except Exception as e:
+            send('log', ('error', f"ERROR: {e}"))
+            retcode = 1
+        send('done', retcode)
+
+    if ydl is not None:
+        ydl.close()
+
+
+def _spawn_engine_worker():
+    process = _ENGINE['context'].Process(
+        target=_engine_worker,
+        args=(_ENGINE['script_dir'], _ENGINE['tasks'], _ENGINE['events'], _ENGINE['rate'], _ENGINE['cancelled']),
+        daemon=True,
+    )
+    process.start()
+    _ENGINE['workers'][process.pid] = process
+
+
+def start_download_engine(cfg, script_dir, logger=None):
+    """Запускает воркер встроенного движка (downloads.engine = "api")."""
+    global _ENGINE
+    if cfg["downloads"].get("engine", "cli") != "api" or _ENGINE is not None:
+        return
+    if not YTDLP_API_AVAILABLE:
+        print(colored("⚠ Для engine = \"api\" нужен пакет yt_dlp (pip install yt-dlp); используется CLI", Fore.YELLOW))
+        if logger:
+            logger.warning("Модуль yt_dlp недоступен, используется движок CLI")
+        return
+    # spawn: из-за потока обработчика библиотеки fork() небезопасен
+    context = multiprocessing.get_context('spawn')
+    _ENGINE = {
+        'context': context,
+        'script_dir': script_dir,
+        'tasks': context.Queue(),
+        'events': context.Queue(),
+        'rate': context.Value('q', 0),
+        'cancelled': context.Value('q', 0),
+        'workers': {},
+        'next_job': 0,
+    }
+    # Один воркер: задания движка идут по одному (см. run_fair_share), остальные простаивали бы
+    _spawn_engine_worker()
+    if logger:
+        logger.info(f"Встроенный движок: yt_dlp {yt_dlp.version.__version__}")
+
+
+def stop_download_engine():
+    """Останавливает воркеры движка (с движком CLI ничего не делает)."""
+    global _ENGINE
+    if _ENGINE is None:
+        return
+    for _ in _ENGINE['workers']:
+        _ENGINE['tasks'].put(None)
+    for process in _ENGINE['workers'].values():
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
+    _ENGINE = None
+
+
+def _replace_engine_worker(pid):
+    """Убивает зависший или упавший воркер и запускает вместо него новый."""
+    process = _ENGINE['workers'].pop(pid, None)
+    if process is not None and process.is_alive():
+        process.kill()
+        process.join(timeout=5)
+    _spawn_engine_worker()
+
+
+def _engine_progress_line(event):
+    """Строка прогресса в стиле CLI для типизированного события прогресса."""
+    total = event.get('total')
+    downloaded = event.get('downloaded') or 0
+    percent = downloaded * 100 / total if total else 0.0
+    line = f"[download] {percent:5.1f}% of {format_size(total) if total else '?'}"
+    if event.get('speed'):
+        line += f" at {format_size(event['speed'])}/s"
+    if event.get('eta') is not None:
+        line += f" ETA {format_time(event['eta'])}"
+    return line
+
+
+def _run_engine_attempt(cmd, script_dir, timeout_seconds, consecutive_dns_errors, logger):
+    """
+    Выполняет одну попытку загрузки на воркере движка (тот же контракт, что у _run_cli_attempt).
+    Возвращает (return_code, error_lines, videos_downloaded, videos_already_in_archive, consecutive_dns_errors)
+    """
+    _ENGINE['next_job'] += 1
+    job_id = _ENGINE['next_job']
+    # cmd = ['yt-dlp', *options, url]
+    _ENGINE['tasks'].put((job_id, cmd[1:-1], cmd[-1:]))
+
+    error_keywords = []
+    last_line_was_progress = False
+    videos_downloaded = 0
+    videos_already_in_archive = 0
+    worker_pid = None
+    return_code = None
+    start_time = time.time()
+
+    cfg = load_config()
+    quota_checked = start_time
+    while return_code is None:
+        if _ENGINE.get('rate') is not None:
+            _ENGINE['rate'].value = scheduled_rate(cfg)
+        if worker_pid is not None and time.time() - quota_checked >= SCHEDULE_CHECK_INTERVAL:
+            quota_checked = time.time()
+            reason = quota_reason(cfg)
+            if reason:
+                msg = f"{reason}: задание движка остановлено"
+                print(colored(f"\n⏱ {msg}", Fore.YELLOW))
+                logger.info(f"   {msg}")
+                _replace_engine_worker(worker_pid)
+                return_code = SCHEDULE_RESTART_CODE
+                break
+        if time.time() - start_time > timeout_seconds:
+            msg = f"ТАЙМАУТ! Задание работало более {timeout_seconds // 3600} часов"
+            print(colored(f"\n⚠ {msg}", Fore.RED))
+            logger.warning(f"   {msg}")
+            if worker_pid is not None:
+                _replace_engine_worker(worker_pid)
+            elif _ENGINE.get('cancelled') is not None:
+                # Ещё в очереди: воркер не должен выполнить его потом впустую
+                _ENGINE['cancelled'].value = job_id
+            return_code = -1
+            break
+
+        try:
+            event_job, kind, payload = _ENGINE['events'].get(timeout=1)
+        except queue.Empty:
+            collect_landed(logger=logger)
+            if worker_pid is not None and not _ENGINE['workers'][worker_pid].is_alive():
+                msg = "✗ Воркер движка завершился аварийно"
+                print(colored(f"\n{msg}", Fore.RED))
+                logger.error(f"   {msg}")
+                _replace_engine_worker(worker_pid)
+                return_code = -1
+            continue
+        collect_landed(logger=logger)
+        if event_job != job_id:
+            # запоздалые события задания, прерванного по таймауту; отменённое задание,
+            # взятое перед самой отменой, задержало бы это, поэтому его воркер заменяется
+            cancelled = _ENGINE.get('cancelled')
+            if (kind == 'start' and cancelled is not None and event_job <= cancelled.value
+                    and payload in _ENGINE['workers']):
+                _replace_engine_worker(payload)
+            continue
+
+        if kind == 'start':
+            worker_pid = payload
+        elif kind == 'done':
+            return_code = payload
+        elif kind == 'progress':
+            if payload['status'] == 'downloading':
+                last_line_was_progress = _echo_ytdlp_line(_engine_progress_line(payload), last_line_was_progress)
+        elif kind == 'postprocess':
+            if payload['postprocessor'] == 'MoveFiles' and payload['status'] == 'finished':
+                videos_downloaded += 1
+        elif kind == 'log':
+            level, line = payload
+            line_lower = line.lower()
+            count_quota_request(line)
+            if 'has already been downloaded' in line_lower or 'has already been recorded in the archive' in line_lower:
+                videos_already_in_archive += 1
+                if last_line_was_progress:
+                    print()
+                last_line_was_progress = False
+                print(colored(line, Fore.CYAN))
+                logger.info(f"   {line}")
+                continue
+            if level != 'info':
+                error_keywords.append(line)
+                if 'failed to resolve' in line_lower or 'getaddrinfo failed' in line_lower:
+                    consecutive_dns_errors += 1
+                    logger.error(f"   DNS ERROR #{consecutive_dns_errors}: {line}")
+                else:
+                    logger.error(f"   ERROR: {line}")
+            last_line_was_progress = _echo_ytdlp_line(line, last_line_was_progress)
+
+    if last_line_was_progress:
+        print()
+    release_reservations(ledger_path(cfg, script_dir), new_admission_owner(f"engine{job_id}"))
+    return (return_code, error_keywords, videos_downloaded, videos_already_in_archive, consecutive_dns_errors)
+
+def _build_download_cmd(cfg, script_dir, output_template, archive_file, targets, logger=None):
+    """Команда загрузки yt-dlp; targets — [url] или ['--batch-file', path]."""
+    downloads_dir = os.path.join(script_dir, cfg["downloads"]["output_dir"])
+    staging_args = _build_staging_args(cfg, script_dir, downloads_dir, logger)
+    if staging_args:
+        output_template = os.path.relpath(output_template, downloads_dir)
+    network = network_settings(cfg)
+    return [
+        'yt-dlp',
+        *_build_cookie_args(cfg, script_dir, logger),  # cookies: mode={cfg['cookies']['mode']}
+        *_build_cache_args(cfg, script_dir),
+        *_build_admission_args(cfg),
+        '--remote-components', 'ejs:github',
+        # Формат и конвертация
+        '-f', 'bestvideo+bestaudio/best',
+        *container_args(cfg),
+        # Попытки повтора
+        '--retries', str(cfg["network"]["retries"]),
+        '--fragment-retries', str(cfg["network"]["fragment_retries"]),
+        '--extractor-retries', str(cfg["network"]["extractor_retries"]),
+        '--file-access-retries', str(cfg["network"]["file_access_retries"]),
+        # Задержки (вежливость активного окна расписания)
+        '--sleep-requests', str(network["sleep_requests"]),
+        '--sleep-interval', str(network["sleep_interval"]),
+        '--max-sleep-interval', str(network["max_sleep_interval"]),
+        # Таймауты
+        '--socket-timeout', str(cfg["network"]["socket_timeout"]),
+        # Оптимизация загрузки
+        '--concurrent-fragments', str(network["concurrent_fragments"]),
+        '--buffer-size', cfg["network"]["buffer_size"],
+        *schedule_args(cfg),
+        # Метаданные и обложки
+        *([] if _POSTPROC is not None else ['--embed-metadata', '--embed-thumbnail']),
+        '--write-thumbnail',
+        *([] if _POSTPROC is not None else ['--convert-thumbnails', 'jpg']),
+        '--write-info-json',
+        # Именование файлов
+        '--windows-filenames',
+        *staging_args,
+        '--output', output_template,
+        # Обработка ошибок
+        '--no-check-certificate',
+        '--no-overwrites',
+        '--download-archive', archive_file,
+        '--ignore-errors',
+        '--no-abort-on-error',
+        # Прогресс
+        '--newline',
+        '--progress',
+        '--console-title',
+        *(landed_manifest_args(_LANDED) if _LANDED else []),
+        # Случайный порядок видео в плейлисте
+        *ordering_args(cfg),
+        *targets
+    ]
+
+
+def start_line_reader(process):
+    """
+    Очередь строк вывода process, которую наполняет фоновый поток; None означает конец.
+    Читается с таймаутом, поэтому проверки таймаута, расписания и квот в цикле идут
+    вовремя, даже пока yt-dlp ничего не печатает (длинный фрагмент, медленный поток).
+    """
+    lines = queue.Queue()
+
+    def pump():
+        for line in iter(process.stdout.readline, ''):
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=pump, daemon=True).start()
+    return lines
+
+
+def _echo_ytdlp_line(line, last_line_was_progress):
+    """Печатает строку вывода yt-dlp; строки прогресса перезаписывают друг друга. Возвращает новое состояние прогресса."""
+    if '[download]' in line and '%' in line:
+        sys.stdout.write('\r' + ' ' * 100 + '\r')
+        sys.stdout.write(colored(line, Fore.GREEN))
+        sys.stdout.flush()
+        return True
+    if last_line_was_progress:
+        print()
+    if line.startswith('[download]'):
+        print(colored(line, Fore.CYAN))
+    elif 'Merging' in line or 'merger' in line.lower():
+        print(colored(line, Fore.MAGENTA))
+    elif line.startswith('['):
+        print(colored(line, Fore.BLUE))
+    else:
+        print(line)
+    return False
+
+
+def _run_cli_attempt(cmd, script_dir, timeout_seconds, consecutive_dns_errors, logger):
+    """
+    Выполняет одну попытку загрузки подпроцессом yt-dlp, выводя его вывод.
+    Возвращает (return_code, error_lines, videos_downloaded, videos_already_in_archive, consecutive_dns_errors)
+    """
+    owner = new_admission_owner()
+    process = subprocess.Popen(
+        cmd,
+        cwd=script_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+        env=admission_env(owner)
+    )
+    lines = start_line_reader(process)
+
+    error_keywords = []
+    last_line_was_progress = False
+    videos_downloaded = 0
+    videos_already_in_archive = 0
+    start_time = time.time()
+    cfg = load_config()
+    window = active_window(cfg)
+    window_checked = start_time
+    restart = False
+
+    while True:
+        if time.time() - start_time > timeout_seconds:
+            process.kill()
+            timeout_hours = timeout_seconds // 3600
+            msg = f"ТАЙМАУТ! Процесс работал более {timeout_hours} часов"
+            print(colored(f"\n⚠ {msg}", Fore.RED))
+            logger.warning(f"   {msg}")
+            break
+
+        if time.time() - window_checked >= SCHEDULE_CHECK_INTERVAL:
+            window_checked = time.time()
+            reason = restart_reason(cfg, window)
+            if reason:
+                process.kill()
+                msg = f"{reason}: перезапуск yt-dlp"
+                print(colored(f"\n⏱ {msg}", Fore.YELLOW))
+                logger.info(f"   {msg}")
+                restart = True
+                break
+
+        try:
+            line = lines.get(timeout=1)
+        except queue.Empty:
+            line = ''
+        if line is None:
+            break
+        collect_landed(logger=logger)
+
+        if line:
+            line = line.rstrip()
+            line_lower = line.lower()
+            count_quota_request(line)
+
+            if '[download] downloading item' in line_lower:
+                match = re.search(r'downloading item (\d+) of (\d+)', line_lower)
+                if match:
+                    current = int(match.group(1))
+                    total_in_playlist = int(match.group(2))
+                    print(colored(f"📊 Прогресс плейлиста: {current}/{total_in_playlist}", Fore.MAGENTA))
+
+            if 'has already been downloaded' in line_lower or 'has already been recorded in the archive' in line_lower:
+                videos_already_in_archive += 1
+                print(colored(line, Fore.CYAN))
+                logger.info(f"   {line}")
+                continue
+
+            if '[download] 100%' in line or 'has already been downloaded' in line_lower:
+                if 'has already been downloaded' not in line_lower:
+                    videos_downloaded += 1
 
-def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file, logger):
+            if 'error' in line_lower or 'warning' in line_lower:
+                error_keywords.append(line)
+
+                if 'failed to resolve' in line_lower or 'getaddrinfo failed' in line_lower:
+                    consecutive_dns_errors += 1
+                    logger.error(f"   DNS ERROR #{consecutive_dns_errors}: {line}")
+                else:
+                    logger.error(f"   ERROR: {line}")
+
+            last_line_was_progress = _echo_ytdlp_line(line, last_line_was_progress)
+
+    if last_line_was_progress:
+        print()
+
+    return_code = process.wait()
+    release_reservations(ledger_path(cfg, script_dir), owner)
+    if restart:
+        return_code = SCHEDULE_RESTART_CODE
+    return (return_code, error_keywords, videos_downloaded, videos_already_in_archive, consecutive_dns_errors)
+
+
+def _write_missing_nfos(cfg, downloads_dir, logger):
+    """Генерирует NFO файлы для скачанных видео
+    (при работающем обработчике библиотеки они создаются сразу по готовности)"""
+    if cfg["downloads"].get("generate_nfo", True) and _LIBRARY_THREAD is None:
+        for info_json in glob.glob(os.path.join(downloads_dir, "**", "*.info.json"), recursive=True):
+            nfo_path = info_json.replace(".info.json", ".nfo")
+            if not os.path.exists(nfo_path):
+                generate_nfo_file(info_json, logger)
+
+def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file, logger, playlist_items=None):
     """
     Скачивает видео по одному URL (может быть одно видео или плейлист)
+    playlist_items: --playlist-items среза планировщика вместо запланированного порядка
     Возвращает (success_count, skip_count, fail_count, failed_url_or_none, consecutive_dns_errors, fatal)
     """
     cfg = load_config()
@@ -563,7 +3760,7 @@ def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file
     if is_playlist:
         output_template = os.path.join(
             downloads_dir,
-            '%(playlist_title,uploader,channel).100s',
+            PLAYLIST_FOLDER_TEMPLATE,
             '%(title).200s [%(id)s].%(ext)s'
         )
     else:
@@ -573,53 +3770,10 @@ def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file
         )
 
     # КОМАНДА yt-dlp
-    cookie_args = _build_cookie_args(cfg, script_dir, logger)
-    _COOKIE_ARGS = cookie_args
-    cmd = [
-        'yt-dlp',
-        *_COOKIE_ARGS,  # cookies: mode={cfg['cookies']['mode']}
-        '--remote-components', 'ejs:github',
-        # Формат и конвертация
-        '-f', 'bestvideo+bestaudio/best',
-        '--merge-output-format', 'mp4',
-        '--remux-video', 'mp4',
-        # Попытки повтора
-        '--retries', str(cfg["network"]["retries"]),
-        '--fragment-retries', str(cfg["network"]["fragment_retries"]),
-        '--extractor-retries', str(cfg["network"]["extractor_retries"]),
-        '--file-access-retries', str(cfg["network"]["file_access_retries"]),
-        # Задержки
-        '--sleep-requests', str(cfg["network"]["sleep_requests"]),
-        '--sleep-interval', str(cfg["network"]["sleep_interval"]),
-        '--max-sleep-interval', str(cfg["network"]["max_sleep_interval"]),
-        # Таймауты
-        '--socket-timeout', str(cfg["network"]["socket_timeout"]),
-        # Оптимизация загрузки
-        '--concurrent-fragments', str(cfg["network"]["concurrent_fragments"]),
-        '--buffer-size', cfg["network"]["buffer_size"],
-        # Метаданные и обложки
-        '--embed-metadata',
-        '--embed-thumbnail',
-        '--write-thumbnail',
-        '--convert-thumbnails', 'jpg',
-        '--write-info-json',
-        # Именование файлов
-        '--windows-filenames',
-        '--output', output_template,
-        # Обработка ошибок
-        '--no-check-certificate',
-        '--no-overwrites',
-        '--download-archive', archive_file,
-        '--ignore-errors',
-        '--no-abort-on-error',
-        # Прогресс
-        '--newline',
-        '--progress',
-        '--console-title',
-        # Случайный порядок видео в плейлисте
-        '--playlist-random',
-        url
-    ]
+    if playlist_items:
+        targets = ['--playlist-items', playlist_items, url]
+    else:
+        targets = [*playlist_order_args(cfg, url), url] if is_playlist else [url]
 
     max_attempts = cfg["downloads"]["max_attempts"]
     attempt = 0
@@ -630,6 +3784,7 @@ def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file
     success_count = 0
     skip_count = 0
     fail_count = 0
+    carried_downloads = 0
 
     while attempt < max_attempts and not success and not should_skip:
         attempt += 1
@@ -640,93 +3795,26 @@ def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file
             time.sleep(5)
 
         try:
-            process = subprocess.Popen(
-                cmd,
-                cwd=script_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1
-            )
-
-            error_keywords = []
-            last_line_was_progress = False
-            dns_errors_in_attempt = 0
-            videos_downloaded = 0
-            videos_already_in_archive = 0
-
             # Таймаут для плейлиста 24 ч, для одного видео 1 ч.
             # WL из 4360 видео при --sleep-interval 20 занимает ~87200 сек только на паузах.
-            start_time = time.time()
             timeout_seconds = cfg["network"]["timeout_playlist"] if is_playlist else cfg["network"]["timeout_video"]
 
-            while True:
-                if time.time() - start_time > timeout_seconds:
-                    process.kill()
-                    timeout_hours = timeout_seconds // 3600
-                    msg = f"ТАЙМАУТ! Процесс работал более {timeout_hours} часов"
-                    print(colored(f"\n⚠ {msg}", Fore.RED))
-                    logger.warning(f"   {msg}")
-                    break
-
-                line = process.stdout.readline()
-                if not line and process.poll() is not None:
-                    break
-
-                if line:
-                    line = line.rstrip()
-                    line_lower = line.lower()
-
-                    if '[download] downloading item' in line_lower:
-                        match = re.search(r'downloading item (\d+) of (\d+)', line_lower)
-                        if match:
-                            current = int(match.group(1))
-                            total_in_playlist = int(match.group(2))
-                            print(colored(f"📊 Прогресс плейлиста: {current}/{total_in_playlist}", Fore.MAGENTA))
-
-                    if 'has already been downloaded' in line_lower or 'has already been recorded in the archive' in line_lower:
-                        videos_already_in_archive += 1
-                        print(colored(line, Fore.CYAN))
-                        logger.info(f"   {line}")
-                        continue
-
-                    if '[download] 100%' in line or 'has already been downloaded' in line_lower:
-                        if 'has already been downloaded' not in line_lower:
-                            videos_downloaded += 1
-
-                    if 'error' in line_lower or 'warning' in line_lower:
-                        error_keywords.append(line)
-
-                        if 'failed to resolve' in line_lower or 'getaddrinfo failed' in line_lower:
-                            dns_errors_in_attempt += 1
-                            consecutive_dns_errors += 1
-                            logger.error(f"   DNS ERROR #{consecutive_dns_errors}: {line}")
-                        else:
-                            logger.error(f"   ERROR: {line}")
-
-                    if '[download]' in line and '%' in line:
-                        sys.stdout.write('\r' + ' ' * 100 + '\r')
-                        sys.stdout.write(colored(line, Fore.GREEN))
-                        sys.stdout.flush()
-                        last_line_was_progress = True
-                    else:
-                        if last_line_was_progress:
-                            print()
-                        last_line_was_progress = False
-
-                        if line.startswith('[download]'):
-                            print(colored(line, Fore.CYAN))
-                        elif 'Merging' in line or 'merger' in line_lower:
-                            print(colored(line, Fore.MAGENTA))
-                        elif line.startswith('['):
-                            print(colored(line, Fore.BLUE))
-                        else:
-                            print(line)
-
-            if last_line_was_progress:
-                print()
-
-            return_code = process.wait()
+            wait_for_quota(cfg, logger)
+            # Собирается на каждую попытку: окно расписания могло поменять лимиты
+            cmd = _build_download_cmd(cfg, script_dir, output_template, archive_file, targets, logger)
+            run_attempt = _run_engine_attempt if _ENGINE is not None else _run_cli_attempt
+            return_code, error_keywords, videos_downloaded, videos_already_in_archive, consecutive_dns_errors = run_attempt(
+                cmd, script_dir, timeout_seconds, consecutive_dns_errors, logger
+            )
+            collect_landed(force=True, logger=logger)
+            if return_code == SCHEDULE_RESTART_CODE:
+                # Это не неудачная попытка; то, что успело скачаться до перезапуска, уже в архиве
+                carried_downloads += videos_downloaded
+                attempt -= 1
+                continue
+            videos_downloaded += carried_downloads
+            videos_already_in_archive = max(0, videos_already_in_archive - carried_downloads)
+            carried_downloads = 0
             url_duration = time.time() - url_start_time
 
             if return_code == 0:
@@ -746,12 +3834,7 @@ def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file
                 consecutive_dns_errors = 0
                 success = True
 
-                # Генерация NFO файлов для скачанных видео
-                if cfg["downloads"].get("generate_nfo", True):
-                    for info_json in glob.glob(os.path.join(downloads_dir, "**", "*.info.json"), recursive=True):
-                        nfo_path = info_json.replace(".info.json", ".nfo")
-                        if not os.path.exists(nfo_path):
-                            generate_nfo_file(info_json, logger)
+                _write_missing_nfos(cfg, downloads_dir, logger)
 
             elif return_code == 2:
                 msg = "✗ ОШИБКА ПАРАМЕТРОВ КОМАНДЫ! (exit code 2)"
@@ -794,12 +3877,23 @@ def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file
                 if error_class['dns_error']:
                     has_dns_error = True
 
+            # Устаревшие cookies: экспортируем заново перед повтором (путь к файлу тот же)
+            if _COOKIE_CACHE is not None and any(is_cookie_error(e.lower()) for e in error_keywords):
+                refresh_cookie_cache(cfg, script_dir, logger, force=True)
+
             if fatal_error:
                 msg = "✗ ФАТАЛЬНАЯ ОШИБКА! Остановка скрипта"
                 print(colored(f"\n{msg}", Fore.RED))
                 logger.critical(msg)
                 return (0, 0, 0, None, consecutive_dns_errors, True)
 
+            # Элементы, отклоненные из-за места: ждем, пока поместится самый большой, и повторяем
+            refused = [e for e in error_keywords if is_admission_error(e.lower())]
+            if refused and not success and attempt < max_attempts:
+                need = max((int(m.group(1)) for m in map(ADMISSION_NEED_RE.search, refused) if m), default=0)
+                if not wait_for_disk_space(cfg, script_dir, need, logger):
+                    attempt = max_attempts
+
             if has_dns_error and consecutive_dns_errors >= max_consecutive_dns_errors:
                 msg = f"⚠ Критическое количество DNS ошибок ({consecutive_dns_errors})!"
                 print(colored(f"\n{msg}", Fore.RED))
@@ -853,6 +3947,600 @@ def download_single_url(url, idx, total, script_dir, downloads_dir, archive_file
     failed_url = url if fail_count > 0 else None
     return (success_count, skip_count, fail_count, failed_url, consecutive_dns_errors, False)
 
+# ── Пакетная загрузка отдельных видео ──────────────────────────
+# Каждый запуск yt-dlp платит за старт интерпретатора, загрузку экстракторов и
+# JS-проверку плеера YouTube. Поэтому подряд идущие ссылки на отдельные видео
+# передаются одному процессу через --batch-file. Результат привязывается к URL
+# по ID видео: манифест after_move отмечает готовые элементы, а свои сообщения
+# yt-dlp начинает с "[extractor] ID:". URL с ошибкой, допускающей повтор, или
+# вовсе без результата проходят через download_single_url() по одному, так что
+# повторы и failed_links.txt остаются точными для каждого URL.
+
+_VIDEO_URL_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/live/|/embed/|/v/)([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])')
+_LINE_VIDEO_ID_RE = re.compile(r'^(?:ERROR: |WARNING: )?\[[\w:.-]+\] ([A-Za-z0-9_-]{11}): ')
+
+
+def video_id_from_url(url):
+    """ID видео YouTube для ссылки на одно видео, None для плейлистов и прочих URL."""
+    if is_playlist_url(url):
+        return None
+    match = _VIDEO_URL_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
+def plan_url_batches(links, batch_size):
+    """
+    Группирует подряд идущие ссылки на отдельные видео в пакеты до batch_size.
+    Плейлисты и URL без распознаваемого ID видео идут по одному;
+    повторный ID начинает новый пакет, чтобы каждому ID соответствовал один URL.
+    Возвращает список списков URL в исходном порядке.
+    """
+    groups = []
+    batch, batch_ids = [], set()
+    for url in links:
+        video_id = video_id_from_url(url) if batch_size > 1 else None
+        if video_id is None or video_id in batch_ids or len(batch) >= batch_size:
+            if batch:
+                groups.append(batch)
+            batch, batch_ids = [], set()
+        if video_id is None:
+            groups.append([url])
+            continue
+        batch.append(url)
+        batch_ids.add(video_id)
+    if batch:
+        groups.append(batch)
+    return groups
+
+
+def line_video_id(line, known_ids):
+    """ID видео, к которому относится строка yt-dlp ("[youtube] ID: ..."), если он есть в known_ids."""
+    match = _LINE_VIDEO_ID_RE.match(line)
+    if match and match.group(1) in known_ids:
+        return match.group(1)
+    return None
+
+
+def attribute_batch_outcomes(url_ids, done, skipped, errors):
+    """
+    Результат пакетного запуска для каждого URL.
+    url_ids: {url: video_id}; done/skipped: множества ID; errors: {video_id: [строки]}.
+    Возвращает {url: 'success' | 'skip' | 'retry' | 'fatal'} — 'retry' означает
+    ошибку, допускающую повтор, или URL, о котором yt-dlp ничего не сообщил.
+    """
+    outcomes = {}
+    for url, video_id in url_ids.items():
+        if video_id in skipped:
+            outcomes[url] = 'skip'
+        elif video_id in done:
+            outcomes[url] = 'success'
+        else:
+            classes = [classify_error(line.lower()) for line in errors.get(video_id, [])]
+            if any(c['fatal'] for c in classes):
+                outcomes[url] = 'fatal'
+            elif any(c['skip'] for c in classes):
+                outcomes[url] = 'skip'
+            else:
+                outcomes[url] = 'retry'
+    return outcomes
+
+
+def download_video_batch(urls, idx, total, script_dir, downloads_dir, archive_file, logger):
+    """
+    Скачивает несколько ссылок на отдельные видео одним процессом yt-dlp (--batch-file)
+    Возвращает (success_count, skip_count, fail_count, failed_urls, consecutive_dns_errors, fatal)
+    """
+    cfg = load_config()
+    last = idx + len(urls) - 1
+    print(f"\n{colored('='*70, Fore.BLUE)}")
+    print(colored(f"[{idx}-{last}/{total}] ПАКЕТ из {len(urls)} видео", Fore.YELLOW))
+    print(colored('='*70, Fore.BLUE))
+    logger.info(f"\n[{idx}-{last}/{total}] ПАКЕТ из {len(urls)} видео")
+    for url in urls:
+        logger.info(f"   URL: {url}")
+
+    url_ids = {url: video_id_from_url(url) for url in urls}
+    known_ids = set(url_ids.values())
+    done, skipped, errors = set(), set(), {}
+    pause_time = 0
+    dns_errors = 0
+    batch_start_time = time.time()
+
+    wait_for_quota(cfg, logger)
+    fd, batch_file = tempfile.mkstemp(prefix='.batch_', suffix='.txt', dir=script_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(urls) + '\n')
+    events = new_landed_manifest(script_dir)
+    output_template = os.path.join(downloads_dir, '%(title).200s [%(id)s].%(ext)s')
+    cmd = _build_download_cmd(cfg, script_dir, output_template, archive_file,
+                              [*landed_manifest_args(events), '--batch-file', batch_file], logger)
+
+    owner = new_admission_owner()
+    try:
+        process = subprocess.Popen(
+            cmd,
+            cwd=script_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            env=admission_env(owner)
+        )
+        lines = start_line_reader(process)
+        last_line_was_progress = False
+        current_id = None
+        start_time = time.time()
+        timeout_seconds = cfg["network"]["timeout_video"] * len(urls)
+        window = active_window(cfg)
+        window_checked = start_time
+
+        while True:
+            if time.time() - start_time > timeout_seconds:
+                process.kill()
+                msg = f"ТАЙМАУТ! Пакет работал более {timeout_seconds // 3600} часов"
+                print(colored(f"\n⚠ {msg}", Fore.RED))
+                logger.warning(f"   {msg}")
+                break
+
+            if time.time() - window_checked >= SCHEDULE_CHECK_INTERVAL:
+                window_checked = time.time()
+                reason = restart_reason(cfg, window)
+                if reason:
+                    # Незавершенные URL остаются без результата и повторяются по одному с новыми лимитами
+                    process.kill()
+                    msg = f"{reason}: пакет остановлен"
+                    print(colored(f"\n⏱ {msg}", Fore.YELLOW))
+                    logger.info(f"   {msg}")
+                    break
+
+            try:
+                line = lines.get(timeout=1)
+            except queue.Empty:
+                line = ''
+            if line is None:
+                break
+            collect_landed(logger=logger)
+            if not line:
+                continue
+
+            line = line.rstrip()
+            line_lower = line.lower()
+            count_quota_request(line)
+            current_id = line_video_id(line, known_ids) or current_id
+
+            if 'has already been downloaded' in line_lower or 'has already been recorded in the archive' in line_lower:
+                if current_id:
+                    skipped.add(current_id)
+                print(colored(line, Fore.CYAN))
+                logger.info(f"   {line}")
+                continue
+
+            if line.startswith('ERROR:'):
+                # Ошибки загрузки ("unable to download video data") без ID: относятся к текущему элементу
+                if current_id:
+                    errors.setdefault(current_id, []).append(line)
+                if 'failed to resolve' in line_lower or 'getaddrinfo failed' in line_lower:
+                    dns_errors += 1
+                logger.error(f"   ERROR [{current_id or '?'}]: {line}")
+            elif 'warning' in line_lower:
+                logger.error(f"   ERROR: {line}")
+
+            last_line_was_progress = _echo_ytdlp_line(line, last_line_was_progress)
+
+        if last_line_was_progress:
+            print()
+        process.wait()
+
+    except KeyboardInterrupt:
+        raise
+
+    except Exception as e:
+        msg = f"✗ ИСКЛЮЧЕНИЕ: {e}"
+        print(f"\n{colored(msg, Fore.RED)}")
+        logger.exception(f"   {msg}")
+
+    finally:
+        collect_landed(force=True, logger=logger)
+        done.update(video_id for video_id, _ in read_landed(events, force=True))
+        remove_landed_manifest(events)
+        release_reservations(ledger_path(cfg, script_dir), owner)
+        try:
+            os.remove(batch_file)
+        except OSError:
+            pass
+
+    outcomes = attribute_batch_outcomes(url_ids, done, skipped, errors)
+    success_count = sum(1 for o in outcomes.values() if o == 'success')
+    skip_count = sum(1 for o in outcomes.values() if o == 'skip')
+    retry_urls = [url for url in urls if outcomes[url] == 'retry']
+
+    for url in urls:
+        for error in errors.get(url_ids[url], []):
+            error_class = classify_error(error.lower())
+            if error_class['message']:
+                print(colored(f"   ⚠ {url_ids[url]}: {error_class['message']}", Fore.YELLOW))
+                logger.warning(f"   {url_ids[url]}: {error_class['message']}")
+            if outcomes[url] == 'retry' and error_class['pause'] > pause_time:
+                pause_time = error_class['pause']
+
+    msg = (f"ПАКЕТ завершен за {format_time(time.time() - batch_start_time)}: "
+           f"скачано {success_count}, пропущено {skip_count}, на повтор {len(retry_urls)}")
+    print(f"\n{colored(msg, Fore.GREEN if not retry_urls else Fore.YELLOW)}")
+    logger.info(f"   {msg}")
+    if success_count:
+        _write_missing_nfos(cfg, downloads_dir, logger)
+
+    if 'fatal' in outcomes.values():
+        msg = "✗ ФАТАЛЬНАЯ ОШИБКА! Остановка скрипта"
+        print(colored(f"\n{msg}", Fore.RED))
+        logger.critical(msg)
+        return (success_count, skip_count, 0, [], dns_errors, True)
+
+    # Устаревшие cookies: экспортируем заново перед повторами по одному
+    if _COOKIE_CACHE is not None and any(is_cookie_error(e.lower()) for lines in errors.values() for e in lines):
+        refresh_cookie_cache(cfg, script_dir, logger, force=True)
+
+    consecutive_dns_errors = 0 if success_count else dns_errors
+    if retry_urls and pause_time > 0:
+        msg = f"Пауза {pause_time} секунд..."
+        print(colored(f"   {msg}", Fore.YELLOW))
+        logger.info(f"   {msg}")
+        time.sleep(pause_time)
+
+    fail_count = 0
+    failed_urls = []
+    for url in retry_urls:
+        success, skip, fail, failed_url, consecutive_dns_errors, fatal = download_single_url(
+            url, idx + urls.index(url), total, script_dir, downloads_dir, archive_file, logger
+        )
+        success_count += success
+        skip_count += skip
+        fail_count += fail
+        if failed_url:
+            failed_urls.append(failed_url)
+        if fatal:
+            return (success_count, skip_count, fail_count, failed_urls, consecutive_dns_errors, True)
+
+    return (success_count, skip_count, fail_count, failed_urls, consecutive_dns_errors, False)
+
+
+# ── Докачка незавершенных загрузок ─────────────────────────────
+# После сбоя или убийства по таймауту остаются .part, фрагменты и файлы
+# состояния .ytdl. Раньше к таким элементам возвращались, только когда снова
+# доходила очередь до их ссылки. Теперь при старте библиотека (и каталог
+# staging) сканируется, каждый такой файл сопоставляется с ID видео по
+# суффиксу "[id]" в имени, и эти элементы ставятся в очередь перед links.txt.
+# Каждый качается по шаблону, указывающему на папку с его частичным файлом,
+# поэтому имя совпадает и yt-dlp продолжает с места остановки. Частичные
+# файлы элементов, которые уже есть в архиве, — остатки (yt-dlp пропустил бы
+# элемент): они удаляются.
+
+_PARTIAL_RE = re.compile(r'\[([A-Za-z0-9_-]{11})\]\.[^\[\]/\\]*?(?:\.part(?:-Frag\d+)?(?:\.part)?|\.ytdl)$')
+
+
+def partial_video_id(name):
+    """ID видео по имени частично скачанного файла ("Title [id].f137.mp4.part"), иначе None."""
+    match = _PARTIAL_RE.search(name)
+    return match.group(1) if match else None
+
+
+def _partial_files(downloads_dir, staging_dir=None):
+    """Выдаёт (video_id, папка библиотеки, путь) каждого файла незавершенной загрузки."""
+    skip = os.path.realpath(staging_dir) if staging_dir else None
+    for root in filter(None, (downloads_dir, staging_dir)):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if os.path.realpath(os.path.join(dirpath, d)) != skip]
+            folder = os.path.normpath(os.path.join(downloads_dir, os.path.relpath(dirpath, root)))
+            for name in filenames:
+                video_id = partial_video_id(name)
+                if video_id is not None:
+                    yield video_id, folder, os.path.join(dirpath, name)
+
+
+def scan_partial_downloads(downloads_dir, staging_dir=None):
+    """
+    Находит незавершенные загрузки. Возвращает {video_id: {'folder', 'bytes', 'files'}},
+    где folder — папка библиотеки, куда относится элемент.
+    Если ID недокачан в нескольких папках, побеждает та, где больше байт.
+    """
+    found = {}
+    for video_id, folder, path in _partial_files(downloads_dir, staging_dir):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        item = found.setdefault((video_id, folder), {'folder': folder, 'bytes': 0, 'files': 0})
+        item['bytes'] += size
+        item['files'] += 1
+    partials = {}
+    for (video_id, _), item in found.items():
+        if video_id not in partials or item['bytes'] > partials[video_id]['bytes']:
+            partials[video_id] = item
+    return partials
+
+
+def remove_partial_leftovers(downloads_dir, staging_dir, video_ids, logger=None):
+    """Удаляет частичные файлы video_ids (элементов, которые есть в архиве). Возвращает (файлы, байты)."""
+    removed = freed = 0
+    for video_id, _, path in list(_partial_files(downloads_dir, staging_dir)):
+        if video_id not in video_ids:
+            continue
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            continue
+        removed += 1
+        freed += size
+    if removed:
+        msg = f"🧹 Удалено {removed} частичных файлов уже скачанных элементов ({len(video_ids)}), освобождено {format_size(freed)}"
+        print(colored(msg, Fore.CYAN))
+        if logger:
+            logger.info(msg)
+    return removed, freed
+
+
+def plan_partial_resume(partials):
+    """
+    [(folder, [url, ...])]: сначала папка с самым большим недокачанным файлом,
+    внутри каждой папки — самые большие первыми.
+    """
+    plan = {}
+    for video_id, item in sorted(partials.items(), key=lambda kv: (-kv[1]['bytes'], kv[0])):
+        plan.setdefault(item['folder'], []).append(f'https://www.youtube.com/watch?v={video_id}')
+    return list(plan.items())
+
+
+# ── Справедливый планировщик ───────────────────────────────────
+# Без планировщика каждая ссылка качается до конца, прежде чем начнется
+# следующая, поэтому Watch Later на 4000 видео задерживает все остальные
+# ссылки на время до timeout_playlist. С scheduler.enabled каждая группа
+# запуска (плейлист или пакет отдельных видео) — это источник, а плейлисты
+# режутся на срезы: их запланированный порядок (см. "Порядок загрузки")
+# делится на куски по scheduler.slice x weight элементов, поэтому
+# одновременные срезы никогда не делят элемент. Срез — это запуск
+# --batch-file по watch-ссылкам его видео в папку плейлиста, названную так
+# же, как ее называет yt-dlp (playlist_folder()), и список плейлиста он не
+# получает заново. Без модуля yt_dlp имя папки неизвестно, и срез — это
+# запуск ссылки плейлиста с --playlist-items, который снова листает список
+# (эти страницы считает count_quota_request()); такие срезы растут вместе с
+# плейлистом, их не больше PLAYLIST_RELISTING_SLICES. Источники ходят по
+# кругу (round robin); одновременно идут до scheduler.workers срезов, не
+# больше max_concurrency от одного источника. weight и max_concurrency
+# берутся из scheduler.sources по подстроке URL. Одновременные срезы
+# допускают элементы через журнал резервирований (см. "Допуск по свободному
+# месту"): каждый запуск yt-dlp — в нем отдельный владелец, поэтому элемент,
+# допущенный одним срезом, уменьшает свободное место, которое видят другие.
+
+_SCHEDULER_STOP = object()
+_SLICE_NO_SPACE = object()
+
+
+def source_settings(cfg, urls):
+    """(weight, max_concurrency) источника: первый ключ scheduler.sources, найденный в одном из его URL."""
+    for key, settings in cfg["scheduler"].get("sources", {}).items():
+        if any(key in url for url in urls):
+            return max(1, int(settings.get("weight", 1))), max(1, int(settings.get("max_concurrency", 1)))
+    return 1, 1
+
+
+def new_source(cfg, target_dir, urls, number):
+    weight, max_concurrency = source_settings(cfg, urls)
+    playlist = len(urls) == 1 and is_playlist_url(urls[0])
+    return {
+        'number': number,
+        'urls': urls,
+        'target': target_dir,
+        'weight': weight,
+        'max_concurrency': max_concurrency,
+        # Плейлист сначала получает список, срезы известны после него
+        'jobs': deque([('list', None)] if playlist else [('download', None)]),
+        'running': 0,
+    }
+
+
+def next_slice(rotation):
+    """
+    Следующая пара (source, job) по кругу или None, если сейчас ни один
+    источник не может ее начать. Источники без работы покидают очередь.
+    """
+    for _ in range(len(rotation)):
+        source = rotation.popleft()
+        if not source['jobs'] and not source['running']:
+            continue
+        rotation.append(source)
+        if source['jobs'] and source['running'] < source['max_concurrency']:
+            return source, source['jobs'].popleft()
+    return None
+
+
+def playlist_folder(downloads_dir, title):
+    """
+    Папка, в которую download_single_url() кладет плейлист с названием title,
+    названная так, как ее называет yt-dlp (очищенная для Windows, обрезанная
+    до 100 символов). None без модуля yt_dlp.
+    """
+    if not YTDLP_API_AVAILABLE or not title:
+        return None
+    try:
+        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'windowsfilenames': True}) as ydl:
+            folder = ydl.prepare_filename({'playlist_title': title},
+                                          outtmpl=os.path.join(downloads_dir, PLAYLIST_FOLDER_TEMPLATE))
+    except Exception:
+        return None
+    return folder or None
+
+
+def plan_playlist_slices(cfg, entries, weight, batch=False):
+    """
+    Срезы плейлиста в запланированном порядке: значения --playlist-items или
+    с batch — ID видео каждого среза. Срезы с --playlist-items заново получают
+    список плейлиста, поэтому их не больше PLAYLIST_RELISTING_SLICES.
+    """
+    order = cfg["downloads"].get("order", "random")
+    if order == 'playlist':
+        indices = [e['index'] for e in entries]
+    else:
+        mode = order if order in ORDER_MODES else 'random'
+        indices = order_playlist_entries(entries, mode, cfg["downloads"].get("order_seed", 0) or None)
+    size = max(1, cfg["scheduler"].get("slice", 20)) * weight
+    if not batch:
+        size = max(size, -(-len(indices) // PLAYLIST_RELISTING_SLICES))
+    chunks = [indices[i:i + size] for i in range(0, len(indices), size)]
+    if batch:
+        ids = {e['index']: e['id'] for e in entries}
+        return [[ids[index] for index in chunk] for chunk in chunks]
+    return [playlist_items_spec(chunk, rest=False) for chunk in chunks]
+
+
+def _list_source(source, total, cfg, script_dir, archive_file, logger):
+    """Получает список источника-плейлиста. Возвращает (jobs, skip_count)."""
+    url = source['urls'][0]
+    total_vids, downloaded_vids, remaining_vids = get_playlist_info(url, archive_file, cfg, script_dir, logger)
+    if total_vids == 0 and downloaded_vids == 0 and remaining_vids == 0:
+        msg = f"[{source['number']}/{total}] Статистика плейлиста недоступна, качаем его одним срезом: {url}"
+        print(colored(f"⚠ {msg}", Fore.YELLOW))
+        logger.warning(f"   {msg}")
+        return [('download', None)], 0
+    if remaining_vids == 0:
+        msg = f"[{source['number']}/{total}] Плейлист уже полностью скачан ({total_vids} видео): {url}"
+        print(colored(f"✓ {msg}", Fore.GREEN))
+        logger.info(f"   {msg}")
+        return [], total_vids
+    entries = _PLAYLIST_ENTRIES.get(url, [])
+    titles = {entry.get('playlist') for entry in entries}
+    folder = playlist_folder(source['target'], titles.pop()) if len(titles) == 1 else None
+    if folder:
+        slices = [('batch', (folder, [f'https://www.youtube.com/watch?v={video_id}' for video_id in ids]))
+                  for ids in plan_playlist_slices(cfg, entries, source['weight'], batch=True)]
+    else:
+        slices = [('download', items) for items in plan_playlist_slices(cfg, entries, source['weight'])]
+    msg = (f"[{source['number']}/{total}] ПЛЕЙЛИСТ: всего {total_vids}, скачано {downloaded_vids}, "
+           f"осталось {remaining_vids}, срезов {len(slices)}: {url}")
+    print(colored(f"📊 {msg}", Fore.MAGENTA))
+    logger.info(f"   {msg}")
+    return slices, 0
+
+
+def _run_slice(source, job, total, cfg, script_dir, archive_file, logger):
+    """
+    Выполняет одно задание источника. Возвращает (new_jobs, success, skip, fail, failed_urls, fatal)
+    или _SLICE_NO_SPACE, если места на диске для среза загрузки так и не хватило.
+    """
+    kind, items = job
+    # Ожидание в воркере: диспетчер тем временем продолжает собирать завершённые срезы
+    if kind != 'list' and not wait_for_disk_space(cfg, script_dir, 0, logger):
+        return _SLICE_NO_SPACE
+    wait_for_quota(cfg, logger)
+    if kind == 'list':
+        jobs, skip = _list_source(source, total, cfg, script_dir, archive_file, logger)
+        return jobs, 0, skip, 0, [], False
+    urls = source['urls']
+    if kind == 'batch':
+        folder, slice_urls = items
+        success, skip, fail, failed, _, fatal = download_video_batch(
+            slice_urls, source['number'], total, script_dir, folder, archive_file, logger)
+    elif len(urls) > 1:
+        success, skip, fail, failed, _, fatal = download_video_batch(
+            urls, source['number'], total, script_dir, source['target'], archive_file, logger)
+    else:
+        success, skip, fail, failed_url, _, fatal = download_single_url(
+            urls[0], source['number'], total, script_dir, source['target'], archive_file, logger,
+            playlist_items=items)
+        failed = [failed_url] if failed_url else []
+    return [], success, skip, fail, failed, fatal
+
+
+def _scheduler_worker(jobs, results):
+    while True:
+        task = jobs.get()
+        if task is _SCHEDULER_STOP:
+            break
+        source, job, args = task
+        try:
+            results.put((source, job, _run_slice(source, job, *args)))
+        except Exception as e:
+            results.put((source, job, e))
+
+
+def run_fair_share(work, cfg, script_dir, archive_file, logger):
+    """
+    Скачивает группы work ([(target_dir, urls)]) чередующимися срезами.
+    Возвращает (success_count, skip_count, fail_count, failed_urls, fatal)
+    """
+    # У встроенного движка одна очередь событий на все задания: по одному срезу.
+    # Потоков — на самое загруженное окно расписания; сколько можно запускать сейчас, решает scheduled_workers().
+    window_workers = [window.get("workers") or 0 for window in cfg["schedule"].get("windows", [])]
+    workers = 1 if _ENGINE is not None else max(1, cfg["scheduler"].get("workers", 2), *window_workers)
+    sources = [new_source(cfg, target_dir, urls, n) for n, (target_dir, urls) in enumerate(work, 1)]
+    rotation = deque(sources)
+    total = len(sources)
+    msg = f"Планировщик: источников {total}, воркеров {workers}"
+    print(colored(msg, Fore.CYAN))
+    logger.info(msg)
+
+    jobs, results = queue.Queue(), queue.Queue()
+    threads = [threading.Thread(target=_scheduler_worker, args=(jobs, results), daemon=True)
+               for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    success_count = skip_count = fail_count = 0
+    failed_urls = []
+    running = 0
+    stopped = fatal = False
+    try:
+        window = active_window(cfg)
+        while True:
+            if active_window(cfg) != window:
+                window = active_window(cfg)
+                msg = f"Расписание: {describe_window(cfg)}"
+                print(colored(f"⏱ {msg}", Fore.CYAN))
+                logger.info(msg)
+            while not stopped and running < scheduled_workers(cfg):
+                picked = next_slice(rotation)
+                if picked is None:
+                    break
+                source, job = picked
+                source['running'] += 1
+                running += 1
+                jobs.put((source, job, (total, cfg, script_dir, archive_file, logger)))
+            if running == 0:
+                break
+            try:
+                source, job, outcome = results.get(timeout=1)
+            except queue.Empty:
+                continue
+            source['running'] -= 1
+            running -= 1
+            if outcome is _SLICE_NO_SPACE:
+                source['jobs'].appendleft(job)
+                stopped = True
+                continue
+            if isinstance(outcome, Exception):
+                msg = f"✗ ИСКЛЮЧЕНИЕ в срезе {source['urls'][0]}: {outcome}"
+                print(colored(msg, Fore.RED))
+                logger.error(msg)
+                outcome = ([], 0, 0, len(source['urls']), source['urls'], False)
+            new_jobs, success, skip, fail, failed, slice_fatal = outcome
+            source['jobs'].extend(new_jobs)
+            success_count += success
+            skip_count += skip
+            fail_count += fail
+            failed_urls.extend(url for url in failed if url not in failed_urls)
+            if slice_fatal:
+                fatal = stopped = True
+    finally:
+        for _ in threads:
+            jobs.put(_SCHEDULER_STOP)
+
+    # Досрочная остановка (место на диске): то, что не запускалось, считается неудачей
+    for source in sources:
+        if source['jobs']:
+            failed_urls.extend(url for url in source['urls'] if url not in failed_urls)
+    return success_count, skip_count, fail_count, failed_urls, fatal
+
+
 def download_youtube_videos(links_file=None):
     """Скачивает YouTube видео с улучшенной обработкой ошибок и проверкой прогресса плейлистов"""
     if not check_ytdlp_installed():
@@ -882,7 +4570,16 @@ def download_youtube_videos(links_file=None):
         print(colored(f"✗ Ошибка чтения файла: {e}", Fore.RED))
         return False
 
-    if not active_links:
+    partials = {}
+    if cfg["downloads"].get("resume_partials", True):
+        partials = scan_partial_downloads(downloads_dir, _staging_dir(cfg, script_dir))
+        # Остатки рядом с элементами, которые всё же докачались: yt-dlp пропустил бы их как архивные
+        finished = archived_ids(cfg, archive_file, partials)
+        if finished:
+            remove_partial_leftovers(downloads_dir, _staging_dir(cfg, script_dir), finished, logger)
+            partials = {video_id: item for video_id, item in partials.items() if video_id not in finished}
+
+    if not active_links and not partials:
         print(colored("✓ Нет активных ссылок для загрузки", Fore.GREEN))
         return True
 
@@ -897,6 +4594,20 @@ def download_youtube_videos(links_file=None):
     logger.info(f"Папка загрузок: {downloads_dir}")
     logger.info(f"{'='*70}")
 
+    reset_container_stats()
+    _PLAYLIST_ENTRIES.clear()
+    cleanup_staging(cfg, script_dir, logger)
+    start_library_worker(cfg, script_dir, logger)
+    prepare_cookie_cache(cfg, script_dir, logger)
+    prepare_component_cache(cfg, script_dir, logger)
+    start_download_engine(cfg, script_dir, logger)
+    start_postprocess_pool(cfg, script_dir, logger)
+    start_quota_accounting(cfg, script_dir, logger)
+    if cfg["schedule"].get("windows"):
+        msg = f"Расписание: {describe_window(cfg)}"
+        print(colored(f"⏱ {msg}", Fore.CYAN))
+        logger.info(msg)
+
     total_success = 0
     total_skip = 0
     total_fail = 0
@@ -904,8 +4615,41 @@ def download_youtube_videos(links_file=None):
     total_start_time = time.time()
     consecutive_dns_errors = 0
 
-    for idx, url in enumerate(active_links, 1):
-        is_playlist = is_playlist_url(url)
+    # Воркеры движка "api" живут весь запуск, пакеты им не нужны
+    batch_size = 1 if _ENGINE is not None else cfg["downloads"]["batch_size"]
+
+    # Прерванные загрузки идут первыми, каждая в папку со своим частичным файлом
+    resume_plan = plan_partial_resume(partials)
+    if partials:
+        salvaged = sum(item['bytes'] for item in partials.values())
+        msg = f"↻ Сначала докачиваем незавершенные загрузки: {len(partials)} (на диске уже {format_size(salvaged)})"
+        print(colored(msg, Fore.MAGENTA))
+        logger.info(msg)
+    run_links = [url for _, urls in resume_plan for url in urls] + active_links
+    work = [(folder, group) for folder, urls in resume_plan for group in plan_url_batches(urls, batch_size)]
+    work += [(downloads_dir, group) for group in plan_url_batches(active_links, batch_size)]
+
+    if cfg["scheduler"].get("enabled"):
+        total_success, total_skip, total_fail, failed_urls, fatal = run_fair_share(
+            work, cfg, script_dir, archive_file, logger)
+        if fatal:
+            stop_download_engine()
+            stop_postprocess_pool()
+            stop_library_worker()
+            stop_quota_accounting()
+            return False
+        work = []  # все группы уже выполнил планировщик
+
+    position = 0
+    for target_dir, group in work:
+        if not wait_for_disk_space(cfg, script_dir, 0, logger):
+            failed_urls.extend(run_links[position:])
+            break
+        wait_for_quota(cfg, logger)
+        idx = position + 1
+        position += len(group)
+        url = group[0]
+        is_playlist = len(group) == 1 and is_playlist_url(url)
 
         if is_playlist:
             total_vids, downloaded_vids, remaining_vids = get_playlist_info(url, archive_file, cfg, script_dir, logger)
@@ -925,24 +4669,33 @@ def download_youtube_videos(links_file=None):
                 total_skip += total_vids
                 continue
 
-        success, skip, fail, failed_url, dns_errors, fatal = download_single_url(
-            url, idx, len(active_links), script_dir, downloads_dir, archive_file, logger
-        )
+        if len(group) > 1:
+            success, skip, fail, group_failed, dns_errors, fatal = download_video_batch(
+                group, idx, len(run_links), script_dir, target_dir, archive_file, logger
+            )
+        else:
+            success, skip, fail, failed_url, dns_errors, fatal = download_single_url(
+                url, idx, len(run_links), script_dir, target_dir, archive_file, logger
+            )
+            group_failed = [failed_url] if failed_url else []
 
         total_success += success
         total_skip += skip
         total_fail += fail
         consecutive_dns_errors = dns_errors
-
-        if failed_url:
-            failed_urls.append(failed_url)
+        failed_urls.extend(group_failed)
 
         if fatal:
+            stop_download_engine()
+            stop_postprocess_pool()
+            stop_library_worker()
+            stop_quota_accounting()
             return False
 
         # После загрузки плейлиста — повторная проверка прогресса
         if is_playlist:
-            total_vids, downloaded_vids, remaining_vids = get_playlist_info(url, archive_file, cfg, script_dir, logger)
+            total_vids, downloaded_vids, remaining_vids = playlist_completeness(
+                url, archive_file, cfg, script_dir, logger)
             if total_vids == 0:
                 logger.warning(f"   Финальная статистика плейлиста недоступна")
             elif remaining_vids > 0:
@@ -953,11 +4706,16 @@ def download_youtube_videos(links_file=None):
                 print(colored(f"\n✓ Плейлист полностью загружен ({total_vids} видео)", Fore.GREEN))
                 logger.info(f"   Плейлист завершен: {total_vids} видео")
 
-        if idx < len(active_links):
+        if position < len(run_links):
             pause = 10 if success > 0 else 5
             print(colored(f"Пауза {pause} сек...", Fore.CYAN))
             time.sleep(pause)
 
+    stop_download_engine()
+    stop_postprocess_pool()
+    stop_library_worker()
+    stop_quota_accounting()
+
     # Финальная статистика
     total_duration = time.time() - total_start_time
     stats = [
@@ -967,11 +4725,14 @@ def download_youtube_videos(links_file=None):
         f"✓ Успешно скачано: {total_success}",
         f"⊘ Пропущено: {total_skip}",
         f"✗ Ошибок: {total_fail}",
-        f"Всего обработано: {len(active_links)} ссылок",
+        f"Всего обработано: {len(run_links)} ссылок",
         f"Общее время: {format_time(total_duration)}",
     ]
-    if len(active_links) > 0:
-        stats.append(f"Среднее время: {format_time(total_duration / len(active_links))}/ссылка")
+    if len(run_links) > 0:
+        stats.append(f"Среднее время: {format_time(total_duration / len(run_links))}/ссылка")
+    savings = container_savings_summary()
+    if savings:
+        stats.append(savings)
     stats.append("="*70)
 
     print(f"\n{colored('='*70, Fore.BLUE)}")
@@ -980,10 +4741,12 @@ def download_youtube_videos(links_file=None):
     print(colored(f"✓ Успешно: {total_success}", Fore.GREEN))
     print(colored(f"⊘ Пропущено: {total_skip}", Fore.CYAN))
     print(colored(f"✗ Ошибок: {total_fail}", Fore.RED))
-    print(colored(f"Всего: {len(active_links)} ссылок", Fore.CYAN))
+    print(colored(f"Всего: {len(run_links)} ссылок", Fore.CYAN))
     print(colored(f"Время: {format_time(total_duration)}", Fore.CYAN))
-    if len(active_links) > 0:
-        print(colored(f"Среднее: {format_time(total_duration / len(active_links))}/ссылка", Fore.CYAN))
+    if len(run_links) > 0:
+        print(colored(f"Среднее: {format_time(total_duration / len(run_links))}/ссылка", Fore.CYAN))
+    if savings:
+        print(colored(savings, Fore.CYAN))
     print(colored('='*70, Fore.BLUE))
 
     logger.info(f"\n{'='*70}")
@@ -1007,7 +4770,7 @@ def download_youtube_videos(links_file=None):
     incomplete_playlists = []
     for url in active_links:
         if is_playlist_url(url):
-            total_vids, _, remaining = get_playlist_info(url, archive_file, cfg, script_dir, None)
+            total_vids, _, remaining = playlist_completeness(url, archive_file, cfg, script_dir)
             if total_vids > 0 and remaining > 0:
                 incomplete_playlists.append((url, remaining))
 
@@ -1075,6 +4838,10 @@ def main_with_auto_restart():
         except KeyboardInterrupt:
             print(colored("\n\n⚠ ПРЕРВАНО ПОЛЬЗОВАТЕЛЕМ", Fore.YELLOW))
             print(colored("Завершение работы...", Fore.CYAN))
+            stop_download_engine()
+            stop_postprocess_pool()
+            stop_library_worker()
+            stop_quota_accounting()
             sys.exit(0)
 
         except Exception as e:
@@ -1221,20 +4988,236 @@ def run_cleanup():
         return
 
     print(colored("\n  Запуск cleaner...\n", Fore.CYAN))
+    # Без таймаута: cleaner интерактивный, а скан большой библиотеки может
+    # законно идти дольше любого фиксированного лимита. Для запуска без
+    # участия пользователя используйте его пакетный режим (--scan / --apply).
     try:
-        subprocess.run([sys.executable, cleaner_path], timeout=300)
-    except subprocess.TimeoutExpired:
-        print(colored("  \u26a0 Cleaner превысил таймаут (300 с)", Fore.YELLOW))
+        subprocess.run([sys.executable, cleaner_path])
     except Exception as e:
         print(colored(f"  \u274c Ошибка запуска cleaner: {e}", Fore.RED))
 
     print(colored("\n  Cleaner завершён.", Fore.GREEN))
 
+
+def build_catalog():
+    """Импортирует существующее дерево загрузок в каталог и создаёт недостающие .nfo."""
+    cfg = load_config()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    downloads_dir = os.path.join(script_dir, cfg["downloads"]["output_dir"])
+    index_path = _library_index_path(cfg, script_dir)
+    if index_path is None:
+        print(colored("  ⚠ Индекс библиотеки отключён (downloads.library_index = \"\")", Fore.YELLOW))
+        return False
+    if not os.path.isdir(downloads_dir):
+        print(colored(f"  ⚠ Папка загрузок не найдена: {downloads_dir}", Fore.YELLOW))
+        return False
+
+    print(colored(f"Построение каталога {downloads_dir}...", Fore.CYAN))
+    start = time.time()
+    conn = open_catalog(index_path)
+    try:
+        stats = backfill_catalog(conn, downloads_dir)
+        print(colored(f"✓ Каталог: {stats['items']} видео, разобрано {stats['parsed']}, "
+                      f"удалено {stats['removed']} за {format_time(time.time() - start)}", Fore.GREEN))
+        if stats['errors']:
+            print(colored(f"  ⚠ Нечитаемых .info.json: {stats['errors']}", Fore.YELLOW))
+
+        if cfg["downloads"].get("generate_nfo", True):
+            pending = catalog_pending_nfo(conn)
+            created = 0
+            for info_json in pending:
+                if generate_nfo_file(info_json):
+                    conn.execute("UPDATE catalog SET has_nfo = 1 WHERE info_json = ?", (info_json,))
+                    created += 1
+            conn.commit()
+            if pending:
+                print(colored(f"✓ Создано NFO файлов: {created}/{len(pending)}", Fore.GREEN))
+    finally:
+        conn.close()
+    return True
+
+
+def show_library_stats():
+    """Выводит статистику библиотеки из каталога без обхода папок."""
+    cfg = load_config()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    index_path = _library_index_path(cfg, script_dir)
+    if index_path is None or not os.path.isfile(index_path):
+        print(colored("  ⚠ Индекса библиотеки ещё нет: сначала запустите с --build-catalog", Fore.YELLOW))
+        return False
+
+    conn = open_catalog(index_path)
+    try:
+        stats = catalog_stats(conn)
+    finally:
+        conn.close()
+
+    print(colored("=" * 70, Fore.BLUE))
+    print(colored("  БИБЛИОТЕКА", Fore.CYAN))
+    print(colored("=" * 70, Fore.BLUE))
+    print(colored(f"  Видео: {stats['items']}  |  Размер: {format_size(stats['size'])}  |  "
+                  f"Длительность: {format_time(stats['duration'])}", Fore.GREEN))
+    for folder, count, size in stats['folders']:
+        print(f"    {folder or '.'}: {count} ({format_size(size)})")
+    print(colored(f"  Без .nfo: {stats['no_nfo']}  |  Без обложки: {stats['no_thumb']}", Fore.CYAN))
+    print(colored(f"  Метаданные без видео: {stats['orphans']}", Fore.CYAN))
+    print(colored(f"  Видео сразу в нескольких папках: {stats['multi_folder']}", Fore.CYAN))
+    print(colored(f"  Плейлисты с недостающими видео: {stats['incomplete_playlists']}", Fore.CYAN))
+    return True
+
+
+def show_quota_status(links_file=None):
+    """Выводит расход бюджетов по cookie-личностям и когда очередь будет разобрана."""
+    cfg = load_config()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    path = _quota_path(cfg, script_dir)
+    if path is None:
+        print(colored("  ⚠ Учет квот отключен: задайте quota.file", Fore.YELLOW))
+        return False
+
+    identity = cookie_identity(cfg, script_dir)
+    conn = open_quota_db(path)
+    try:
+        identities = [r[0] for r in conn.execute(
+            "SELECT DISTINCT identity FROM quota_usage ORDER BY identity")]
+        if identity not in identities:
+            identities.insert(0, identity)
+        print(colored("=" * 70, Fore.BLUE))
+        print(colored("  КВОТЫ", Fore.CYAN))
+        print(colored("=" * 70, Fore.BLUE))
+        for name in identities:
+            print(colored(f"  {name}{' (текущая)' if name == identity else ''}", Fore.GREEN))
+            for counter, key, seconds, unit in QUOTA_BUDGETS:
+                used = quota_usage(conn, name, seconds)[counter]
+                budget = cfg["quota"].get(key, 0) * unit
+                show = format_size if counter == 'bytes' else str
+                if budget > 0:
+                    print(f"    {key}: {show(used)} из {show(budget)} (осталось {show(max(0, budget - used))})")
+                else:
+                    print(f"    {key}: {show(used)} (без лимита)")
+        history = quota_usage(conn, identity, QUOTA_HISTORY_DAYS * 86400)
+        last_day = quota_usage(conn, identity, 86400)
+    finally:
+        conn.close()
+
+    links_path = os.path.join(script_dir, links_file or cfg["downloads"]["links_file"])
+    if not os.path.exists(links_path):
+        print(colored(f"  ⚠ Файл {links_path} не найден: очередь не подсчитана", Fore.YELLOW))
+        return True
+    links = read_links_file(links_path)
+    archive_file = os.path.join(script_dir, cfg["downloads"]["archive_file"])
+    print(colored(f"  Подсчет очереди ({len(links)} ссылок)...", Fore.CYAN))
+    remaining, unlisted = count_queued_videos(links, archive_file, cfg, script_dir)
+    msg = f"  Очередь: {remaining} видео"
+    if unlisted:
+        msg += f" (+ {unlisted} плейлистов, которые не удалось получить)"
+    print(colored(msg, Fore.CYAN))
+    projection = projected_drain_seconds(cfg, history, remaining)
+    if projection is None:
+        print(colored("  Темп не ограничен ни одним бюджетом", Fore.CYAN))
+    else:
+        seconds, key = projection
+        print(colored(f"  В темпе бюджета: очередь будет разобрана за {format_time(seconds)} (ограничивает {key})",
+                      Fore.GREEN))
+    if last_day['videos']:
+        print(colored(f"  В темпе последних 24 ч ({last_day['videos']} видео): "
+                      f"{format_time(remaining / last_day['videos'] * 86400)}", Fore.CYAN))
+    return True
+
+
+def search_library(text, limit=50):
+    """Выводит видео из каталога, подходящие под запрос, лучшие первыми."""
+    cfg = load_config()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    index_path = _library_index_path(cfg, script_dir)
+    if index_path is None or not os.path.isfile(index_path):
+        print(colored("  ⚠ Индекса библиотеки ещё нет: сначала запустите с --build-catalog", Fore.YELLOW))
+        return False
+    if not FTS5_AVAILABLE:
+        print(colored("  ⚠ SQLite в этом Python собран без FTS5: поиск недоступен", Fore.YELLOW))
+        return False
+
+    conn = open_catalog(index_path)
+    try:
+        start = time.perf_counter()
+        results = search_catalog(conn, text, limit)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    finally:
+        conn.close()
+
+    for rank, (path, title, folder) in enumerate(results, 1):
+        print(colored(f"{rank:3}. {title}", Fore.GREEN) + colored(f"  [{folder or '.'}]", Fore.CYAN))
+        print(f"     {path}")
+    print(colored(f"Найдено: {len(results)} ({elapsed_ms:.1f} мс)", Fore.CYAN))
+    return bool(results)
+
+
+def run_archive_rebuild(mode='merge'):
+    """Пересобирает download_archive.txt по дереву загрузок и сообщает о записях без файлов."""
+    cfg = load_config()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    downloads_dir = os.path.join(script_dir, cfg["downloads"]["output_dir"])
+    archive_file = os.path.join(script_dir, cfg["downloads"]["archive_file"])
+    if not os.path.isdir(downloads_dir):
+        print(colored(f"  ⚠ Папка загрузок не найдена: {downloads_dir}", Fore.YELLOW))
+        return False
+
+    print(colored(f"Пересборка {archive_file} по {downloads_dir} ({mode})...", Fore.CYAN))
+    start = time.time()
+    report = rebuild_archive(archive_file, downloads_dir, mode)
+    print(colored(f"✓ На диске: {report['on_disk']}, добавлено: {report['added']}, "
+                  f"в архиве теперь: {report['written']} ({format_time(time.time() - start)})", Fore.GREEN))
+
+    missing = report['missing']
+    if missing:
+        missing_file = archive_file + '.missing.txt'
+        with open(missing_file, 'w', encoding='utf-8') as f:
+            f.writelines(f"{extractor} {video_id}\n" for extractor, video_id in missing)
+        action = "удалены" if mode == 'replace' else "оставлены"
+        print(colored(f"  ⚠ В архиве, но без файла на диске ({action}): {len(missing)} -> {missing_file}", Fore.YELLOW))
+    return True
+
+
+def run_archive_compaction(extra_sources=()):
+    """Сортирует download_archive.txt и удаляет повторы на месте, вливая в него указанные архивы."""
+    cfg = load_config()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    archive_file = os.path.join(script_dir, cfg["downloads"]["archive_file"])
+    for path in extra_sources:
+        if not os.path.isfile(path):
+            print(colored(f"  ⚠ Архив не найден: {path}", Fore.YELLOW))
+            return False
+    if not os.path.exists(archive_file):
+        open(archive_file, 'a', encoding='utf-8').close()
+
+    lines_before = sum(1 for _ in _read_lines(archive_file))
+    start = time.time()
+    stats = compact_archive(archive_file, extra_sources)
+    print(colored(f"✓ {archive_file}: {lines_before} строк + влито архивов: {len(extra_sources)} -> "
+                  f"{stats['written']} уникальных записей ({format_time(time.time() - start)})", Fore.GREEN))
+    if stats['caught_up']:
+        print(colored(f"  Строк, дописанных работающей загрузкой во время сжатия: {stats['caught_up']}", Fore.CYAN))
+    return True
+
 if __name__ == '__main__':
+    admission_values = admission_hook_values(sys.argv)
+    if admission_values is not None:
+        sys.exit(run_admission_check(admission_values))
     import argparse
     parser = argparse.ArgumentParser(description="YouTube Downloader")
     parser.add_argument('--check', '-c', action='store_true', help='Check dependencies and exit')
     parser.add_argument('--cleanup', '-C', action='store_true', help='Run orphan metadata cleaner and exit')
+    parser.add_argument('--build-catalog', action='store_true', help='Import the downloads tree into the library catalog and exit')
+    parser.add_argument('--stats', action='store_true', help='Show library statistics from the catalog and exit')
+    parser.add_argument('--search', metavar='QUERY', help='Search the library catalog (title, description, channel, tags) and exit')
+    parser.add_argument('--rebuild-archive', nargs='?', const='merge', choices=['merge', 'replace'],
+                        help='Rebuild the download archive from files on disk (default: merge) and exit')
+    parser.add_argument('--compact-archive', action='store_true',
+                        help='Sort and deduplicate the download archive in place (safe during downloads) and exit')
+    parser.add_argument('--merge-archives', nargs='+', metavar='FILE',
+                        help='Merge other hosts\' archives into the download archive (sorted, deduplicated) and exit')
+    parser.add_argument('--quota-status', action='store_true',
+                        help='Show quota usage per cookie identity, the budget left and when the queue would be drained, and exit')
     args = parser.parse_args()
     if args.check:
         setup_check()
@@ -1242,4 +5225,16 @@ def run_cleanup():
     if args.cleanup:
         run_cleanup()
         sys.exit(0)
+    if args.build_catalog:
+        sys.exit(0 if build_catalog() else 1)
+    if args.stats:
+        sys.exit(0 if show_library_stats() else 1)
+    if args.search:
+        sys.exit(0 if search_library(args.search) else 1)
+    if args.rebuild_archive:
+        sys.exit(0 if run_archive_rebuild(args.rebuild_archive) else 1)
+    if args.compact_archive or args.merge_archives:
+        sys.exit(0 if run_archive_compaction(args.merge_archives or ()) else 1)
+    if args.quota_status:
+        sys.exit(0 if show_quota_status() else 1)
     main_with_auto_restart()
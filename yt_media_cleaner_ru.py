@@ -1,21 +1,44 @@
 #!/usr/bin/env python3
 """
 File Deduplicator & Orphan Media Cleaner
-- Находит дубли файлов по SHA-256 хэшу
-- Находит .json и .jpg без парного .mp4
+- Находит дубли файлов по хэшу (SHA-256 / BLAKE2b / xxHash), хэширование в пуле потоков
+- Кэширует хэши в SQLite: повторный скан читает только новые/изменённые файлы
+- Инкрементальный скан: в неизменённые папки (тот же mtime) не заходит повторно
+- Находит .json и .jpg без парного медиафайла (.mp4, .webm, .mkv, .m4a...)
 - Поддерживает ручной и автоматический режим удаления дублей
 - Жёсткая защита: удаляются ТОЛЬКО файлы .jpg / .jpeg / .json
+- Одинаковые видео в разных папках плейлистов заменяются hardlink/reflink
+  на одну копию (содержимое не удаляется: ссылка создаётся до замены)
+- Пакетный режим для cron: --scan пишет JSON-план, --apply удаляет по плану
+
+Пакетный режим:
+    python yt_media_cleaner_ru.py --scan [plan.json] [--mode dupes|orphans|both]
+    python yt_media_cleaner_ru.py --apply plan.json [--dry-run]
+    python yt_media_cleaner_ru.py --link-dupes [--dry-run]
 """
 
 from __future__ import annotations
 
 import os
 import sys
+import re
 import json
 import hashlib
+import argparse
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from pathlib import Path
 from collections import defaultdict
-from typing import Optional, List
+from typing import Optional, List, Tuple, Dict, NamedTuple
+
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
 
 # Корректный вывод UTF-8 в Windows (CMD, PowerShell, Windows Terminal)
 if sys.platform == "win32":
@@ -27,10 +50,35 @@
 # ЖЁСТКИЙ СПИСОК: скрипт физически не может удалить файл с другим расширением
 DELETABLE_EXTENSIONS = {".jpg", ".jpeg", ".json"}
 
+# Частичный хэш: первые и последние PARTIAL_HASH_SIZE байт файла.
+# Файлы не длиннее 2 * PARTIAL_HASH_SIZE читаются целиком, их частичный хэш = полный.
+PARTIAL_HASH_SIZE = 65536
+
+# Размер буфера чтения (переиспользуется потоком через readinto)
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# hashlib отпускает GIL на больших update(), поэтому потоки дают реальный параллелизм
+HASH_ALGORITHMS = ("sha256", "blake2b", "xxhash")
+
+# Видео, которые можно заменять ссылками на идентичную копию
+MEDIA_EXTENSIONS = (".mp4", ".mkv", ".webm", ".m4a")
+
+# Медиафайлы элемента: контейнеры downloads.container загрузчика (CATALOG_MEDIA_EXTENSIONS там).
+# По ним ищутся сироты — и по каталогу, и обходом папок
+CATALOG_MEDIA_EXTENSIONS = (".mp4", ".mkv", ".webm", ".m4a", ".mp3", ".opus")
+
+# Имя файла yt-dlp: "Название [VIDEO_ID].ext"
+VIDEO_ID_RE = re.compile(r"\[([A-Za-z0-9_-]{6,})\]\.[^.\[\]]+$")
+
+# ioctl FICLONE (Linux: Btrfs, XFS, bcachefs) — копия, разделяющая блоки с исходником
+FICLONE = 0x40049409
+
 # ─── КОНФИГ ───────────────────────────────────────────────────────────────────
 
 SCRIPT_DIR = Path(__file__).resolve().parent
 CONFIG_PATH = SCRIPT_DIR / "media_cleaner_config.json"
+DEFAULT_PLAN_PATH = SCRIPT_DIR / "media_cleaner_plan.json"
+PLAN_VERSION = 1
 
 DEFAULT_CONFIG: dict = {
     # Путь к рабочей директории.
@@ -38,6 +86,20 @@
     "work_dir": "",
     "duplicate_mode": "manual",        # "manual" | "auto"
     "auto_keep_strategy": "shortest_path",  # "shortest_path" | "oldest" | "newest"
+    # SQLite-кэш хэшей (относительно папки скрипта). "" — кэш отключён.
+    # Тот же файл, что library_index загрузчика: хэши, посчитанные при
+    # скачивании, используются без повторного чтения файлов.
+    "hash_cache_file": "library_index.sqlite",
+    "hash_algorithm": "sha256",        # "sha256" | "blake2b" | "xxhash" (pip install xxhash)
+    "hash_workers": 0,                 # потоков хэширования; 0 — по числу ядер
+    # Снимок папок в кэше: папки с прежним mtime не перечитываются
+    "incremental_scan": True,
+    # Сироты по каталогу загрузчика из того же файла, без обхода папок
+    # (если каталог есть: --build-catalog в yt_download). Отдельные .json/.jpg
+    # без .info.json каталог не знает, поэтому по умолчанию выключено
+    "catalog_orphans": False,
+    # Замена одинаковых видео ссылками: "auto" (reflink, иначе hardlink) | "hardlink" | "reflink"
+    "link_mode": "auto",
 }
 
 
@@ -90,6 +152,16 @@ def show_config(cfg: dict) -> None:
     print(f"  Режим удаления дублей : {mode_label}")
     if cfg["duplicate_mode"] == "auto":
         print(f"  Стратегия авто-режима : {strat}")
+    print(f"  Алгоритм хэширования  : {resolve_hash_algorithm(cfg)}"
+          f" ({resolve_hash_workers(cfg)} потоков)")
+    cache_path = resolve_cache_path(cfg)
+    print(f"  Кэш хэшей             : {cache_path if cache_path else '(отключён)'}")
+    if cache_path:
+        inc = "вкл" if cfg.get("incremental_scan", True) else "выкл"
+        print(f"  Инкрементальный скан  : {inc}")
+        orphans_label = "по каталогу загрузчика" if cfg.get("catalog_orphans", False) else "обходом папок"
+        print(f"  Поиск сирот           : {orphans_label}")
+    print(f"  Замена копий ссылками : {cfg.get('link_mode', 'auto')}")
     print(f"  Защищённые расширения : только .jpg/.jpeg/.json могут быть удалены")
 
 
@@ -102,6 +174,7 @@ def settings_menu(cfg: dict) -> dict:
     print("  1 -- Рабочая директория")
     print("  2 -- Режим удаления дублей (ручной / авто)")
     print("  3 -- Стратегия авто-режима")
+    print("  4 -- Алгоритм хэширования")
     print("  0 -- Назад")
 
     while True:
@@ -157,8 +230,22 @@ def settings_menu(cfg: dict) -> dict:
                 save_config(cfg)
             break
 
+        elif raw == "4":
+            print("\n  Алгоритм хэширования:")
+            print("  1 -- SHA-256 (по умолчанию)")
+            print("  2 -- BLAKE2b (быстрее на 64-битных CPU)")
+            xx_note = "" if XXHASH_AVAILABLE else " -- не установлен: pip install xxhash"
+            print(f"  3 -- xxHash  (самый быстрый, не криптографический){xx_note}")
+            sub = input("  Выбор: ").strip()
+            mapping = {"1": "sha256", "2": "blake2b", "3": "xxhash"}
+            if sub in mapping:
+                cfg["hash_algorithm"] = mapping[sub]
+                print(f"  >> Алгоритм: {resolve_hash_algorithm(cfg)}")
+                save_config(cfg)
+            break
+
         else:
-            print("  Введите 0, 1, 2 или 3.")
+            print("  Введите 0, 1, 2, 3 или 4.")
 
     return cfg
 
@@ -177,17 +264,19 @@ def is_deletable(path: Path) -> bool:
     return path.suffix.lower() in DELETABLE_EXTENSIONS
 
 
-def safe_unlink(path: Path) -> bool:
+def safe_unlink(path: Path, quiet: bool = False) -> bool:
     """
     Удалить файл с проверкой безопасности.
     Возвращает True при успехе, False при любой ошибке или блокировке.
+    quiet=True — не печатать строку на каждый удалённый файл (ошибки печатаются).
     """
     if not is_deletable(path):
         print(f"  [BLOCK] Удаление заблокировано (расширение не в списке): {path}")
         return False
     try:
         path.unlink()
-        print(f"  [OK] Удалён: {path}")
+        if not quiet:
+            print(f"  [OK] Удалён: {path}")
         return True
     except PermissionError:
         print(f"  [!!] Нет доступа (файл занят или защищён): {path}")
@@ -197,16 +286,84 @@ def safe_unlink(path: Path) -> bool:
         return False
 
 
-def calc_hash(filepath: Path, chunk_size: int = 65536) -> Optional[str]:
-    sha256 = hashlib.sha256()
+def resolve_hash_algorithm(cfg: dict) -> str:
+    """Алгоритм из настроек; xxhash без установленного модуля заменяется на blake2b."""
+    algo = cfg.get("hash_algorithm", "sha256")
+    if algo not in HASH_ALGORITHMS:
+        return "sha256"
+    if algo == "xxhash" and not XXHASH_AVAILABLE:
+        return "blake2b"
+    return algo
+
+
+def resolve_hash_workers(cfg: dict) -> int:
+    workers = cfg.get("hash_workers", 0)
+    if not isinstance(workers, int) or workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def new_hasher(algorithm: str):
+    if algorithm == "blake2b":
+        return hashlib.blake2b()
+    if algorithm == "xxhash":
+        return xxhash.xxh3_128()
+    return hashlib.sha256()
+
+
+_thread_buffers = threading.local()
+
+
+def _read_buffer() -> memoryview:
+    """Буфер чтения текущего потока (выделяется один раз на поток)."""
+    buf = getattr(_thread_buffers, "buf", None)
+    if buf is None:
+        buf = _thread_buffers.buf = memoryview(bytearray(HASH_BUFFER_SIZE))
+    return buf
+
+
+def _update_from(f, hasher, buf: memoryview, limit: Optional[int] = None) -> None:
+    """Дочитать файл (или limit байт) в hasher через readinto без лишних копий."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        view = buf if remaining is None or remaining >= len(buf) else buf[:remaining]
+        n = f.readinto(view)
+        if not n:
+            break
+        hasher.update(view[:n])
+        if remaining is not None:
+            remaining -= n
+
+
+def calc_hash(filepath: Path, algorithm: str = "sha256") -> Optional[str]:
+    hasher = new_hasher(algorithm)
     try:
-        with open(filepath, "rb") as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                sha256.update(chunk)
-        return sha256.hexdigest()
+        with open(filepath, "rb", buffering=0) as f:
+            _update_from(f, hasher, _read_buffer())
+        return hasher.hexdigest()
+    except (OSError, PermissionError) as e:
+        print(f"  [!] Не удалось прочитать {filepath}: {e}")
+        return None
+
+
+def calc_partial_hash(filepath: Path, size: int, algorithm: str = "sha256",
+                      chunk_size: int = PARTIAL_HASH_SIZE) -> Optional[str]:
+    """
+    Быстрый хэш: первые и последние chunk_size байт файла.
+    Для файлов не длиннее 2 * chunk_size хэшируется всё содержимое,
+    и результат совпадает с calc_hash().
+    """
+    hasher = new_hasher(algorithm)
+    try:
+        with open(filepath, "rb", buffering=0) as f:
+            buf = _read_buffer()
+            if size <= 2 * chunk_size:
+                _update_from(f, hasher, buf)
+            else:
+                _update_from(f, hasher, buf, chunk_size)
+                f.seek(-chunk_size, os.SEEK_END)
+                _update_from(f, hasher, buf, chunk_size)
+        return hasher.hexdigest()
     except (OSError, PermissionError) as e:
         print(f"  [!] Не удалось прочитать {filepath}: {e}")
         return None
@@ -220,45 +377,425 @@ def fmt_size(size: int) -> str:
     return f"{size:.1f} PB"
 
 
-def walk(root: Path):
-    for dirpath, dirnames, filenames in os.walk(root):
-        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
-        yield Path(dirpath), filenames
+# ─── СКАН ДЕРЕВА ──────────────────────────────────────────────────────────────
 
+class FileInfo(NamedTuple):
+    """Файл из скана: stat берётся один раз из DirEntry и больше не повторяется."""
+    path: Path
+    size: int
+    mtime_ns: int
+    dev: int
+    ino: int
 
-# ─── 1. ДУБЛИ ─────────────────────────────────────────────────────────────────
 
-def find_duplicates(root: Path) -> dict:
-    print("\n[>>] Сканирую файлы для поиска дублей...")
-    hash_map: dict = defaultdict(list)
+def _file_info(entry: os.DirEntry, dir_dev: int) -> FileInfo:
+    st = entry.stat()
+    # В Windows DirEntry.stat() не заполняет st_ino/st_dev:
+    # inode берём отдельно, устройство — от родительской папки
+    ino = st.st_ino or entry.inode()
+    dev = st.st_dev or dir_dev
+    return FileInfo(Path(entry.path), st.st_size, st.st_mtime_ns, dev, ino)
+
+
+def scan_dir(dir_path: Path) -> Tuple[List[FileInfo], List[Path]]:
+    """
+    Один проход os.scandir по папке.
+    Возвращает (файлы, подпапки); скрытые подпапки пропускаются.
+    """
+    files: List[FileInfo] = []
+    subdirs: List[Path] = []
+    try:
+        dir_dev = os.stat(dir_path).st_dev
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith("."):
+                            subdirs.append(Path(entry.path))
+                    elif entry.is_file():
+                        files.append(_file_info(entry, dir_dev))
+                except OSError:
+                    continue
+    except OSError as e:
+        print(f"  [!] Не удалось прочитать папку {dir_path}: {e}")
+    subdirs.sort()
+    return files, subdirs
+
+
+class DirScan(NamedTuple):
+    """Результат скана одной папки."""
+    files: List[FileInfo]
+    subdirs: List[Path]
+    orphans: List[FileInfo]
+
+
+# Папки, изменённые меньше чем за столько наносекунд до начала скана, в снимок
+# не записываются: на ФС с грубым mtime (FAT — 2 с) изменение в тот же «тик»
+# иначе осталось бы незамеченным.
+SNAPSHOT_RACY_NS = 2_000_000_000
+
+
+def _encode_dir(scan: DirScan) -> Tuple[str, str, str]:
+    files = json.dumps([[f.path.name, f.size, f.mtime_ns, f.dev, f.ino] for f in scan.files])
+    subdirs = json.dumps([d.name for d in scan.subdirs])
+    orphans = json.dumps([f.path.name for f in scan.orphans])
+    return files, subdirs, orphans
+
+
+def _decode_dir(dir_path: Path, files_json: str, subdirs_json: str, orphans_json: str) -> DirScan:
+    files = [FileInfo(dir_path / name, size, mtime_ns, dev, ino)
+             for name, size, mtime_ns, dev, ino in json.loads(files_json)]
+    # Сироты пересчитываются по списку файлов: снимок мог сохранить их по прежнему
+    # правилу (только .mp4), а пересчёт обходится без обращений к диску
+    orphans = dir_orphans(files)
+    subdirs = [dir_path / name for name in json.loads(subdirs_json)]
+    return DirScan(files, subdirs, orphans)
+
+
+def load_snapshot(conn: Optional[sqlite3.Connection], root: Path) -> dict:
+    """Снимок папок под root: {str(path): (mtime_ns, files, subdirs, orphans)}."""
+    if conn is None:
+        return {}
+    prefix = str(root).rstrip(os.sep) + os.sep
+    rows = conn.execute(
+        "SELECT path, mtime_ns, files, subdirs, orphans FROM dir_snapshot"
+        " WHERE path = ? OR substr(path, 1, ?) = ?",
+        (str(root), len(prefix), prefix),
+    )
+    return {row[0]: row[1:] for row in rows}
+
+
+def save_snapshot(conn: sqlite3.Connection, root: Path, tree: Dict[Path, DirScan],
+                  changed: dict, snapshot: dict) -> None:
+    """Записать изменённые папки и удалить строки исчезнувших."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO dir_snapshot (path, mtime_ns, files, subdirs, orphans)"
+        " VALUES (?, ?, ?, ?, ?)",
+        ((str(d), mtime_ns, *_encode_dir(tree[d])) for d, mtime_ns in changed.items()),
+    )
+    gone = [(path,) for path in snapshot if Path(path) not in tree]
+    conn.executemany("DELETE FROM dir_snapshot WHERE path = ?", gone)
+    conn.commit()
+
+
+def scan_tree(root: Path,
+              snapshot_conn: Optional[sqlite3.Connection] = None) -> Dict[Path, DirScan]:
+    """
+    Обойти дерево за один проход: {папка: DirScan}.
+    И дубли, и осиротевшие файлы, и размеры считаются из этого результата —
+    на каждый файл приходится примерно один системный вызов.
+
+    С snapshot_conn скан инкрементальный: папка, чей mtime совпал со снимком,
+    не перечитывается — её файлы, подпапки и сироты берутся из снимка
+    (один stat на папку). mtime папки меняется только при добавлении,
+    удалении или переименовании записей, поэтому файлы, перезаписанные
+    на месте, find_duplicates() дополнительно сверяет перед удалением.
+    """
+    print("\n[>>] Сканирую дерево файлов...")
+    snapshot = load_snapshot(snapshot_conn, root)
+    scan_started_ns = time.time_ns()
+    tree: Dict[Path, DirScan] = {}
+    changed: dict = {}
+    reused = 0
     total = 0
+    stack = [root]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            mtime_ns = -1
+        row = snapshot.get(str(dir_path))
+        if row is not None and mtime_ns != -1 and row[0] == mtime_ns:
+            scan = _decode_dir(dir_path, *row[1:])
+            reused += 1
+        else:
+            files, subdirs = scan_dir(dir_path)
+            scan = DirScan(files, subdirs, dir_orphans(files))
+            racy = mtime_ns >= scan_started_ns - SNAPSHOT_RACY_NS
+            changed[dir_path] = -1 if racy else mtime_ns
+        tree[dir_path] = scan
+        total += len(scan.files)
+        stack.extend(reversed(scan.subdirs))
+
+    if snapshot_conn is not None:
+        save_snapshot(snapshot_conn, root, tree, changed, snapshot)
+        print(f"  Папок: {len(tree)} (без изменений: {reused}), файлов: {total}")
+    else:
+        print(f"  Папок: {len(tree)}, файлов: {total}")
+    return tree
+
+
+# ─── КЭШ ХЭШЕЙ ────────────────────────────────────────────────────────────────
+#
+# Строка кэша привязана к (st_dev, st_ino, st_size, st_mtime_ns): если файл
+# переименован — хэш по-прежнему валиден, если изменён — размер/mtime
+# не совпадут и файл будет перехэширован. Путь хранится только для
+# очистки строк, чьи файлы исчезли.
+
+def resolve_cache_path(cfg: dict) -> Optional[Path]:
+    """Путь к SQLite-кэшу хэшей или None, если кэш отключён."""
+    raw = cfg.get("hash_cache_file", "").strip()
+    if not raw:
+        return None
+    p = Path(raw).expanduser()
+    return p if p.is_absolute() else SCRIPT_DIR / p
+
+
+def open_hash_cache(path: Optional[Path]) -> Optional[sqlite3.Connection]:
+    """
+    Открыть (или создать) кэш хэшей.
+    Возвращает None, если кэш отключён или база недоступна — тогда
+    скан работает как раньше, без кэша.
+    """
+    if path is None:
+        return None
+    try:
+        conn = sqlite3.connect(str(path))
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(file_hashes)")}
+        if columns and "algo" not in columns:
+            # Кэш старого формата (только SHA-256) — проще пересоздать
+            conn.execute("DROP TABLE file_hashes")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            " dev INTEGER NOT NULL,"
+            " ino INTEGER NOT NULL,"
+            " algo TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " path TEXT NOT NULL,"
+            " partial TEXT,"
+            " full TEXT,"
+            " PRIMARY KEY (dev, ino, algo))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS dir_snapshot ("
+            " path TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " files TEXT NOT NULL,"
+            " subdirs TEXT NOT NULL,"
+            " orphans TEXT NOT NULL)"
+        )
+        conn.commit()
+        return conn
+    except sqlite3.Error as e:
+        print(f"  [!] Кэш хэшей недоступен ({path}): {e}")
+        return None
+
+
+def cache_key(info: FileInfo) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Ключ кэша (dev, ino, size, mtime_ns).
+    None, если ФС не выдаёт номер inode (FAT, часть сетевых дисков) —
+    такие файлы всегда хэшируются заново.
+    """
+    if not info.ino:
+        return None
+    return (info.dev, info.ino, info.size, info.mtime_ns)
+
+
+def cache_get(conn: Optional[sqlite3.Connection],
+              key: Optional[Tuple[int, int, int, int]],
+              algorithm: str) -> Tuple[Optional[str], Optional[str]]:
+    """Вернуть (partial, full) из кэша или (None, None) при промахе."""
+    if conn is None or key is None:
+        return None, None
+    row = conn.execute(
+        "SELECT size, mtime_ns, partial, full FROM file_hashes"
+        " WHERE dev = ? AND ino = ? AND algo = ?",
+        (*key[:2], algorithm),
+    ).fetchone()
+    if row is None or (row[0], row[1]) != key[2:]:
+        return None, None
+    return row[2], row[3]
+
+
+def cache_put(conn: Optional[sqlite3.Connection],
+              key: Optional[Tuple[int, int, int, int]], path: Path, algorithm: str,
+              partial: Optional[str] = None, full: Optional[str] = None) -> None:
+    """
+    Записать хэш(и) файла. Непереданный хэш сохраняется из кэша,
+    если файл с тех пор не менялся (тот же size/mtime).
+    """
+    if conn is None or key is None:
+        return
+    dev, ino, size, mtime_ns = key
+    conn.execute(
+        "INSERT INTO file_hashes (dev, ino, algo, size, mtime_ns, path, partial, full)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT (dev, ino, algo) DO UPDATE SET"
+        "  partial = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns"
+        "   THEN COALESCE(excluded.partial, partial) ELSE excluded.partial END,"
+        "  full = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns"
+        "   THEN COALESCE(excluded.full, full) ELSE excluded.full END,"
+        "  size = excluded.size, mtime_ns = excluded.mtime_ns, path = excluded.path",
+        (dev, ino, algorithm, size, mtime_ns, str(path), partial, full),
+    )
+
+
+def cache_prune(conn: Optional[sqlite3.Connection], root: Path, seen: set) -> int:
+    """
+    Удалить строки кэша под root, чьих файлов (dev, ino) больше нет.
+    Строки других рабочих директорий не трогаются.
+    Возвращает количество удалённых строк.
+    """
+    if conn is None:
+        return 0
+    prefix = str(root).rstrip(os.sep) + os.sep
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen_files (dev INTEGER, ino INTEGER)")
+    conn.execute("DELETE FROM seen_files")
+    conn.executemany("INSERT INTO seen_files VALUES (?, ?)", seen)
+    cur = conn.execute(
+        "DELETE FROM file_hashes"
+        " WHERE substr(path, 1, ?) = ?"
+        " AND NOT EXISTS (SELECT 1 FROM seen_files s"
+        "  WHERE s.dev = file_hashes.dev AND s.ino = file_hashes.ino)",
+        (len(prefix), prefix),
+    )
+    conn.execute("DELETE FROM seen_files")
+    conn.commit()
+    return cur.rowcount
 
-    for dir_path, filenames in walk(root):
-        for name in filenames:
-            if name.startswith("."):
+
+# ─── 1. ДУБЛИ ─────────────────────────────────────────────────────────────────
+
+def _hash_job(info: FileInfo, algorithm: str, full: bool) -> Optional[str]:
+    if full:
+        return calc_hash(info.path, algorithm)
+    return calc_partial_hash(info.path, info.size, algorithm)
+
+
+def hash_files(files: List[FileInfo], algorithm: str, workers: int,
+               cache: Optional[sqlite3.Connection], full: bool, stats: dict) -> dict:
+    """
+    Посчитать хэши файлов: из кэша или в пуле потоков.
+    Запись в кэш и вывод прогресса — только из главного потока
+    (соединение SQLite не разделяется между потоками).
+    Возвращает {path: digest}; нечитаемые файлы пропускаются.
+    """
+    results: dict = {}
+    todo: List[FileInfo] = []
+    for info in files:
+        partial, full_h = cache_get(cache, cache_key(info), algorithm)
+        cached = full_h if full else partial
+        if cached:
+            results[info.path] = cached
+            stats["from_cache"] += 1
+        else:
+            todo.append(info)
+
+    if not todo:
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_hash_job, info, algorithm, full): info for info in todo}
+        for fut in as_completed(futures):
+            info = futures[fut]
+            h = fut.result()
+            stats["hashed"] += 1
+            stats["bytes"] += info.size if full else min(info.size, 2 * PARTIAL_HASH_SIZE)
+            if not h:
                 continue
-            fp = dir_path / name
-            if not fp.is_file():
+            results[info.path] = h
+            key = cache_key(info)
+            if full:
+                cache_put(cache, key, info.path, algorithm, full=h)
+            elif info.size <= 2 * PARTIAL_HASH_SIZE:
+                # Маленький файл прочитан целиком — полный хэш уже известен
+                cache_put(cache, key, info.path, algorithm, partial=h, full=h)
+            else:
+                cache_put(cache, key, info.path, algorithm, partial=h)
+            if cache is not None and stats["hashed"] % 500 == 0:
+                cache.commit()
+            if stats["hashed"] % 50 == 0:
+                elapsed = max(time.monotonic() - stats["started"], 1e-6)
+                mb = stats["bytes"] / (1024 * 1024)
+                print(f"  Прочитано: {stats['hashed']} файлов, {mb:.0f} MB,"
+                      f" {mb / elapsed:.1f} MB/s    ", end="\r", flush=True)
+    return results
+
+
+def find_duplicates(root: Path, cache: Optional[sqlite3.Connection] = None,
+                    algorithm: str = "sha256", workers: int = 1,
+                    tree: Optional[Dict[Path, DirScan]] = None) -> dict:
+    """
+    Поиск дублей в три этапа:
+      1. группировка по размеру — файлы с уникальным размером не читаются;
+      2. частичный хэш (начало + конец файла) внутри групп одного размера;
+      3. полный хэш только для совпавших частичных хэшей.
+    Хэши берутся из кэша, если файл не менялся с прошлого скана;
+    остальные считаются в пуле из workers потоков.
+    tree — готовый результат scan_tree(), чтобы не обходить дерево повторно.
+    Возвращает {hash: [FileInfo, ...]} для групп из 2+ файлов.
+    """
+    if tree is None:
+        tree = scan_tree(root)
+    print("\n[>>] Ищу дубли...")
+    by_size: dict = defaultdict(list)
+    seen: set = set()
+
+    for scan in tree.values():
+        for info in scan.files:
+            if info.path.name.startswith("."):
                 continue
-            total += 1
-            if total % 50 == 0:
-                print(f"  Файлов обработано: {total}", end="\r", flush=True)
-            h = calc_hash(fp)
-            if h:
-                hash_map[h].append(fp)
+            if info.ino:
+                seen.add((info.dev, info.ino))
+            by_size[info.size].append(info)
 
-    print(f"  Всего файлов проверено: {total}               ")
-    return {h: paths for h, paths in hash_map.items() if len(paths) > 1}
+    stats = {"hashed": 0, "from_cache": 0, "bytes": 0, "started": time.monotonic()}
 
+    candidates = [info for files in by_size.values() if len(files) > 1 for info in files]
+    partials = hash_files(candidates, algorithm, workers, cache, False, stats)
+    by_partial: dict = defaultdict(list)
+    for info in candidates:
+        if info.path in partials:
+            by_partial[(info.size, partials[info.path])].append(info)
 
-def pick_file_to_keep(paths: List[Path], strategy: str) -> Path:
+    candidates = [info for files in by_partial.values() if len(files) > 1 for info in files]
+    fulls = hash_files(candidates, algorithm, workers, cache, True, stats)
+    hash_map: dict = defaultdict(list)
+    for info in candidates:
+        if info.path in fulls and _is_fresh(info, cache):
+            hash_map[fulls[info.path]].append(info)
+
+    elapsed = max(time.monotonic() - stats["started"], 1e-6)
+    mb = stats["bytes"] / (1024 * 1024)
+    summary = (f"  Прочитано файлов: {stats['hashed']} ({mb:.0f} MB, {mb / elapsed:.1f} MB/s),"
+               f" из кэша: {stats['from_cache']}")
+    if cache is not None:
+        cache.commit()
+        summary += f", устаревших записей удалено: {cache_prune(cache, root, seen)}"
+    print(summary + "               ")
+    return {h: files for h, files in hash_map.items() if len(files) > 1}
+
+
+def _is_fresh(info: FileInfo, cache: Optional[sqlite3.Connection]) -> bool:
+    """
+    Сверить кандидата в дубли с диском: файл из инкрементального снимка мог
+    быть перезаписан на месте (mtime папки при этом не меняется).
+    Устаревший файл исключается, а снимок его папки сбрасывается —
+    при следующем скане папка будет прочитана заново.
+    """
+    try:
+        st = os.stat(info.path)
+    except OSError:
+        st = None
+    if st is not None and (st.st_size, st.st_mtime_ns) == (info.size, info.mtime_ns):
+        return True
+    print(f"  [!] Файл изменился после скана, пропущен: {info.path}")
+    if cache is not None:
+        cache.execute("DELETE FROM dir_snapshot WHERE path = ?", (str(info.path.parent),))
+    return False
+
+
+def pick_file_to_keep(files: List[FileInfo], strategy: str) -> FileInfo:
     if strategy == "shortest_path":
-        return min(paths, key=lambda p: len(str(p)))
+        return min(files, key=lambda f: len(str(f.path)))
     elif strategy == "oldest":
-        return min(paths, key=lambda p: p.stat().st_mtime)
+        return min(files, key=lambda f: f.mtime_ns)
     elif strategy == "newest":
-        return max(paths, key=lambda p: p.stat().st_mtime)
-    return paths[0]
+        return max(files, key=lambda f: f.mtime_ns)
+    return files[0]
 
 
 def handle_duplicates(duplicates: dict, cfg: dict) -> None:
@@ -279,6 +816,24 @@ def handle_duplicates(duplicates: dict, cfg: dict) -> None:
         _handle_duplicates_manual(groups)
 
 
+def plan_duplicate_deletions(groups: list, strategy: str) -> Tuple[list, int]:
+    """
+    Выбрать по стратегии, что оставить в каждой группе дублей.
+    Возвращает ([(keep, delete), ...], число пропущенных защищённых файлов).
+    """
+    to_delete: list = []
+    skipped_protected = 0
+    for file_hash, files in groups:
+        keep = pick_file_to_keep(files, strategy)
+        for f in files:
+            if f != keep:
+                if is_deletable(f.path):
+                    to_delete.append((keep, f))
+                else:
+                    skipped_protected += 1
+    return to_delete, skipped_protected
+
+
 def _handle_duplicates_auto(groups: list, strategy: str) -> None:
     strat_labels = {
         "shortest_path": "кратчайший путь",
@@ -287,20 +842,7 @@ def _handle_duplicates_auto(groups: list, strategy: str) -> None:
     }
     print(f"  Режим: Авто  |  Стратегия: {strat_labels.get(strategy, strategy)}\n")
 
-    to_delete: list = []
-    skipped_protected: int = 0
-
-    for file_hash, paths in groups:
-        try:
-            keep = pick_file_to_keep(paths, strategy)
-        except OSError:
-            keep = paths[0]
-        for p in paths:
-            if p != keep:
-                if is_deletable(p):
-                    to_delete.append((keep, p))
-                else:
-                    skipped_protected += 1
+    to_delete, skipped_protected = plan_duplicate_deletions(groups, strategy)
 
     if skipped_protected:
         print(f"  [BLOCK] Пропущено защищённых файлов: {skipped_protected} (расширение не .jpg/.jpeg/.json)")
@@ -310,35 +852,28 @@ def _handle_duplicates_auto(groups: list, strategy: str) -> None:
         return
 
     for i, (keep, delete) in enumerate(to_delete, 1):
-        try:
-            sz = delete.stat().st_size
-        except OSError:
-            sz = 0
-        print(f"  {i:>4}. УДАЛИТЬ : {delete}  [{fmt_size(sz)}]")
-        print(f"        ОСТАВИТЬ: {keep}\n")
+        print(f"  {i:>4}. УДАЛИТЬ : {delete.path}  [{fmt_size(delete.size)}]")
+        print(f"        ОСТАВИТЬ: {keep.path}\n")
 
     confirm = input(
         f"\n  Удалить {len(to_delete)} файл(ов) автоматически? (y/n): "
     ).strip().lower()
     if confirm == "y":
-        deleted = sum(1 for _, p in to_delete if safe_unlink(p))
+        deleted = sum(1 for _, f in to_delete if safe_unlink(f.path))
         print(f"\n  Удалено файлов: {deleted}/{len(to_delete)}")
     else:
         print("  Отменено.")
 
 
 def _handle_duplicates_manual(groups: list) -> None:
-    for g_idx, (file_hash, paths) in enumerate(groups, 1):
+    for g_idx, (file_hash, files) in enumerate(groups, 1):
         print(f"\n{'='*72}")
         print(f"Группа {g_idx}/{len(groups)}")
         print("\nВыберите файл для удаления (0 -- пропустить, q -- выход):\n")
 
         infos: list = []
-        for i, p in enumerate(paths, 1):
-            try:
-                sz = p.stat().st_size
-            except OSError:
-                sz = 0
+        for i, f in enumerate(files, 1):
+            p, sz = f.path, f.size
             protected = not is_deletable(p)
             tag = " [ЗАЩИЩЁН -- удаление невозможно]" if protected else ""
             infos.append((p, sz, protected))
@@ -386,42 +921,95 @@ def get_base_stem(name: str) -> str:
     return Path(name).stem
 
 
-def find_orphans(root: Path) -> List[Path]:
-    print("\n[>>] Ищу .json/.jpg без парного .mp4...")
+def find_orphans(root: Path,
+                 tree: Optional[Dict[Path, DirScan]] = None) -> List[FileInfo]:
+    """
+    .json/.jpg/.jpeg без парного медиафайла (CATALOG_MEDIA_EXTENSIONS) в той же папке.
+    tree — готовый результат scan_tree(); сироты посчитаны (или взяты
+    из снимка) при скане каждой папки.
+    """
+    if tree is None:
+        tree = scan_tree(root)
+    print("\n[>>] Ищу .json/.jpg без парного медиафайла...")
+
+    orphans: List[FileInfo] = []
+    for scan in tree.values():
+        orphans.extend(scan.orphans)
+    return orphans
 
-    mp4_stems: dict = defaultdict(set)
-    for dir_path, filenames in walk(root):
-        for name in filenames:
-            if name.lower().endswith(".mp4"):
-                mp4_stems[dir_path].add(Path(name).stem)
 
-    orphans: List[Path] = []
+def dir_orphans(files: List[FileInfo]) -> List[FileInfo]:
+    """Осиротевшие файлы одной папки (stem-ы медиафайлов собираются из того же списка)."""
     ext_targets = (".json", ".jpg", ".jpeg")
+    media_stems = {Path(f.path.name).stem for f in files
+                   if f.path.name.lower().endswith(CATALOG_MEDIA_EXTENSIONS)}
+    return [
+        f for f in files
+        if f.path.name.lower().endswith(ext_targets)
+        and get_base_stem(f.path.name) not in media_stems
+    ]
+
 
-    for dir_path, filenames in walk(root):
-        dir_mp4 = mp4_stems.get(dir_path, set())
-        for name in filenames:
-            lower = name.lower()
-            if any(lower.endswith(ext) for ext in ext_targets):
-                stem = get_base_stem(name)
-                if stem not in dir_mp4:
-                    orphans.append(dir_path / name)
+def catalog_orphans(conn: Optional[sqlite3.Connection], root: Path) -> Optional[List[FileInfo]]:
+    """
+    Сироты по каталогу загрузчика (таблица catalog в том же library_index):
+    .info.json без медиафайла и его обложка .jpg/.jpeg — индексный запрос
+    вместо обхода дерева. None, если каталога нет или в нём нет ничего
+    из root (--build-catalog ещё не запускали) — тогда ищем обходом.
+    Отдельные .json/.jpg без .info.json каталог не знает.
+    """
+    if conn is None:
+        return None
+    prefix = str(root) + os.sep
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'catalog'").fetchone() is None:
+            return None
+        # info_json — PRIMARY KEY: диапазон по префиксу идёт по индексу
+        in_root = "info_json >= ? AND info_json < ?"
+        bounds = (prefix, prefix + "\U0010ffff")
+        if conn.execute(f"SELECT 1 FROM catalog WHERE {in_root} LIMIT 1", bounds).fetchone() is None:
+            return None
+        rows = conn.execute(
+            f"SELECT info_json FROM catalog WHERE media_path IS NULL AND {in_root}", bounds).fetchall()
+    except sqlite3.Error:
+        return None
 
+    orphans: List[FileInfo] = []
+    for (info_json,) in rows:
+        stem = info_json[: -len(".info.json")]
+        # Каталог мог отстать от диска: появившееся видео снимает пометку
+        if any(os.path.exists(stem + ext) for ext in CATALOG_MEDIA_EXTENSIONS):
+            continue
+        for path in (info_json, stem + ".jpg", stem + ".jpeg"):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            orphans.append(FileInfo(Path(path), st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino))
     return orphans
 
 
-def handle_orphans(orphans: List[Path]) -> None:
+def collect_orphans(root: Path, cfg: dict, cache: Optional[sqlite3.Connection],
+                    tree: Optional[Dict[Path, DirScan]] = None) -> List[FileInfo]:
+    """Сироты из каталога загрузчика (если он есть и включён catalog_orphans), иначе обходом дерева."""
+    if cfg.get("catalog_orphans", False):
+        orphans = catalog_orphans(cache, root)
+        if orphans is not None:
+            print("\n[>>] Сироты по каталогу библиотеки (без обхода папок)...")
+            return orphans
+    if tree is None:
+        tree = scan_tree(root, cache if cfg.get("incremental_scan", True) else None)
+    return find_orphans(root, tree)
+
+
+def handle_orphans(orphans: List[FileInfo]) -> None:
     if not orphans:
         print("\n[OK] Осиротевших файлов не найдено.")
         return
 
     print(f"\n[!!] Найдено осиротевших файлов: {len(orphans)}\n")
-    for i, p in enumerate(orphans, 1):
-        try:
-            sz = p.stat().st_size
-        except OSError:
-            sz = 0
-        print(f"  {i:>4}. [{fmt_size(sz):>10}]  {p}")
+    for i, f in enumerate(orphans, 1):
+        print(f"  {i:>4}. [{fmt_size(f.size):>10}]  {f.path}")
 
     print("\nДоступные действия:")
     print("  all      -- удалить все")
@@ -445,7 +1033,7 @@ def handle_orphans(orphans: List[Path]) -> None:
                 f"  Удалить все {len(orphans)} файлов? (y/n): "
             ).strip().lower()
             if conf == "y":
-                deleted = sum(1 for p in orphans if safe_unlink(p))
+                deleted = sum(1 for f in orphans if safe_unlink(f.path))
                 print(f"\n  Удалено: {deleted}/{len(orphans)}")
             else:
                 print("  Отменено.")
@@ -454,7 +1042,7 @@ def handle_orphans(orphans: List[Path]) -> None:
         else:
             try:
                 nums = [int(x.strip()) for x in raw.split(",") if x.strip()]
-                selected: List[Path] = []
+                selected: List[FileInfo] = []
                 valid = True
                 for n in nums:
                     if 1 <= n <= len(orphans):
@@ -466,11 +1054,11 @@ def handle_orphans(orphans: List[Path]) -> None:
 
                 if valid and selected:
                     print(f"\n  Будут удалены ({len(selected)} шт.):")
-                    for p in selected:
-                        print(f"    - {p}")
+                    for f in selected:
+                        print(f"    - {f.path}")
                     conf = input("  Подтвердите (y/n): ").strip().lower()
                     if conf == "y":
-                        deleted = sum(1 for p in selected if safe_unlink(p))
+                        deleted = sum(1 for f in selected if safe_unlink(f.path))
                         print(f"  Удалено: {deleted}/{len(selected)}")
                     else:
                         print("  Отменено.")
@@ -479,6 +1067,272 @@ def handle_orphans(orphans: List[Path]) -> None:
                 print("  Введите 'all', 'skip', 'q' или номера через запятую (1,3,5).")
 
 
+# ─── 3. ОДИНАКОВЫЕ ВИДЕО В РАЗНЫХ ПАПКАХ ──────────────────────────────────────
+#
+# Одно и то же видео из канала и, например, из «Смотреть позже» лежит в двух
+# папках плейлистов. Копии с одинаковым ID и одинаковым хэшем заменяются
+# ссылкой на одну из них. Это не удаление: ссылка создаётся во временный файл
+# рядом с копией и атомарно встаёт на её место (os.replace), так что в любой
+# момент на диске остаётся хотя бы один полный экземпляр.
+
+def video_id_from_name(name: str) -> Optional[str]:
+    m = VIDEO_ID_RE.search(name)
+    return m.group(1) if m else None
+
+
+def find_link_groups(tree: Dict[Path, DirScan], cache: Optional[sqlite3.Connection],
+                     algorithm: str, workers: int) -> List[List[FileInfo]]:
+    """
+    Группы идентичных медиафайлов: одинаковый ID в имени, размер и полный хэш.
+    Файлы, уже являющиеся ссылками друг на друга (тот же dev+ino), считаются одной копией.
+    """
+    by_id: dict = defaultdict(dict)
+    for scan in tree.values():
+        for info in scan.files:
+            if not info.path.name.lower().endswith(MEDIA_EXTENSIONS):
+                continue
+            vid = video_id_from_name(info.path.name)
+            if vid:
+                by_id[(vid, info.size)].setdefault((info.dev, info.ino), info)
+
+    candidates = [info for files in by_id.values() if len(files) > 1 for info in files.values()]
+    if not candidates:
+        return []
+    stats = {"hashed": 0, "from_cache": 0, "bytes": 0, "started": time.monotonic()}
+    fulls = hash_files(candidates, algorithm, workers, cache, True, stats)
+
+    groups: dict = defaultdict(list)
+    for info in candidates:
+        h = fulls.get(info.path)
+        if h and _is_fresh(info, cache):
+            groups[(video_id_from_name(info.path.name), h)].append(info)
+    return [files for files in groups.values() if len(files) > 1]
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    if sys.platform != "linux":
+        return False
+    import fcntl
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        try:
+            dst.unlink()
+        except OSError:
+            pass
+        return False
+
+
+def link_replace(keep: FileInfo, target: FileInfo, link_mode: str) -> Optional[str]:
+    """
+    Заменить target ссылкой на keep. Возвращает "reflink"/"hardlink" или None.
+    Обе копии сверяются с диском прямо перед заменой.
+    """
+    if not (_matches_disk(_plan_entry(keep)) and _matches_disk(_plan_entry(target))):
+        return None
+    tmp = target.path.with_name(target.path.name + ".linktmp")
+    try:
+        tmp.unlink()  # остаток прерванного запуска
+    except OSError:
+        pass
+    method = None
+    if link_mode in ("auto", "reflink") and _reflink(keep.path, tmp):
+        os.chmod(tmp, os.stat(target.path).st_mode & 0o7777)
+        os.utime(tmp, ns=(target.mtime_ns, target.mtime_ns))
+        method = "reflink"
+    elif link_mode in ("auto", "hardlink") and keep.dev == target.dev:
+        try:
+            os.link(keep.path, tmp)
+            method = "hardlink"
+        except OSError:
+            return None
+    if method is None:
+        return None
+    try:
+        os.replace(tmp, target.path)
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        return None
+    return method
+
+
+def dedup_links(root: Path, cfg: dict, tree: Dict[Path, DirScan],
+                cache: Optional[sqlite3.Connection], dry_run: bool = False,
+                confirm: bool = False) -> dict:
+    """
+    Заменить одинаковые видео ссылками на одну копию (её выбирает auto_keep_strategy).
+    confirm=True — спросить подтверждение перед заменой.
+    Возвращает счётчики, в т.ч. освобождённые байты.
+    """
+    print("\n[>>] Ищу одинаковые видео в разных папках...")
+    link_mode = cfg.get("link_mode", "auto")
+    groups = find_link_groups(tree, cache, resolve_hash_algorithm(cfg), resolve_hash_workers(cfg))
+    pairs = []
+    for files in groups:
+        keep = pick_file_to_keep(files, cfg["auto_keep_strategy"])
+        pairs.extend((keep, f) for f in files if f != keep)
+
+    counters = {"groups": len(groups), "linked": 0, "bytes": 0, "failed": 0}
+    planned = sum(f.size for _, f in pairs)
+    print(f"  Групп: {len(groups)}, копий к замене ссылками: {len(pairs)} ({fmt_size(planned)})")
+    if not pairs:
+        return counters
+    if dry_run:
+        counters["linked"] = len(pairs)
+        counters["bytes"] = planned
+        print("  (dry-run, ничего не изменено)")
+        return counters
+    if confirm:
+        ans = input(f"\n  Заменить {len(pairs)} копий ссылками ({link_mode})? (y/n): ").strip().lower()
+        if ans != "y":
+            print("  Отменено.")
+            return counters
+
+    for keep, target in pairs:
+        try:
+            nlink = os.stat(target.path).st_nlink
+        except OSError:
+            nlink = 1
+        method = link_replace(keep, target, link_mode)
+        if method is None:
+            counters["failed"] += 1
+            continue
+        counters["linked"] += 1
+        # Место освобождается, только если у копии не было других жёстких ссылок
+        if nlink <= 1:
+            counters["bytes"] += target.size
+
+    print(f"  Заменено ссылками: {counters['linked']}, не удалось: {counters['failed']}")
+    print(f"  Освобождено: {fmt_size(counters['bytes'])}")
+    return counters
+
+
+# ─── ПАКЕТНЫЙ РЕЖИМ ───────────────────────────────────────────────────────────
+#
+# Без input() и без построчного вывода: --scan сохраняет план в JSON,
+# --apply удаляет по плану и печатает только итоговые счётчики.
+# Перед удалением каждая запись сверяется с диском (размер и mtime),
+# поэтому устаревший план ничего лишнего не удалит.
+
+def _plan_entry(f: FileInfo) -> dict:
+    return {"path": str(f.path), "size": f.size, "mtime_ns": f.mtime_ns}
+
+
+def batch_scan(root: Path, cfg: dict, mode: str, plan_path: Path) -> dict:
+    """
+    Просканировать root и записать план удаления в plan_path.
+    mode: "dupes" | "orphans" | "both". Дубли размечаются по auto_keep_strategy.
+    """
+    algorithm = resolve_hash_algorithm(cfg)
+    strategy = cfg["auto_keep_strategy"]
+    plan: dict = {
+        "version": PLAN_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "root": str(root),
+        "algorithm": algorithm,
+        "keep_strategy": strategy,
+        "duplicates": [],
+        "orphans": [],
+        "protected_skipped": 0,
+    }
+
+    cache = open_hash_cache(resolve_cache_path(cfg))
+    try:
+        tree = None
+        if mode in ("dupes", "both"):
+            tree = scan_tree(root, cache if cfg.get("incremental_scan", True) else None)
+            dupes = find_duplicates(root, cache, algorithm, resolve_hash_workers(cfg), tree)
+            to_delete, plan["protected_skipped"] = plan_duplicate_deletions(
+                list(dupes.items()), strategy)
+            by_keep: dict = {}
+            for keep, f in to_delete:
+                group = by_keep.setdefault(keep.path, {"keep": _plan_entry(keep), "delete": []})
+                group["delete"].append(_plan_entry(f))
+            plan["duplicates"] = list(by_keep.values())
+        if mode in ("orphans", "both"):
+            plan["orphans"] = [_plan_entry(f) for f in collect_orphans(root, cfg, cache, tree)]
+    finally:
+        if cache is not None:
+            cache.close()
+
+    tmp = plan_path.with_name(plan_path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, plan_path)
+
+    dup_files = sum(len(g["delete"]) for g in plan["duplicates"])
+    dup_bytes = sum(e["size"] for g in plan["duplicates"] for e in g["delete"])
+    orphan_bytes = sum(e["size"] for e in plan["orphans"])
+    print(f"\n[OK] План сохранён: {plan_path}")
+    print(f"  Дубли к удалению     : {dup_files} ({fmt_size(dup_bytes)})")
+    print(f"  Сироты к удалению    : {len(plan['orphans'])} ({fmt_size(orphan_bytes)})")
+    if plan["protected_skipped"]:
+        print(f"  Защищённых пропущено : {plan['protected_skipped']}")
+    return plan
+
+
+def _matches_disk(entry: dict) -> bool:
+    try:
+        st = os.stat(entry["path"])
+    except OSError:
+        return False
+    return st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]
+
+
+def batch_apply(plan_path: Path, dry_run: bool = False) -> dict:
+    """
+    Удалить файлы по плану. Запись пропускается, если файл исчез или изменился
+    после скана, а для дублей — ещё и если исчез или изменился оставляемый файл.
+    Возвращает счётчики.
+    """
+    with open(plan_path, encoding="utf-8") as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"неподдерживаемая версия плана: {plan.get('version')}")
+
+    counters = {"deleted": 0, "bytes": 0, "changed": 0, "blocked": 0, "errors": 0}
+    queue: list = [e for g in plan.get("duplicates", []) if _matches_disk(g["keep"])
+                   for e in g["delete"]]
+    counters["changed"] += sum(len(g["delete"]) for g in plan.get("duplicates", [])
+                               if not _matches_disk(g["keep"]))
+    queue.extend(plan.get("orphans", []))
+
+    done: set = set()
+    for entry in queue:
+        # Файл может быть и дублем, и сиротой — обрабатывается один раз
+        if entry["path"] in done:
+            continue
+        done.add(entry["path"])
+        path = Path(entry["path"])
+        if not is_deletable(path):
+            counters["blocked"] += 1
+            continue
+        if not _matches_disk(entry):
+            counters["changed"] += 1
+            continue
+        if dry_run:
+            counters["deleted"] += 1
+            counters["bytes"] += entry["size"]
+        elif safe_unlink(path, quiet=True):
+            counters["deleted"] += 1
+            counters["bytes"] += entry["size"]
+        else:
+            counters["errors"] += 1
+
+    verb = "Будет удалено" if dry_run else "Удалено"
+    print(f"\n[OK] План: {plan_path}{'  (dry-run, ничего не удалено)' if dry_run else ''}")
+    print(f"  {verb:<21}: {counters['deleted']} ({fmt_size(counters['bytes'])})")
+    print(f"  Изменились/исчезли   : {counters['changed']}")
+    print(f"  Заблокировано        : {counters['blocked']}")
+    print(f"  Ошибок               : {counters['errors']}")
+    return counters
+
+
 # ─── MAIN ─────────────────────────────────────────────────────────────────────
 
 def main() -> None:
@@ -494,9 +1348,10 @@ def main() -> None:
     show_config(cfg)
 
     print("\nРежим работы:")
-    print("  1 -- Найти и удалить дубли файлов (по SHA-256)")
-    print("  2 -- Найти и удалить осиротевшие .json / .jpg (без парного .mp4)")
+    print(f"  1 -- Найти и удалить дубли файлов (по {resolve_hash_algorithm(cfg)})")
+    print("  2 -- Найти и удалить осиротевшие .json / .jpg (без парного медиафайла)")
     print("  3 -- Оба режима")
+    print("  4 -- Заменить одинаковые видео в разных папках ссылками (hardlink/reflink)")
     print("  s -- Настройки")
     print("  q -- Выход")
 
@@ -513,22 +1368,75 @@ def main() -> None:
             print(f"  Рабочая директория: {root}")
             show_config(cfg)
 
-        elif mode in ("1", "2", "3"):
+        elif mode in ("1", "2", "3", "4"):
             break
 
         else:
-            print("  Введите 1, 2, 3, s или q.")
-
-    if mode in ("1", "3"):
-        dupes = find_duplicates(root)
-        handle_duplicates(dupes, cfg)
+            print("  Введите 1, 2, 3, 4, s или q.")
 
-    if mode in ("2", "3"):
-        orphans = find_orphans(root)
-        handle_orphans(orphans)
+    cache = open_hash_cache(resolve_cache_path(cfg))
+    try:
+        # Один обход дерева на все режимы; сиротам из каталога он не нужен
+        tree = None
+        if mode != "2":
+            tree = scan_tree(root, cache if cfg.get("incremental_scan", True) else None)
+
+        if mode in ("1", "3"):
+            dupes = find_duplicates(root, cache, resolve_hash_algorithm(cfg),
+                                    resolve_hash_workers(cfg), tree)
+            handle_duplicates(dupes, cfg)
+
+        if mode in ("2", "3"):
+            orphans = collect_orphans(root, cfg, cache, tree)
+            handle_orphans(orphans)
+
+        if mode == "4":
+            dedup_links(root, cfg, tree, cache, confirm=True)
+    finally:
+        if cache is not None:
+            cache.close()
 
     print("\n[OK] Готово.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File Deduplicator & Orphan Media Cleaner")
+    parser.add_argument("--scan", nargs="?", const=str(DEFAULT_PLAN_PATH), metavar="PLAN",
+                        help="просканировать и записать JSON-план (без вопросов)")
+    parser.add_argument("--apply", metavar="PLAN", help="удалить файлы по JSON-плану")
+    parser.add_argument("--link-dupes", action="store_true",
+                        help="заменить одинаковые видео в разных папках ссылками (без вопросов)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="с --apply / --link-dupes: только посчитать, ничего не менять")
+    parser.add_argument("--mode", choices=("dupes", "orphans", "both"), default="both",
+                        help="что искать при --scan (по умолчанию both)")
+    parser.add_argument("--root", help="рабочая директория (вместо work_dir из настроек)")
+    args = parser.parse_args()
+
+    if args.scan or args.apply or args.link_dupes:
+        cfg = load_config()
+        if args.root:
+            cfg["work_dir"] = args.root
+        if args.link_dupes:
+            root = resolve_work_dir(cfg)
+            cache = open_hash_cache(resolve_cache_path(cfg))
+            try:
+                tree = scan_tree(root, cache if cfg.get("incremental_scan", True) else None)
+                result = dedup_links(root, cfg, tree, cache, args.dry_run)
+            finally:
+                if cache is not None:
+                    cache.close()
+            if not (args.scan or args.apply):
+                sys.exit(1 if result["failed"] else 0)
+        if args.scan:
+            batch_scan(resolve_work_dir(cfg), cfg, args.mode, Path(args.scan))
+        if args.apply:
+            try:
+                result = batch_apply(Path(args.apply), args.dry_run)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"  [!!] Не удалось применить план: {e}")
+                sys.exit(2)
+            sys.exit(1 if result["errors"] else 0)
+        sys.exit(0)
+
     main()